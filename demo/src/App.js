@@ -78,13 +78,12 @@ class Demo extends React.Component {
     if (slug && !responseData) {
       // Make an ajax call to get the permadata,
       // and then use it to update the state.
-      fetch(`${API_ROOT}/permadata`, {
-        method: 'POST',
+      // This is a GET so that the browser can cache it; permalinks never change.
+      fetch(`${API_ROOT}/permadata/${encodeURIComponent(slug)}`, {
+        method: 'GET',
         headers: {
           'Accept': 'application/json',
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({"slug": slug})
+        }
       }).then(function(response) {
         return response.json();
       }).then((json) => {
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+"""
+Measures the throughput and latency of the demo server under a few typical workloads,
+by driving the Flask app (in-process, through its test client) from several threads:
+
+    cache-hot   the same input over and over, so everything after the first request is a cache hit
+    cache-cold  a different input every time, through a stub predictor that takes ``--latency-ms``
+    db          like cache-cold, but recording every prediction in the database
+                (an ``InMemoryDemoDatabase``, or Postgres if ``--postgres`` is given and
+                the ``DEMO_POSTGRES_*`` environment variables are set)
+    mixed       the small models under ``tests/fixtures``, taking turns, with caching off
+
+For example:
+
+    ./scripts/benchmark.py cache-cold db --requests 2000 --concurrency 16
+
+Each run is appended to ``--results`` along with the current git commit, and compared
+with the most recent run of the same workload at a different commit, so that
+regressions show up.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import copy
+import itertools
+import json
+import subprocess
+import tempfile
+import threading
+import time
+
+from flask import Flask
+
+from allennlp.common.util import JsonDict
+from allennlp.models.archival import load_archive
+from allennlp.service.predictors import Predictor
+
+from server.app import make_app
+from server.cache import InMemoryPredictionCache
+from server.db import DemoDatabase, InMemoryDemoDatabase, PostgresDemoDatabase
+from server.prediction_log import PredictionLog
+
+# The small models used by the tests, along with an input for each.
+FIXTURES = {
+        'machine-comprehension': ('tests/fixtures/bidaf/model.tar.gz',
+                                  {"passage": "the super bowl was played in seattle",
+                                   "question": "where was the super bowl played?"}),
+        'semantic-role-labeling': ('tests/fixtures/srl/model.tar.gz',
+                                   {"sentence": "the super bowl was played in seattle"}),
+        'textual-entailment': ('tests/fixtures/decomposable_attention/model.tar.gz',
+                               {"premise": "the super bowl was played in seattle",
+                                "hypothesis": "the super bowl was played in ohio"})
+}
+
+CACHE_BYTES = 64 * 1024 * 1024
+
+# Returns the path and the input for the i-th request.
+RequestMaker = Callable[[int], Tuple[str, JsonDict]]
+
+
+class SleepingPredictor(Predictor):
+    """
+    stub predictor that takes ``latency_ms`` to return a copy of its inputs
+    """
+    # pylint: disable=abstract-method
+    def __init__(self, latency_ms: float) -> None:  # pylint: disable=super-init-not-called
+        self.latency = latency_ms / 1000
+
+    def predict_json(self, inputs: JsonDict) -> JsonDict:
+        time.sleep(self.latency)
+        return copy.deepcopy(inputs)
+
+    def predict_batch_json(self, inputs: List[JsonDict]) -> List[JsonDict]:
+        time.sleep(self.latency)
+        return copy.deepcopy(inputs)
+
+
+def cache_hot(args: argparse.Namespace) -> Tuple[Flask, RequestMaker]:
+    app = _app(args, {"stub": SleepingPredictor(args.latency_ms)})
+    return app, lambda i: ("/predict/stub?record=false", {"sentence": "the same thing every time"})
+
+def cache_cold(args: argparse.Namespace) -> Tuple[Flask, RequestMaker]:
+    app = _app(args, {"stub": SleepingPredictor(args.latency_ms)})
+    return app, lambda i: ("/predict/stub?record=false", {"sentence": "sentence number {}".format(i)})
+
+def db(args: argparse.Namespace) -> Tuple[Flask, RequestMaker]:
+    demo_db: Optional[DemoDatabase] = PostgresDemoDatabase.from_environment() if args.postgres else None
+    if demo_db is None:
+        demo_db = InMemoryDemoDatabase()
+    app = _app(args, {"stub": SleepingPredictor(args.latency_ms)}, demo_db)
+    return app, lambda i: ("/predict/stub", {"sentence": "sentence number {}".format(i)})
+
+def mixed(args: argparse.Namespace) -> Tuple[Flask, RequestMaker]:
+    predictors = {name: Predictor.from_archive(load_archive(archive_file), name)
+                  for name, (archive_file, _) in FIXTURES.items()}
+    app = _app(args, predictors)
+    names = sorted(FIXTURES)
+
+    def make_request(i: int) -> Tuple[str, JsonDict]:
+        name = names[i % len(names)]
+        return "/predict/{}?record=false&cache=false".format(name), FIXTURES[name][1]
+
+    return app, make_request
+
+WORKLOADS = {
+        "cache-hot": cache_hot,
+        "cache-cold": cache_cold,
+        "db": db,
+        "mixed": mixed
+}
+
+
+def _app(args: argparse.Namespace,
+         predictors: Dict[str, Predictor],
+         demo_db: Optional[DemoDatabase] = None) -> Flask:
+    app = make_app(build_dir=tempfile.mkdtemp(),
+                   demo_db=demo_db,
+                   cache=InMemoryPredictionCache(max_bytes=CACHE_BYTES))
+    app.predictors = predictors
+    app.testing = True
+    # Don't log every prediction to stdout, which would bury the results and slow the requests down.
+    app.prediction_log.close()
+    app.prediction_log = PredictionLog(sample_rate=0.0)
+    return app
+
+
+def run(app: Flask, make_request: RequestMaker, num_requests: int, concurrency: int) -> JsonDict:
+    """
+    Sends ``num_requests`` requests from ``concurrency`` threads at once,
+    and returns the throughput and latency percentiles (in milliseconds).
+    """
+    client = app.test_client()
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies: List[float] = []
+    errors = 0
+
+    def work() -> None:
+        nonlocal errors
+        while True:
+            i = next(counter)
+            if i >= num_requests:
+                return
+            path, data = make_request(i)
+            start = time.perf_counter()
+            response = client.post(path, content_type="application/json", data=json.dumps(data))
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(work)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {"requests": num_requests,
+            "concurrency": concurrency,
+            "errors": errors,
+            "requests_per_second": round(num_requests / elapsed, 1),
+            "p50_ms": _percentile(latencies, 50),
+            "p95_ms": _percentile(latencies, 95),
+            "p99_ms": _percentile(latencies, 99)}
+
+def _percentile(ordered: List[float], percent: float) -> float:
+    index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 2)
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def _previous(results_file: str, workload: str, commit: str) -> Optional[JsonDict]:
+    """
+    The most recent saved run of the workload at a commit other than this one.
+    """
+    previous = None
+    try:
+        with open(results_file) as results:
+            for line in results:
+                record = json.loads(line)
+                if record["workload"] == workload and record["commit"] != commit:
+                    previous = record
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the demo server.")
+    parser.add_argument("workloads", nargs="*", metavar="WORKLOAD",
+                        help="the workloads to run (default: all of them)")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per workload")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--latency-ms", type=float, default=20, help="how long the stub predictor takes")
+    parser.add_argument("--postgres", action="store_true", help="use Postgres for the db workload")
+    parser.add_argument("--results", default="benchmark_results.jsonl", help="file to append the results to")
+    args = parser.parse_args()
+    # (Not checked with ``choices``, which argparse also applies to the default list as a whole.)
+    unknown = [workload for workload in args.workloads if workload not in WORKLOADS]
+    if unknown:
+        parser.error("unknown workloads: {} (choose from {})".format(", ".join(unknown),
+                                                                     ", ".join(sorted(WORKLOADS))))
+    args.workloads = args.workloads or sorted(WORKLOADS)
+
+    commit = _commit()
+    for workload in args.workloads:
+        app, make_request = WORKLOADS[workload](args)
+        # Warm up, so that one-off costs (and, for cache-hot, the first miss) aren't counted,
+        # with inputs that the measured requests won't repeat.
+        for i in range(args.requests, args.requests + 10):
+            path, data = make_request(i)
+            app.test_client().post(path, content_type="application/json", data=json.dumps(data))
+
+        results = run(app, make_request, args.requests, args.concurrency)
+        record = {"commit": commit,
+                  "date": datetime.now().isoformat(timespec="seconds"),
+                  "workload": workload,
+                  "latency_ms": args.latency_ms,
+                  "results": results}
+
+        print("{:<12} {requests_per_second:>8} req/s  p50 {p50_ms:>8} ms  p95 {p95_ms:>8} ms  "
+              "p99 {p99_ms:>8} ms  errors {errors}".format(workload, **results))
+        previous = _previous(args.results, workload, commit)
+        if previous is not None:
+            before = previous["results"]
+            print("{:<12} vs {}: {:+.1f}% req/s, {:+.1f}% p99".format(
+                    "", previous["commit"],
+                    100 * (results["requests_per_second"] / before["requests_per_second"] - 1),
+                    100 * (results["p99_ms"] / before["p99_ms"] - 1) if before["p99_ms"] else 0.0))
+
+        with open(args.results, "a") as results_file:
+            results_file.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Unpacks each demo model's archive into the model store, with its weights in a form that the
+server can memory-map, so that it starts up without unpacking or deserializing anything:
+
+    ./scripts/extract_models.py --store /stage/allennlp/model-store
+
+The server loads models from the store named by ``ALLENNLP_DEMO_MODEL_STORE``.
+With ``--time-loads``, each model is also loaded both ways, to show what the store saves.
+"""
+import argparse
+import time
+
+from allennlp.models.archival import load_archive
+
+from server.models import MODEL_STORE, MODELS, load_extracted
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Extract the demo models into a model store.")
+    parser.add_argument("models", nargs="*", metavar="MODEL",
+                        help="the models to extract (default: all of them)")
+    parser.add_argument("--store", default=MODEL_STORE, required=MODEL_STORE is None,
+                        help="where to put them (default: $ALLENNLP_DEMO_MODEL_STORE)")
+    parser.add_argument("--time-loads", action="store_true",
+                        help="compare loading each model from its archive and from the store")
+    args = parser.parse_args()
+    # (Not checked with ``choices``, which argparse also applies to the default list as a whole.)
+    unknown = [model for model in args.models if model not in MODELS]
+    if unknown:
+        parser.error("unknown models: {} (choose from {})".format(", ".join(unknown),
+                                                                  ", ".join(sorted(MODELS))))
+    args.models = args.models or sorted(MODELS)
+
+    print(f"Extracting {len(args.models)} models into {args.store}.")
+    for name in args.models:
+        demo_model = MODELS[name]
+        start = time.time()
+        path = demo_model.extract(args.store)
+        print(f"{name:<28} extracted to {path} in {time.time() - start:.1f}s")
+
+        if args.time_loads:
+            start = time.time()
+            load_archive(demo_model.archive_file)
+            from_archive = time.time() - start
+            start = time.time()
+            load_extracted(path)
+            from_store = time.time() - start
+            print(f"{'':<28} loads in {from_archive:.2f}s from its archive, {from_store:.2f}s from the store")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Migrates the demo database's ``queries`` table to the schema the server expects, using the same
+``DEMO_POSTGRES_*`` environment variables as the server. Run it (as a user that's allowed to alter
+the table) before deploying a server that needs the new schema:
+
+    ./scripts/migrate_db.py
+
+Every step is safe to run again. The steps are:
+
+1. Add the ``content_hash`` column, which identifies a prediction by its model, model version and inputs.
+2. Backfill it for existing rows (since ``--since-id``), assuming they were made with the model
+   archives that are in ``MODELS`` now. Rows for models that aren't there any more are left alone.
+3. Clear the hash of all but the first of any rows that share one, rather than deleting them,
+   so that their permalinks keep working.
+4. Index the hashes, without locking the table against the server's inserts while that happens.
+   If an earlier run failed partway through building the index, Postgres leaves it behind marked
+   invalid (and ``IF NOT EXISTS`` would skip it), so it's dropped and built again.
+5. Add the ``hits`` column, which counts the requests for each stored prediction. Existing rows
+   count as one each, which is what they did before deduplication. (Before Postgres 11,
+   adding a column with a default rewrites the table.)
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from server.cache import cache_key
+from server.models import MODELS
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+ADD_CONTENT_HASH_SQL = "ALTER TABLE queries ADD COLUMN IF NOT EXISTS content_hash TEXT"
+
+UNHASHED_SQL = (
+        """
+        SELECT id, model_name, request_data
+        FROM queries
+        WHERE content_hash IS NULL AND id >= %s
+        ORDER BY id
+        """
+)
+
+BACKFILL_SQL = (
+        """
+        UPDATE queries SET content_hash = data.content_hash
+        FROM (VALUES %s) AS data (id, content_hash)
+        WHERE queries.id = data.id
+        """
+)
+
+CLEAR_DUPLICATES_SQL = (
+        """
+        UPDATE queries SET content_hash = NULL
+        WHERE content_hash IS NOT NULL
+          AND id NOT IN (SELECT min(id) FROM queries WHERE content_hash IS NOT NULL GROUP BY content_hash)
+        """
+)
+
+ADD_HITS_SQL = "ALTER TABLE queries ADD COLUMN IF NOT EXISTS hits INTEGER NOT NULL DEFAULT 1"
+
+INDEX_VALID_SQL = (
+        """
+        SELECT pg_index.indisvalid
+        FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+        WHERE pg_class.relname = 'queries_content_hash'
+        """
+)
+
+# These have to run outside a transaction.
+DROP_INDEX_SQL = "DROP INDEX CONCURRENTLY IF EXISTS queries_content_hash"
+CREATE_INDEX_SQL = "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS queries_content_hash ON queries (content_hash)"
+
+
+def backfill(conn: psycopg2.extensions.connection, since_id: int, batch_size: int) -> int:
+    """
+    Hashes the rows that don't have a hash yet, the same way the server does (for a request for
+    every field of the prediction, which is what the rows made before field selection hold).
+    """
+    hashed = 0
+    # A named (server-side) cursor, so that the whole table isn't read into memory at once.
+    with conn.cursor(name="unhashed") as reader, conn.cursor() as writer:
+        reader.itersize = batch_size
+        reader.execute(UNHASHED_SQL, (since_id,))
+        batch = []
+        for perma_id, model_name, request_data in reader:
+            demo_model = MODELS.get(model_name.lower())
+            if demo_model is None:
+                continue
+            batch.append((perma_id, cache_key(model_name.lower(), demo_model.version, json.loads(request_data))))
+            if len(batch) == batch_size:
+                execute_values(writer, BACKFILL_SQL, batch)
+                hashed += len(batch)
+                batch = []
+        if batch:
+            execute_values(writer, BACKFILL_SQL, batch)
+            hashed += len(batch)
+    return hashed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Migrate the demo database to the current schema.")
+    parser.add_argument("--since-id", type=int, default=0,
+                        help="only backfill rows from this id on (e.g. the first made with the current models)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="rows to backfill per update")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    settings = {"host": os.environ.get("DEMO_POSTGRES_HOST"),
+                "port": os.environ.get("DEMO_POSTGRES_PORT") or "5432",
+                "dbname": os.environ.get("DEMO_POSTGRES_DBNAME"),
+                "user": os.environ.get("DEMO_POSTGRES_USER"),
+                "password": os.environ.get("DEMO_POSTGRES_PASSWORD")}
+    if not all(settings.values()):
+        logger.error("the DEMO_POSTGRES_* environment variables aren't all set")
+        sys.exit(-1)
+
+    conn = psycopg2.connect(**settings)
+    with conn, conn.cursor() as curs:
+        curs.execute(ADD_CONTENT_HASH_SQL)
+    logger.info("added content_hash column")
+
+    with conn:
+        logger.info("backfilled %s content hashes", backfill(conn, args.since_id, args.batch_size))
+
+    with conn, conn.cursor() as curs:
+        curs.execute(CLEAR_DUPLICATES_SQL)
+        logger.info("cleared %s duplicate content hashes", curs.rowcount)
+
+    conn.autocommit = True
+    with conn.cursor() as curs:
+        curs.execute(INDEX_VALID_SQL)
+        row = curs.fetchone()
+        if row is not None and not row[0]:
+            logger.info("dropping the invalid index left behind by an earlier run")
+            curs.execute(DROP_INDEX_SQL)
+        curs.execute(CREATE_INDEX_SQL)
+    logger.info("indexed content hashes")
+
+    with conn.cursor() as curs:
+        curs.execute(ADD_HITS_SQL)
+    logger.info("added hits column")
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Runs one of the demo models over a JSONL file (or stdin) offline, writing one JSON result
+per non-blank input line, in input order, to a file (or stdout). For example:
+
+    ./scripts/score.py named-entity-recognition --input docs.jsonl --output ner.jsonl --workers 4
+
+With ``--workers`` above 1, batches are spread over that many processes, each with its own
+copy of the model. When writing to a file, progress is checkpointed as it goes, so a run
+that's interrupted can be picked up where it left off with ``--resume``.
+"""
+from collections import deque
+from typing import Deque, Iterator, List, Optional, Tuple
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import torch
+
+from allennlp.common.util import JsonDict
+from allennlp.service.predictors import Predictor
+
+from server.models import MODELS
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# How many batches each worker can have waiting, so that we never read far ahead of the output.
+BATCHES_PER_WORKER = 2
+
+# How often (in seconds) to report throughput.
+REPORT_INTERVAL = 30
+
+# The predictor in a worker process.
+_predictor: Optional[Predictor] = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run a demo model over a JSONL file.")
+    parser.add_argument("model", choices=sorted(MODELS), help="the model to run")
+    parser.add_argument("--input", default="-", help="JSONL file of inputs (default: stdin)")
+    parser.add_argument("--output", default="-", help="JSONL file for the results (default: stdout)")
+    parser.add_argument("--batch-size", type=int, default=32, help="inputs to run through the model at once")
+    parser.add_argument("--workers", type=int, default=1, help="processes to run the model in")
+    parser.add_argument("--checkpoint-every", type=int, default=100,
+                        help="batches between checkpoints (only when writing to a file)")
+    parser.add_argument("--resume", action="store_true",
+                        help="carry on from the last checkpoint rather than starting over")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s', level=logging.INFO)
+
+    if args.resume and args.output == "-":
+        parser.error("--resume needs an --output file")
+
+    checkpoint_file = args.output + ".checkpoint" if args.output != "-" else None
+    lines_done, bytes_done = _read_checkpoint(checkpoint_file) if args.resume else (0, 0)
+
+    source = sys.stdin if args.input == "-" else open(args.input)
+    if args.output == "-":
+        sink = sys.stdout
+    else:
+        sink = open(args.output, "r+" if args.resume and os.path.exists(args.output) else "w")
+        # Throw away anything written after the last checkpoint, since we're about to redo it.
+        sink.seek(bytes_done)
+        sink.truncate()
+
+    if lines_done:
+        logger.info("resuming after %s lines", lines_done)
+        for _ in range(lines_done):
+            source.readline()
+
+    score(args.model, source, sink, args.batch_size, args.workers,
+          lines_done, checkpoint_file, args.checkpoint_every)
+
+
+def score(model_name: str,
+          source,
+          sink,
+          batch_size: int,
+          num_workers: int,
+          lines_done: int = 0,
+          checkpoint_file: str = None,
+          checkpoint_every: int = 100) -> None:
+    """
+    Writes the model's results for each line of ``source`` to ``sink``, in order.
+    ``lines_done`` is how many lines of the source have already been read.
+    """
+    start = last_report = time.time()
+    count = 0
+    batches = _batches(source, batch_size)
+
+    for index, (num_lines, results) in enumerate(_run(model_name, batches, num_workers)):
+        for result in results:
+            sink.write(json.dumps(result) + "\n")
+        lines_done += num_lines
+        count += len(results)
+
+        if checkpoint_file is not None and (index + 1) % checkpoint_every == 0:
+            _write_checkpoint(checkpoint_file, sink, lines_done)
+
+        if time.time() - last_report > REPORT_INTERVAL:
+            _report(count, start)
+            last_report = time.time()
+
+    sink.flush()
+    if checkpoint_file is not None:
+        _write_checkpoint(checkpoint_file, sink, lines_done)
+    _report(count, start)
+
+
+def _run(model_name: str,
+         batches: Iterator[Tuple[int, List[str]]],
+         num_workers: int) -> Iterator[Tuple[int, List[JsonDict]]]:
+    """
+    Scores each batch, yielding the results in the same order as the batches.
+    """
+    if num_workers <= 1:
+        _load(model_name, 1)
+        for num_lines, lines in batches:
+            yield num_lines, _score_batch(lines)
+        return
+
+    with multiprocessing.Pool(num_workers, initializer=_load, initargs=(model_name, num_workers)) as pool:
+        # Unlike ``imap``, this only reads as far ahead of the output as there are workers to keep busy.
+        pending: Deque = deque()
+        for num_lines, lines in batches:
+            pending.append((num_lines, pool.apply_async(_score_batch, (lines,))))
+            if len(pending) >= num_workers * BATCHES_PER_WORKER:
+                num_lines, result = pending.popleft()
+                yield num_lines, result.get()
+        while pending:
+            num_lines, result = pending.popleft()
+            yield num_lines, result.get()
+
+
+def _load(model_name: str, num_workers: int) -> None:
+    global _predictor  # pylint: disable=global-statement
+    # Split the cores between the workers, rather than every worker trying to use all of them.
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+    _predictor = MODELS[model_name].predictor()
+
+
+def _score_batch(lines: List[str]) -> List[JsonDict]:
+    """
+    Runs a batch of JSON lines through the predictor. A line that isn't valid JSON,
+    or that the model can't handle, gets an error object in its place.
+    """
+    inputs: List[Optional[JsonDict]] = []
+    for line in lines:
+        try:
+            inputs.append(json.loads(line))
+        except ValueError:
+            inputs.append(None)
+
+    valid = [data for data in inputs if isinstance(data, dict)]
+    try:
+        predictions = iter(_predictor.predict_batch_json(valid) if valid else [])
+    except Exception:  # pylint: disable=broad-except
+        logger.exception("batch of %s failed, retrying individually", len(valid))
+        predictions = iter([_score_one(data) for data in valid])
+
+    return [next(predictions) if isinstance(data, dict) else {"error": "input must be a JSON object"}
+            for data in inputs]
+
+def _score_one(data: JsonDict) -> JsonDict:
+    try:
+        return _predictor.predict_json(data)
+    except Exception as error:  # pylint: disable=broad-except
+        return {"error": repr(error)}
+
+
+def _batches(source, batch_size: int) -> Iterator[Tuple[int, List[str]]]:
+    """
+    Groups the non-blank lines of ``source`` into batches, along with
+    how many lines (blank ones included) each batch used up.
+    """
+    batch: List[str] = []
+    num_lines = 0
+    for line in source:
+        num_lines += 1
+        if line.strip():
+            batch.append(line)
+        if len(batch) == batch_size:
+            yield num_lines, batch
+            batch, num_lines = [], 0
+    if num_lines:
+        yield num_lines, batch
+
+
+def _read_checkpoint(checkpoint_file: str) -> Tuple[int, int]:
+    try:
+        with open(checkpoint_file) as checkpoint:
+            state = json.load(checkpoint)
+    except FileNotFoundError:
+        return 0, 0
+    return state["lines"], state["bytes"]
+
+def _write_checkpoint(checkpoint_file: str, sink, lines_done: int) -> None:
+    """
+    Records how far through the input we are and how much output that accounts for.
+    The output is flushed first, so the checkpoint never gets ahead of it.
+    """
+    sink.flush()
+    os.fsync(sink.fileno())
+    with open(checkpoint_file + ".tmp", "w") as checkpoint:
+        json.dump({"lines": lines_done, "bytes": sink.tell()}, checkpoint)
+    os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+
+def _report(count: int, start: float) -> None:
+    elapsed = time.time() - start
+    logger.info("scored %s inputs in %.1fs (%.1f/s)", count, elapsed, count / elapsed if elapsed else 0.0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Checks what dynamic int8 quantization does to the models in ``tests/fixtures``: how often the
+quantized model's answer agrees with the full-precision one's, and how much faster it is.
+
+    ./scripts/verify_quantization.py --repeat 20
+
+The fixtures are tiny models trained on toy data, so the numbers only show that quantization
+works and roughly what it costs; to judge a production model, compare the two variants on real
+traffic with the server's ``variant`` argument.
+"""
+from typing import Any, Callable, Dict, List, NamedTuple
+import argparse
+import time
+
+import numpy
+
+from allennlp.common.util import JsonDict
+from allennlp.service.predictors import Predictor
+
+from server.models import DemoModel
+
+
+class Fixture(NamedTuple):
+    demo_model: DemoModel
+    inputs: List[JsonDict]
+    # The part of a prediction that has to be the same for the two to agree.
+    answer: Callable[[JsonDict], Any]
+
+
+FIXTURES = {
+        'machine-comprehension': Fixture(
+                DemoModel('tests/fixtures/bidaf/model.tar.gz', 'machine-comprehension'),
+                [{"passage": "the super bowl was played in seattle",
+                  "question": "where was the super bowl played?"},
+                 {"passage": "the squirrel wrote a unit test to make sure its nuts worked as designed",
+                  "question": "what did the squirrel write?"}],
+                lambda prediction: prediction["best_span"]),
+        'textual-entailment': Fixture(
+                DemoModel('tests/fixtures/decomposable_attention/model.tar.gz', 'textual-entailment'),
+                [{"premise": "the super bowl was played in seattle",
+                  "hypothesis": "the super bowl was played in ohio"},
+                 {"premise": "Two women are wandering along the shore.",
+                  "hypothesis": "Two people are walking."}],
+                lambda prediction: int(numpy.argmax(prediction["label_probs"]))),
+        'semantic-role-labeling': Fixture(
+                DemoModel('tests/fixtures/srl/model.tar.gz', 'semantic-role-labeling'),
+                [{"sentence": "the super bowl was played in seattle"},
+                 {"sentence": "The squirrel wrote a unit test to make sure its nuts worked as designed."}],
+                lambda prediction: [verb["tags"] for verb in prediction["verbs"]])
+}
+
+
+def _time(predictor: Predictor, inputs: List[JsonDict], repeat: int) -> float:
+    """
+    The mean time (in milliseconds) to predict one input.
+    """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for data in inputs:
+            predictor.predict_json(data)
+    return 1000 * (time.perf_counter() - start) / (repeat * len(inputs))
+
+def verify(fixture: Fixture, repeat: int) -> Dict[str, float]:
+    full = fixture.demo_model.predictor()
+    quantized = fixture.demo_model.predictor(quantized=True)
+
+    agreed = sum(fixture.answer(full.predict_json(data)) == fixture.answer(quantized.predict_json(data))
+                 for data in fixture.inputs)
+    full_ms = _time(full, fixture.inputs, repeat)
+    quantized_ms = _time(quantized, fixture.inputs, repeat)
+    return {"agreement": agreed / len(fixture.inputs),
+            "full_ms": round(full_ms, 2),
+            "quantized_ms": round(quantized_ms, 2),
+            "speedup": round(full_ms / quantized_ms, 2)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare quantized and full-precision fixture models.")
+    parser.add_argument("models", nargs="*", metavar="MODEL",
+                        help="the models to check (default: all of them)")
+    parser.add_argument("--repeat", type=int, default=10, help="how many times to time each input")
+    args = parser.parse_args()
+    # (Not checked with ``choices``, which argparse also applies to the default list as a whole.)
+    unknown = [model for model in args.models if model not in FIXTURES]
+    if unknown:
+        parser.error("unknown models: {} (choose from {})".format(", ".join(unknown),
+                                                                  ", ".join(sorted(FIXTURES))))
+    args.models = args.models or sorted(FIXTURES)
+
+    for name in args.models:
+        results = verify(FIXTURES[name], args.repeat)
+        print("{:<24} agreement {agreement:>6.1%}  full {full_ms:>8} ms  quantized {quantized_ms:>8} ms  "
+              "speedup {speedup:>5}x".format(name, **results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Admission control for predictions.
+"""
+from contextlib import contextmanager
+from typing import Iterator
+import threading
+
+from allennlp.common.util import JsonDict
+
+
+class Overloaded(Exception):
+    """
+    Raised when there's no room left for another prediction.
+    """
+    pass
+
+
+class AdmissionController:
+    """
+    Lets at most ``max_concurrency`` predictions run at once, with up to ``max_queue`` more
+    waiting for their turn. Anything beyond that is shed immediately with ``Overloaded``
+    rather than queueing up without bound.
+    """
+    def __init__(self, max_concurrency: int, max_queue: int = 0) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.shed = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        with self._condition:
+            if self.in_flight >= self.max_concurrency:
+                if self.waiting >= self.max_queue:
+                    self.shed += 1
+                    raise Overloaded()
+
+                self.waiting += 1
+                try:
+                    while self.in_flight >= self.max_concurrency:
+                        self._condition.wait()
+                finally:
+                    self.waiting -= 1
+
+            self.in_flight += 1
+            self.admitted += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    def stats(self) -> JsonDict:
+        with self._condition:
+            return {"max_concurrency": self.max_concurrency,
+                    "max_queue": self.max_queue,
+                    "in_flight": self.in_flight,
+                    "waiting": self.waiting,
+                    "admitted": self.admitted,
+                    "shed": self.shed}
@@ -3,16 +3,26 @@
 """
 A `Flask <http://flask.pocoo.org/>`_ server that serves up our demo.
 """
+if __name__ == "__main__":
+    # The prediction batchers wait on threads and locks, which need to
+    # cooperate with the gevent ``WSGIServer`` rather than block its event loop,
+    # so patch the standard library before anything else imports it.
+    from gevent import monkey
+    monkey.patch_all()
+
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+import atexit
 import json
 import logging
 import os
+import random
+import signal
 import sys
 import time
-from functools import lru_cache
 
-from flask import Flask, request, Response, jsonify, send_file, send_from_directory
+from flask import Flask, request, Response, jsonify, stream_with_context
 from flask_cors import CORS
 from gevent.pywsgi import WSGIServer
 
@@ -21,14 +31,65 @@ import psycopg2
 import pytz
 
 from allennlp.common.util import JsonDict, peak_memory_mb
-from allennlp.service.db import DemoDatabase, PostgresDemoDatabase
-from allennlp.service.permalinks import int_to_slug, slug_to_int
-from allennlp.service.predictors import Predictor, DemoModel
-
-from server.models import MODELS
-
-# Can override cache size with an environment variable. If it's 0 then disable caching altogether.
-CACHE_SIZE = os.environ.get("FLASK_CACHE_SIZE") or 128
+from allennlp.service.predictors import Predictor
+
+from server.admission import AdmissionController, Overloaded
+from server.batching import PredictionBatcher
+from server.cache import PredictionCache, InMemoryPredictionCache, SqlitePredictionCache, cache_key
+from server.db import DemoDatabase, PostgresDemoDatabase, make_psycopg_green
+from server.encoding import (MSGPACK, compress, decode_json, encode_json, encoders, negotiate, representation,
+                             to_msgpack)
+from server.loader import ModelLoader
+from server.metrics import MetricsRegistry
+from server.models import COMPRESS_LEVEL, COMPRESS_MIN_BYTES, FULL, MODELS, QUANTIZED
+from server.prefork import memory_sharing, serve_forked
+from server.preprocessing import DOCUMENTS, preprocess_batch
+from server.permalinks import int_to_slug, slug_to_int
+from server.prediction_log import PredictionLog
+from server.sentences import split_sentences
+from server.singleflight import SingleFlight
+from server.static import StaticFiles
+from server.warmup import CacheWarmup
+
+# Can override cache size (in megabytes) with an environment variable. If it's 0 then disable caching altogether.
+# Every variant of a prediction (trimmed to some fields, from the quantized model, or as MessagePack or compressed)
+# is an entry of its own, and they all share this one budget with the full predictions, least recently used first.
+CACHE_MB = os.environ.get("FLASK_CACHE_MB")
+# The old setting, which counted predictions rather than megabytes. It's converted
+# (assuming predictions of CACHE_ENTRY_KB kilobytes apiece) if FLASK_CACHE_MB isn't set.
+CACHE_SIZE = os.environ.get("FLASK_CACHE_SIZE")
+CACHE_ENTRY_KB = 32
+# "memory" caches predictions privately in each process; "sqlite" caches them
+# in a file at FLASK_CACHE_PATH that every server process on the host shares.
+CACHE_BACKEND = os.environ.get("FLASK_CACHE_BACKEND") or "memory"
+CACHE_PATH = os.environ.get("FLASK_CACHE_PATH") or "prediction-cache.sqlite"
+# Cached predictions older than this many seconds are recomputed. Unset means they never expire.
+CACHE_TTL = os.environ.get("FLASK_CACHE_TTL")
+# If set, the (in-memory) cache is saved to this file at shutdown and loaded from it at startup.
+CACHE_SNAPSHOT = os.environ.get("FLASK_CACHE_SNAPSHOT")
+# At startup, precompute predictions for (up to) this many of the inputs most often given to each model,
+# according to the database. The server isn't ready until this fraction of them are done.
+WARMUP_SIZE = os.environ.get("ALLENNLP_DEMO_WARMUP_SIZE") or 20
+WARMUP_READY = os.environ.get("ALLENNLP_DEMO_WARMUP_READY") or 0
+# Seconds to pause before answering from the cache, so the demo doesn't feel suspiciously fast.
+CACHE_HIT_DELAY = os.environ.get("FLASK_CACHE_HIT_DELAY") or 0
+# How many inputs /predict_batch runs through the model at once, if not told otherwise, and at most.
+DEFAULT_BATCH_SIZE = 32
+MAX_BATCH_SIZE = 256
+# The fraction of predictions to log, and how many log entries can be waiting to be written
+# before new ones are dropped.
+LOG_SAMPLE_RATE = os.environ.get("ALLENNLP_DEMO_LOG_SAMPLE_RATE") or 1.0
+LOG_QUEUE_SIZE = os.environ.get("ALLENNLP_DEMO_LOG_QUEUE_SIZE") or 1000
+# How long (in seconds) clients may cache the results for a permalink.
+PERMADATA_MAX_AGE = 365 * 24 * 60 * 60
+# How to load the models at startup: "sequential" loads them one at a time and "parallel" loads
+# them all at once, both before the server starts listening; "background" starts listening
+# right away and loads them all at once behind it; "lazy" loads each model on its first request.
+LOAD_MODE = os.environ.get("ALLENNLP_DEMO_LOAD_MODE") or "sequential"
+LOAD_THREADS = os.environ.get("ALLENNLP_DEMO_LOAD_THREADS") or 4
+# Serve from this many forked processes, which share a single copy of the models. (Models that run in their
+# own processes are the exception: their processes are divided between the workers, at least one each.)
+WORKERS = os.environ.get("ALLENNLP_DEMO_WORKERS") or 1
 PORT = os.environ.get("ALLENNLP_DEMO_PORT") or 8000
 DEMO_DIR = os.environ.get("ALLENNLP_DEMO_DIRECTORY") or 'demo/'
 
@@ -38,12 +99,13 @@ logger.setLevel(logging.INFO)
 class ServerError(Exception):
     status_code = 400
 
-    def __init__(self, message, status_code=None, payload=None):
+    def __init__(self, message, status_code=None, payload=None, headers=None):
         Exception.__init__(self)
         self.message = message
         if status_code is not None:
             self.status_code = status_code
         self.payload = payload
+        self.headers = headers
 
     def to_dict(self):
         error_dict = dict(self.payload or ())
@@ -57,6 +119,45 @@ def main():
     if PORT != 8000:
         logger.warning("The demo requires the API to be run on port 8000.")
 
+    # The optional encoders make responses much cheaper, so make it obvious when they're missing.
+    logger.info("encoding with %s", encoders())
+
+    # Let other requests carry on while we wait for the database.
+    make_psycopg_green()
+
+    num_workers = int(WORKERS)
+    loader = ModelLoader(MODELS, {}, num_threads=int(LOAD_THREADS), num_workers=num_workers)
+
+    if num_workers > 1:
+        # The workers share whatever we've loaded, so load everything now, and without starting
+        # any threads, since they wouldn't survive the fork.
+        if LOAD_MODE != "sequential":
+            logger.warning("load mode %s isn't supported with %i workers, loading sequentially",
+                           LOAD_MODE, num_workers)
+        loader.load_here()
+        serve_forked(lambda listener: _serve(listener, loader), ('0.0.0.0', PORT), num_workers)
+        return
+
+    if LOAD_MODE == "sequential":
+        loader.load_all(parallel=False)
+    elif LOAD_MODE == "parallel":
+        loader.load_all()
+    elif LOAD_MODE == "background":
+        loader.load_all(wait=False)
+    elif LOAD_MODE != "lazy":
+        logger.error("unknown load mode %s, aborting", LOAD_MODE)
+        sys.exit(-1)
+
+    _serve(('0.0.0.0', PORT), loader)
+
+def _serve(listener, loader: ModelLoader) -> None:
+    """
+    Serve the demo, with the models from the given loader, on the given address or socket.
+    """
+    # ``docker stop`` (and Kubernetes) send SIGTERM, which by default kills the process without running
+    # the exit handlers that, for instance, flush queued permalinks. Exiting normally runs them.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     # This will be ``None`` if all the relevant environment variables are not defined or if
     # there is an exception when connecting to the database.
     demo_db = PostgresDemoDatabase.from_environment()
@@ -66,16 +167,25 @@ def main():
     app = make_app(demo_db=demo_db)
     CORS(app)
 
-    for name, demo_model in MODELS.items():
-        logger.info(f"loading {name} model")
-        predictor = demo_model.predictor()
-        app.predictors[name] = predictor
+    app.predictors = loader.predictors
+    app.quantized = loader.quantized
+    app.loader = loader
+
+    # Models that run in their own processes get those processes now,
+    # in the process that will be routing requests to them.
+    loader.start_processes()
 
-    http_server = WSGIServer(('0.0.0.0', PORT), app)
+    if app.warmup is not None:
+        # Lazily loaded models stay unloaded until someone actually asks for them.
+        app.warmup.start(list(MODELS) if LOAD_MODE != "lazy" else list(app.predictors))
+
+    http_server = WSGIServer(listener, app)
     logger.info("Server started on port %i.  Please visit: http://localhost:%i", PORT, PORT)
     http_server.serve_forever()
 
-def make_app(build_dir: str = None, demo_db: Optional[DemoDatabase] = None) -> Flask:
+def make_app(build_dir: str = None,
+             demo_db: Optional[DemoDatabase] = None,
+             cache: Optional[PredictionCache] = None) -> Flask:
     if build_dir is None:
         build_dir = os.path.join(DEMO_DIR, 'build')
 
@@ -84,72 +194,339 @@ def make_app(build_dir: str = None, demo_db: Optional[DemoDatabase] = None) -> F
         sys.exit(-1)
 
     app = Flask(__name__)  # pylint: disable=invalid-name
+    static_files = StaticFiles(build_dir)
     start_time = datetime.now(pytz.utc)
     start_time_str = start_time.strftime("%Y-%m-%d %H:%M:%S %Z")
 
     app.predictors = {}
+    # The quantized variants of the models that have them.
+    app.quantized: Dict[str, Predictor] = {}
+    # If set, a ``ModelLoader`` for models that aren't in ``app.predictors`` yet.
+    app.loader: Optional[ModelLoader] = None
+    app.batchers: Dict[str, PredictionBatcher] = {}
+    app.single_flight = SingleFlight()
+    app.admission = {name: AdmissionController(demo_model.max_concurrency, demo_model.max_queue)
+                     for name, demo_model in MODELS.items()
+                     if demo_model.max_concurrency is not None}
+
+    if cache is None:
+        cache = _cache_from_environment()
+        if cache is not None and CACHE_SNAPSHOT:
+            cache.load(CACHE_SNAPSHOT)
+            atexit.register(cache.save, CACHE_SNAPSHOT)
+
+    app.prediction_log = PredictionLog(sample_rate=float(LOG_SAMPLE_RATE), queue_size=int(LOG_QUEUE_SIZE))
+
+    app.metrics = MetricsRegistry()
+    stage_seconds = app.metrics.histogram(
+            "demo_prediction_stage_seconds",
+            "Time spent in each stage (parse, cache, inference, db, serialize) of a prediction request.",
+            ["model", "stage"])
+    prediction_seconds = app.metrics.histogram(
+            "demo_prediction_seconds", "Total time spent handling a prediction request.", ["model"])
+    cache_lookups = app.metrics.counter(
+            "demo_cache_lookups_total", "Prediction cache lookups, by whether they hit.", ["model", "result"])
+    in_flight = app.metrics.gauge(
+            "demo_predictions_in_flight", "Prediction requests currently being handled.", ["model"])
+    shed = app.metrics.counter(
+            "demo_predictions_shed_total", "Prediction requests turned away because the model was overloaded.",
+            ["model"])
+    waiting = app.metrics.gauge(
+            "demo_predictions_waiting", "Predictions queued for admission to the model.", ["model"])
+    db_seconds = app.metrics.histogram(
+            "demo_db_seconds", "Time spent on database operations.", ["operation"])
+    db_errors = app.metrics.counter(
+            "demo_db_errors_total", "Database operations that failed.", ["operation"])
+    cache_bytes = app.metrics.gauge(
+            "demo_cache_bytes", "Size of the values in the prediction cache.")
+    coalesced = app.metrics.counter(
+            "demo_predictions_coalesced_total",
+            "Prediction requests that waited for an identical one in progress rather than running the model.",
+            ["model"])
+    log_dropped = app.metrics.counter(
+            "demo_prediction_log_dropped_total", "Prediction log entries dropped because the log queue was full.")
+    memory = app.metrics.gauge(
+            "demo_process_memory_megabytes", "Memory used by this process, by kind (peak, rss, shared, private).",
+            ["kind"])
+
+    def _collect() -> None:
+        for name, admission in app.admission.items():
+            waiting.set(admission.waiting, model=name)
+        if demo_db is not None:
+            for operation, count in demo_db.stats().get("errors", {}).items():
+                db_errors.set(count, operation=operation)
+        if cache is not None:
+            cache_bytes.set(cache.stats()["bytes"])
+        log_dropped.set(app.prediction_log.dropped)
+        memory.set(peak_memory_mb(), kind="peak")
+        sharing = memory_sharing()
+        if sharing is not None:
+            memory.set(sharing["rss_mb"], kind="rss")
+            memory.set(sharing["shared_mb"], kind="shared")
+            memory.set(sharing["private_mb"], kind="private")
+    app.metrics.collectors.append(_collect)
 
     try:
-        cache_size = int(CACHE_SIZE)  # type: ignore
+        cache_hit_delay = float(CACHE_HIT_DELAY)
     except ValueError:
-        logger.warning("unable to parse cache size %s as int, disabling cache", CACHE_SIZE)
-        cache_size = 0
+        logger.warning("unable to parse cache hit delay %s as a number, not delaying", CACHE_HIT_DELAY)
+        cache_hit_delay = 0.0
 
     @app.errorhandler(ServerError)
     def handle_invalid_usage(error: ServerError) -> Response:  # pylint: disable=unused-variable
         response = jsonify(error.to_dict())
         response.status_code = error.status_code
+        if error.headers:
+            response.headers.extend(error.headers)
         return response
 
-    @lru_cache(maxsize=cache_size)
-    def _caching_prediction(model: Predictor, data: str) -> JsonDict:
+    def _predictor(model_name: str, variant: str = FULL) -> Predictor:
+        """
+        Returns the predictor for the given model (and variant), loading it first if it hasn't been yet.
+        """
+        if variant == QUANTIZED:
+            model = app.quantized.get(model_name.lower())
+            if model is None and app.loader is not None and model_name.lower() in app.loader.models:
+                model = app.loader.load_quantized(model_name.lower())
+            if model is None:
+                raise ServerError("unable to load quantized model: {}".format(model_name), status_code=503)
+            return model
+
+        model = app.predictors.get(model_name.lower())
+        if model is None and app.loader is not None and model_name.lower() in app.loader.models:
+            model = app.loader.load(model_name.lower())
+            if model is None:
+                raise ServerError("unable to load model: {}".format(model_name), status_code=503)
+        if model is None:
+            raise ServerError("unknown model: {}".format(model_name), status_code=400)
+        return model
+
+    def _batcher(model_name: str, model: Predictor, variant: str = FULL) -> PredictionBatcher:
+        """
+        Returns the ``PredictionBatcher`` for the given model (and variant), creating it (with the
+        batching settings from ``MODELS``, if any) the first time the model is used.
+        """
+        name = model_name if variant == FULL else "{}/{}".format(model_name, variant)
+        batcher = app.batchers.get(name)
+        if batcher is None or batcher.predictor is not model:
+            demo_model = MODELS.get(model_name)
+            if demo_model is None:
+                batcher = PredictionBatcher(model)
+            else:
+                batcher = PredictionBatcher(model,
+                                            max_batch_size=demo_model.max_batch_size,
+                                            batch_window_ms=demo_model.batch_window_ms)
+            app.batchers[name] = batcher
+        return batcher
+
+    def _variant(model_name: str, requested: Optional[str]) -> str:
+        """
+        The variant of the model to use: the one ``requested`` (by the ``variant`` argument), or else
+        the quantized one for the model's ``quantized_fraction`` of requests, if it's loaded.
+        """
+        demo_model = MODELS.get(model_name)
+        if requested:
+            if requested not in (FULL, QUANTIZED):
+                raise ServerError("unknown variant: {}".format(requested), status_code=400)
+            if requested == QUANTIZED and (demo_model is None or not demo_model.quantize):
+                raise ServerError("{} has no quantized variant".format(model_name), status_code=400)
+            return requested
+
+        sampled = demo_model is not None and random.random() < demo_model.quantized_fraction
+        if sampled and model_name in app.quantized:
+            return QUANTIZED
+        return FULL
+
+    def _fields(model_name: str, requested: Optional[str]) -> Optional[FrozenSet[str]]:
+        """
+        The fields of the prediction to return, as ``requested`` by the (comma-separated) ``fields``
+        argument, or else the model's ``default_fields``. ``None`` (or ``fields=*``) means all of them.
+        """
+        if requested == "*":
+            return None
+        elif requested:
+            return frozenset(field.strip() for field in requested.split(",") if field.strip())
+
+        demo_model = MODELS.get(model_name)
+        if demo_model is None or demo_model.default_fields is None:
+            return None
+        return frozenset(demo_model.default_fields)
+
+    def _key(model_name: str, data: JsonDict, fields: Optional[FrozenSet[str]], variant: str = FULL) -> str:
+        """
+        Identifies the prediction, trimmed to ``fields``, in the cache, in the database and while it's in flight.
+        """
+        demo_model = MODELS.get(model_name)
+        version = demo_model.version if demo_model else ""
+        if variant != FULL:
+            version += "|" + variant
+        if fields is not None:
+            version += "|fields=" + ",".join(sorted(fields))
+        return cache_key(model_name, version, data)
+
+    def _warm(model_name: str, data: JsonDict) -> bool:
+        """
+        Caches the prediction that a request with the given inputs (and no other arguments) would get,
+        unless it's already cached. Returns whether it had to make the prediction.
+        """
+        fields = _fields(model_name, None)
+        key = _key(model_name, data, fields)
+        if cache.get(key) is not None:
+            return False
+        batcher = _batcher(model_name, _predictor(model_name))
+        cache.put(key, encode_json(_project(batcher.predict_json(data), fields)))
+        return True
+
+    app.warmup: Optional[CacheWarmup] = None
+    if cache is not None and demo_db is not None and int(WARMUP_SIZE) > 0:
+        app.warmup = CacheWarmup(lambda model_name: demo_db.top_inputs(model_name, int(WARMUP_SIZE)),
+                                 _warm,
+                                 threshold=float(WARMUP_READY))
+
+    @contextmanager
+    def _admission(model_name: str):
+        """
+        Runs the body if the model's ``AdmissionController`` (if it has one) lets it,
+        and otherwise raises ``Overloaded``.
+        """
+        admission = app.admission.get(model_name)
+        if admission is None:
+            yield
+            return
+
+        try:
+            with admission.admit():
+                yield
+        except Overloaded:
+            shed.inc(model=model_name)
+            raise
+
+    @contextmanager
+    def _admitted(model_name: str):
+        """
+        Runs the body if the model's ``AdmissionController`` (if it has one) lets it,
+        and otherwise fails fast with a 503 telling the client when to try again.
         """
-        Just a wrapper around ``model.predict_json`` that allows us to use a cache decorator.
+        try:
+            with _admission(model_name):
+                yield
+        except Overloaded:
+            logger.warning("shedding request for %s: %s", model_name, app.admission[model_name].stats())
+            retry_after = MODELS[model_name].retry_after
+            raise ServerError("{} is overloaded, please try again later".format(model_name),
+                              status_code=503,
+                              headers={"Retry-After": str(retry_after)})
+
+    def _admit_and_predict(model_name: str, batcher: PredictionBatcher, data: JsonDict) -> JsonDict:
+        with _admitted(model_name):
+            return batcher.predict_json(data)
+
+    def _predict_by_sentence(model_name: str,
+                             batcher: PredictionBatcher,
+                             data: JsonDict,
+                             variant: str = FULL) -> Optional[JsonDict]:
+        """
+        For models that can ``merge_sentences``, predicts an input of several sentences a sentence
+        at a time, reusing the cached predictions for any sentences seen before and predicting the rest
+        together in one batch. Returns ``None`` if the input can't (or needn't) be split up.
         """
-        return model.predict_json(json.loads(data))
+        demo_model = MODELS.get(model_name)
+        if demo_model is None or demo_model.merge_sentences is None:
+            return None
+        text = data.get("sentence") if isinstance(data, dict) else None
+        if not isinstance(text, str) or set(data) != {"sentence"}:
+            return None
+        sentences = split_sentences(text)
+        if len(sentences) < 2:
+            return None
+
+        # The whole, untrimmed prediction for each sentence, whatever fields the request asked for.
+        version = demo_model.version + ("" if variant == FULL else "|" + variant) + "|sentence"
+        keys = [cache_key(model_name, version, {"sentence": sentence}) for sentence in sentences]
+        predictions: List[Optional[JsonDict]] = []
+        for key in keys:
+            cached = cache.get(key)
+            predictions.append(decode_json(cached) if cached is not None else None)
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        cache_lookups.inc(model=model_name, result="sentence_hit", amount=len(sentences) - len(missing))
+        cache_lookups.inc(model=model_name, result="sentence_miss", amount=len(missing))
+
+        if missing:
+            with _admitted(model_name):
+                made = batcher.predict_batch_json([{"sentence": sentences[i]} for i in missing])
+            for i, prediction in zip(missing, made):
+                predictions[i] = prediction
+                cache.put(keys[i], encode_json(prediction))
+
+        return demo_model.merge_sentences(predictions)
 
     @app.route('/')
     def index() -> Response: # pylint: disable=unused-variable
-        return send_file(os.path.join(build_dir, 'index.html'))
+        return static_files.response('index.html', request)
 
-    @app.route('/permadata', methods=['POST', 'OPTIONS'])
-    def permadata() -> Response:  # pylint: disable=unused-variable
+    def _permadata_response(slug: str) -> Response:
         """
-        If the user requests a permalink, the front end will POST here with the payload
-            { slug: slug }
-        which we convert to an integer id and use to retrieve saved results from the database.
+        Looks up the saved results for the given permalink slug, going to the database only
+        if they're not already in the cache. Permalinks never change once they've been written,
+        so the response can be cached indefinitely by anyone.
         """
-        # This is just CORS boilerplate.
-        if request.method == "OPTIONS":
-            return Response(response="", status=200)
-
         # If we don't have a database configured, there are no permalinks.
         if demo_db is None:
             raise ServerError('Permalinks are not enabled', 400)
 
         # Convert the provided slug to an integer id.
-        slug = request.get_json()["slug"]
         perma_id = slug_to_int(slug)
         if perma_id is None:
             # Malformed slug
             raise ServerError("Unrecognized permalink: {}".format(slug), 400)
 
-        # Fetch the results from the database.
-        try:
-            permadata = demo_db.get_result(perma_id)
-        except psycopg2.Error:
-            logger.exception("Unable to get results from database: perma_id %s", perma_id)
-            raise ServerError('Database trouble', 500)
+        key = "permadata:{}".format(perma_id)
+        body = cache.get(key) if cache is not None else None
 
-        if permadata is None:
-            # No data found, invalid id?
-            raise ServerError("Unrecognized permalink: {}".format(slug), 400)
+        if body is None:
+            # Fetch the results from the database.
+            try:
+                with db_seconds.time(operation="get_result"):
+                    permadata = demo_db.get_result(perma_id)
+            except psycopg2.Error:
+                logger.exception("Unable to get results from database: perma_id %s", perma_id)
+                raise ServerError('Database trouble', 500)
+
+            if permadata is None:
+                # No data found, invalid id?
+                raise ServerError("Unrecognized permalink: {}".format(slug), 400)
+
+            body = encode_json({
+                    "modelName": permadata.model_name,
+                    "requestData": permadata.request_data,
+                    "responseData": permadata.response_data
+            })
+            if cache is not None:
+                cache.put(key, body)
+
+        response = _encoded_response(None, body, key, use_cache=cache is not None)
+        response.headers["Cache-Control"] = "public, max-age={}, immutable".format(PERMADATA_MAX_AGE)
+        return response.make_conditional(request)
 
-        return jsonify({
-                "modelName": permadata.model_name,
-                "requestData": permadata.request_data,
-                "responseData": permadata.response_data
-        })
+    @app.route('/permadata', methods=['POST', 'OPTIONS'])
+    def permadata() -> Response:  # pylint: disable=unused-variable
+        """
+        If the user requests a permalink, the front end will POST here with the payload
+            { slug: slug }
+        which we convert to an integer id and use to retrieve saved results from the database.
+        """
+        # This is just CORS boilerplate.
+        if request.method == "OPTIONS":
+            return Response(response="", status=200)
+
+        return _permadata_response(request.get_json()["slug"])
+
+    @app.route('/permadata/<slug>')
+    def permadata_by_slug(slug: str) -> Response:  # pylint: disable=unused-variable
+        """
+        The same as ``permadata``, but as a GET, so that browsers and proxies can cache the results.
+        """
+        return _permadata_response(slug)
 
     @app.route('/predict/<model_name>', methods=['POST', 'OPTIONS'])
     def predict(model_name: str) -> Response:  # pylint: disable=unused-variable
@@ -163,82 +540,331 @@ def make_app(build_dir: str = None, demo_db: Optional[DemoDatabase] = None) -> F
         # Do use the cache if no argument is specified
         use_cache = request.args.get("cache", "true").lower() != "false"
 
-        model = app.predictors.get(model_name.lower())
-        if model is None:
-            raise ServerError("unknown model: {}".format(model_name), status_code=400)
-
-        data = request.get_json()
-
-        log_blob = {"model": model_name, "inputs": data, "cached": False, "outputs": {}}
+        variant = _variant(model_name.lower(), request.args.get("variant"))
+        batcher = _batcher(model_name.lower(), _predictor(model_name, variant), variant)
 
-        # Record the number of cache hits before we hit the cache so we can tell whether we hit or not.
-        # In theory this could result in false positives.
-        pre_hits = _caching_prediction.cache_info().hits  # pylint: disable=no-value-for-parameter
-
-        if use_cache and cache_size > 0:
-            # lru_cache insists that all function arguments be hashable,
-            # so unfortunately we have to stringify the data.
-            prediction = _caching_prediction(model, json.dumps(data))
+        in_flight.inc(model=model_name.lower())
+        try:
+            with prediction_seconds.time(model=model_name.lower()):
+                return _predict(model_name, batcher, record_to_database, use_cache, variant)
+        finally:
+            in_flight.dec(model=model_name.lower())
+
+    def _predict(model_name: str,
+                 batcher: PredictionBatcher,
+                 record_to_database: bool,
+                 use_cache: bool,
+                 variant: str = FULL) -> Response:
+        def stage(name: str):
+            return stage_seconds.time(model=model_name.lower(), stage=name)
+
+        with stage("parse"):
+            data = request.get_json()
+
+        log_blob = {"model": model_name, "variant": variant, "inputs": data, "cached": False, "outputs": {}}
+
+        # If there's no cache, skip caching altogether
+        use_cache = use_cache and cache is not None
+        will_record = record_to_database and demo_db is not None
+        cached = None
+
+        fields = _fields(model_name.lower(), request.args.get("fields"))
+        # This identifies the prediction in the cache, in the database and among those in flight.
+        key = _key(model_name.lower(), data, fields, variant)
+
+        # Predictions are POSTs, which (RFC 7232) can't be answered with a 304, so If-None-Match is ignored.
+        if use_cache:
+            with stage("cache"):
+                cached = cache.get(key)
+            cache_lookups.inc(model=model_name.lower(), result="hit" if cached is not None else "miss")
+
+        if cached is not None:
+            # The cache holds the encoded response body, which we can send as-is.
+            log_blob["cached"] = True
+            body = cached
+            prediction = None
         else:
-            # if cache_size is 0, skip caching altogether
-            prediction = model.predict_json(data)
-
-        post_hits = _caching_prediction.cache_info().hits  # pylint: disable=no-value-for-parameter
-
-        if record_to_database and demo_db is not None:
+            def infer() -> Tuple[JsonDict, bytes]:
+                with stage("inference"):
+                    prediction = None
+                    if use_cache:
+                        prediction = _predict_by_sentence(model_name.lower(), batcher, data, variant)
+                    if prediction is None:
+                        prediction = _admit_and_predict(model_name.lower(), batcher, data)
+                    prediction = _project(prediction, fields)
+                with stage("serialize"):
+                    body = encode_json(prediction)
+                if use_cache:
+                    with stage("cache"):
+                        cache.put(key, body)
+                return prediction, body
+
+            # Requests for the same prediction that turn up while it's being made
+            # wait for it, rather than making it again (whether or not it's cached).
+            (prediction, body), shared = app.single_flight.do(key, infer)
+            if shared:
+                coalesced.inc(model=model_name.lower())
+                log_blob["coalesced"] = True
+
+        slug = None
+        if will_record:
             try:
-                perma_id = None
-                perma_id = demo_db.add_result(headers=dict(request.headers),
-                                              model_name=model_name,
-                                              inputs=data,
-                                              outputs=prediction)
+                if prediction is None:
+                    prediction = decode_json(body)
+                with stage("db"), db_seconds.time(operation="add_result"):
+                    perma_id = demo_db.add_result(headers=dict(request.headers),
+                                                  model_name=model_name,
+                                                  inputs=data,
+                                                  outputs=prediction,
+                                                  content_key=key)
                 if perma_id is not None:
                     slug = int_to_slug(perma_id)
-                    prediction["slug"] = slug
                     log_blob["slug"] = slug
 
             except Exception:  # pylint: disable=broad-except
                 # TODO(joelgrus): catch more specific errors
                 logger.exception("Unable to add result to database", exc_info=True)
 
-        if use_cache and post_hits > pre_hits:
+        if cached is not None and cache_hit_delay > 0:
             # Cache hit, so insert an artifical pause
-            log_blob["cached"] = True
-            time.sleep(0.25)
-
-        # The model predictions are extremely verbose, so we only log the most human-readable
-        # parts of them.
-        if model_name == "machine-comprehension":
-            log_blob["outputs"]["best_span_str"] = prediction["best_span_str"]
-        elif model_name == "coreference-resolution":
-            log_blob["outputs"]["clusters"] = prediction["clusters"]
-            log_blob["outputs"]["document"] = prediction["document"]
-        elif model_name == "textual-entailment":
-            log_blob["outputs"]["label_probs"] = prediction["label_probs"]
-        elif model_name == "named-entity-recognition":
-            log_blob["outputs"]["tags"] = prediction["tags"]
-        elif model_name == "semantic-role-labeling":
-            verbs = []
-            for verb in prediction["verbs"]:
-                # Don't want to log boring verbs with no semantic parses.
-                good_tags = [tag for tag in verb["tags"] if tag != "0"]
-                if len(good_tags) > 1:
-                    verbs.append({"verb": verb["verb"], "description": verb["description"]})
-            log_blob["outputs"]["verbs"] = verbs
-
-        elif model_name == "constituency-parsing":
-            log_blob["outputs"]["trees"] = prediction["trees"]
-
-        logger.info("prediction: %s", json.dumps(log_blob))
-
-        print(log_blob)
-
-        return jsonify(prediction)
+            time.sleep(cache_hit_delay)
+
+        # The outputs were already logged when a cached prediction was first made.
+        if cached is None:
+            demo_model = MODELS.get(model_name.lower())
+            if demo_model is not None and demo_model.log_outputs is not None:
+                log_blob["outputs"] = demo_model.log_outputs(prediction)
+        app.prediction_log.log(log_blob)
+
+        with stage("serialize"):
+            if slug is not None:
+                body = _add_slug(body, slug)
+                return _encoded_response(model_name.lower(), body)
+            return _encoded_response(model_name.lower(), body, key, use_cache)
+
+    def _encoded_response(model_name: Optional[str],
+                          body: bytes,
+                          key: Optional[str] = None,
+                          use_cache: bool = False) -> Response:
+        """
+        Returns ``body`` (which is JSON) in the representation the client asks for,
+        compressed if it's big enough for that to be worth it. If ``key`` is given, it determines
+        the response entirely, so the response gets an ETag and (if ``use_cache``) the encoded
+        representation is cached, so that it isn't compressed afresh for every hit.
+        """
+        demo_model = MODELS.get(model_name) if model_name is not None else None
+        min_bytes = demo_model.compress_min_bytes if demo_model else COMPRESS_MIN_BYTES
+        level = demo_model.compress_level if demo_model else COMPRESS_LEVEL
+
+        mimetype, content_encoding = negotiate(request)
+        if len(body) < min_bytes:
+            content_encoding = None
+
+        name = representation(mimetype, content_encoding)
+        variant_key = "{}:{}".format(key, name) if key is not None and use_cache and name != "json" else None
+
+        encoded = cache.get(variant_key) if variant_key is not None else None
+        if encoded is None:
+            encoded = to_msgpack(body) if mimetype == MSGPACK else body
+            if content_encoding is not None:
+                encoded = compress(encoded, content_encoding, level)
+            if variant_key is not None:
+                cache.put(variant_key, encoded)
+
+        response = Response(encoded, mimetype=mimetype)
+        response.vary.update(("Accept", "Accept-Encoding"))
+        if content_encoding is not None:
+            response.headers["Content-Encoding"] = content_encoding
+        if key is not None:
+            response.set_etag(_etag(key, mimetype, content_encoding))
+        return response
+
+    @app.route('/predict_batch/<model_name>', methods=['POST', 'OPTIONS'])
+    def predict_batch(model_name: str) -> Response:  # pylint: disable=unused-variable
+        """
+        make predictions for many inputs at once using the specified model. The inputs are either
+        a JSON list or newline-delimited JSON (with content type ``application/x-ndjson``), and the
+        results are streamed back as newline-delimited JSON, one line per input, in order, as each
+        batch of ``batch_size`` inputs finishes
+        """
+        if request.method == "OPTIONS":
+            return Response(response="", status=200)
+
+        # Unlike single predictions, don't log unless asked to
+        record_to_database = request.args.get("record", "false").lower() == "true"
+
+        # Do use the cache if no argument is specified
+        use_cache = request.args.get("cache", "true").lower() != "false"
+
+        try:
+            batch_size = int(request.args.get("batch_size") or DEFAULT_BATCH_SIZE)
+        except ValueError:
+            raise ServerError("batch_size must be an integer", status_code=400)
+        if not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ServerError("batch_size must be between 1 and {}".format(MAX_BATCH_SIZE), status_code=400)
+
+        variant = _variant(model_name.lower(), request.args.get("variant"))
+        model = _predictor(model_name, variant)
+
+        if request.mimetype == "application/x-ndjson":
+            inputs: Iterable[JsonDict] = _read_ndjson(request.stream)
+        else:
+            inputs = request.get_json()
+            if not isinstance(inputs, list):
+                raise ServerError("expected a list of inputs", status_code=400)
+
+        def generate() -> Iterator[bytes]:
+            count = 0
+            for batch in _batches(inputs, batch_size):
+                for body in _predict_many(model_name, model, batch, record_to_database, use_cache, variant):
+                    yield body + b"\n"
+                count += len(batch)
+            logger.info("batch prediction: %s", json.dumps({"model": model_name, "count": count}))
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+    def _predict_many(model_name: str,
+                      model: Predictor,
+                      batch: List[JsonDict],
+                      record_to_database: bool,
+                      use_cache: bool,
+                      variant: str = FULL) -> List[bytes]:
+        """
+        Returns the encoded predictions for a batch of inputs, running the ones that aren't
+        cached through the predictor together. An input that can't be predicted gets an error
+        object in its place, so that one bad input doesn't take down the rest of the stream.
+        """
+        def stage(name: str):
+            return stage_seconds.time(model=model_name.lower(), stage=name)
+
+        use_cache = use_cache and cache is not None
+        will_record = record_to_database and demo_db is not None
+        fields = _fields(model_name.lower(), request.args.get("fields"))
+        keys = [_key(model_name.lower(), data, fields, variant) if isinstance(data, dict) else None
+                for data in batch]
+
+        bodies: List[Optional[bytes]] = [None] * len(batch)
+        errors = {i: "input must be a JSON object" for i, key in enumerate(keys) if key is None}
+        if use_cache:
+            with stage("cache"):
+                for i, key in enumerate(keys):
+                    if key is not None:
+                        bodies[i] = cache.get(key)
+                        cache_lookups.inc(model=model_name.lower(),
+                                          result="hit" if bodies[i] is not None else "miss")
+
+        misses = [i for i, body in enumerate(bodies) if body is None and i not in errors]
+        predictions: Dict[int, JsonDict] = {}
+
+        # Inputs that are already being predicted (for another request, or earlier in this batch)
+        # are waited for rather than predicted again.
+        flights = {i: app.single_flight.claim(keys[i]) for i in misses}
+        leading = [i for i in misses if flights[i][1]]
+        unfinished = set(leading)
+        try:
+            if leading:
+                with stage("inference"):
+                    results = _predict_or_explain(model_name, model, [batch[i] for i in leading])
+                with stage("serialize"):
+                    for i, (prediction, error) in zip(leading, results):
+                        unfinished.remove(i)
+                        if error is not None:
+                            errors[i] = error
+                            app.single_flight.fail(keys[i], RuntimeError(error))
+                            continue
+                        predictions[i] = _project(prediction, fields)
+                        bodies[i] = encode_json(predictions[i])
+                        if use_cache:
+                            cache.put(keys[i], bodies[i])
+                        app.single_flight.resolve(keys[i], (predictions[i], bodies[i]))
+        finally:
+            for i in unfinished:
+                app.single_flight.fail(keys[i], RuntimeError("prediction abandoned"))
+
+        for i in misses:
+            if i not in flights or flights[i][1]:
+                continue
+            coalesced.inc(model=model_name.lower())
+            try:
+                predictions[i], bodies[i] = flights[i][0].wait()
+            except Exception as error:  # pylint: disable=broad-except
+                errors[i] = str(error)
+
+        for i, error in errors.items():
+            bodies[i] = json.dumps({"error": error}).encode('utf-8')
+
+        if will_record:
+            for i, body in enumerate(bodies):
+                if i in errors:
+                    continue
+                try:
+                    prediction = predictions.get(i) or decode_json(body)
+                    with stage("db"), db_seconds.time(operation="add_result"):
+                        perma_id = demo_db.add_result(headers=dict(request.headers),
+                                                      model_name=model_name,
+                                                      inputs=batch[i],
+                                                      outputs=prediction,
+                                                      content_key=keys[i])
+                    if perma_id is not None:
+                        bodies[i] = _add_slug(body, int_to_slug(perma_id))
+                except Exception:  # pylint: disable=broad-except
+                    # As in ``_predict``, the prediction is still sent, just without a permalink.
+                    logger.exception("Unable to add result to database", exc_info=True)
+
+        return bodies
+
+    def _predict_or_explain(model_name: str,
+                            model: Predictor,
+                            batch: List[JsonDict]) -> List[Tuple[Optional[JsonDict], Optional[str]]]:
+        """
+        Runs the batch through the predictor, falling back to one input at a time if that fails.
+        Returns a ``(prediction, error)`` pair for each input, exactly one of which is ``None``.
+        """
+        overloaded = "{} is overloaded".format(model_name)
+        try:
+            with _admission(model_name.lower()):
+                preprocess_batch(model, batch)
+                return [(prediction, None) for prediction in model.predict_batch_json(batch)]
+        except Overloaded:
+            return [(None, overloaded)] * len(batch)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("batch of %s failed, retrying individually", len(batch))
+
+        # Each retry has to be admitted too, or a failing batch would get round the model's limits.
+        results: List[Tuple[Optional[JsonDict], Optional[str]]] = []
+        for data in batch:
+            try:
+                with _admission(model_name.lower()):
+                    results.append((model.predict_json(data), None))
+            except Overloaded:
+                results.append((None, overloaded))
+            except Exception as error:  # pylint: disable=broad-except
+                results.append((None, repr(error)))
+        return results
 
     @app.route('/models')
     def list_models() -> Response:  # pylint: disable=unused-variable
         """list the available models"""
-        return jsonify({"models": list(app.predictors.keys())})
+        models = list(app.predictors.keys())
+        if app.loader is not None:
+            models.extend(name for name in app.loader.models if name not in app.predictors)
+        return jsonify({"models": models})
+
+    @app.route('/ready')
+    def ready() -> Response:  # pylint: disable=unused-variable
+        """report whether every model is ready to serve, so deploys know when to send traffic"""
+        is_ready = ((app.loader is None or app.loader.ready()) and
+                    (app.warmup is None or app.warmup.ready()))
+        response = jsonify({"ready": is_ready,
+                            "models": app.loader.info() if app.loader is not None else None,
+                            "warmup": app.warmup.stats() if app.warmup is not None else None})
+        response.status_code = 200 if is_ready else 503
+        return response
+
+    @app.route('/metrics')
+    def metrics() -> Response:  # pylint: disable=unused-variable
+        """report runtime metrics in the Prometheus text format"""
+        return Response(app.metrics.render(), mimetype="text/plain; version=0.0.4")
 
     @app.route('/info')
     def info() -> Response:  # pylint: disable=unused-variable
@@ -250,6 +876,19 @@ def make_app(build_dir: str = None, demo_db: Optional[DemoDatabase] = None) -> F
                 "uptime": uptime,
                 "git_version": git_version,
                 "peak_memory_mb": peak_memory_mb(),
+                "memory_sharing": memory_sharing(),
+                "batch_sizes": {name: batcher.batch_size_distribution()
+                                for name, batcher in app.batchers.items()},
+                "admission": {name: admission.stats() for name, admission in app.admission.items()},
+                "single_flight": app.single_flight.stats(),
+                "cache": cache.stats() if cache is not None else None,
+                "database": demo_db.stats() if demo_db is not None else None,
+                "prediction_log": app.prediction_log.stats(),
+                "preprocessing": DOCUMENTS.stats(),
+                "encoders": encoders(),
+                "warmup": app.warmup.stats() if app.warmup is not None else None,
+                "models": app.loader.info() if app.loader is not None else None,
+                "quantized": sorted(app.quantized),
                 "githubUrl": "http://github.com/allenai/allennlp/commit/" + git_version})
 
     # As a SPA, we need to return index.html for /model-name and /model-name/permalink
@@ -267,17 +906,103 @@ def make_app(build_dir: str = None, demo_db: Optional[DemoDatabase] = None) -> F
     @app.route('/named-entity-recognition/<permalink>')
     def return_page(permalink: str = None) -> Response:  # pylint: disable=unused-argument, unused-variable
         """return the page"""
-        return send_file(os.path.join(build_dir, 'index.html'))
+        return static_files.response('index.html', request)
 
     @app.route('/<path:path>')
     def static_proxy(path: str) -> Response: # pylint: disable=unused-variable
-        return send_from_directory(build_dir, path)
+        return static_files.response(path, request)
 
     @app.route('/static/js/<path:path>')
     def static_js_proxy(path: str) -> Response: # pylint: disable=unused-variable
-        return send_from_directory(os.path.join(build_dir, 'static/js'), path)
+        return static_files.response('static/js/' + path, request)
 
     return app
 
+def _read_ndjson(stream) -> Iterator[JsonDict]:
+    """
+    Lazily parses newline-delimited JSON, skipping blank lines. A line that isn't valid JSON
+    comes out as ``None``, so that it gets an error in its place rather than ending the stream.
+    """
+    for line in stream:
+        if line.strip():
+            try:
+                yield json.loads(line.decode('utf-8'))
+            except ValueError:
+                yield None
+
+def _batches(inputs: Iterable[JsonDict], batch_size: int) -> Iterator[List[JsonDict]]:
+    batch: List[JsonDict] = []
+    for data in inputs:
+        batch.append(data)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _project(prediction: JsonDict, fields: Optional[FrozenSet[str]]) -> JsonDict:
+    if fields is None:
+        return prediction
+    return {name: value for name, value in prediction.items() if name in fields}
+
+def _etag(key: str, mimetype: str, content_encoding: Optional[str]) -> str:
+    """
+    Each representation of a result needs an ETag of its own.
+    """
+    return "{}-{}".format(key, representation(mimetype, content_encoding))
+
+def _add_slug(body: bytes, slug: str) -> bytes:
+    """
+    Adds the permalink slug to an encoded prediction, without decoding it unless it might
+    already have a ``slug`` (which mustn't end up in it twice).
+    """
+    if b'"slug"' in body:
+        prediction = decode_json(body)
+        prediction["slug"] = slug
+        return encode_json(prediction)
+
+    entry = json.dumps({"slug": slug}).encode('utf-8')[1:-1]
+    body = body.rstrip()[:-1].rstrip()
+    if body == b'{':
+        return body + entry + b'}'
+    return body + b', ' + entry + b'}'
+
+def _cache_from_environment() -> Optional[PredictionCache]:
+    """
+    Builds the prediction cache described by the ``FLASK_CACHE_*`` environment variables,
+    or returns ``None`` if caching is disabled.
+    """
+    if CACHE_MB is None and CACHE_SIZE is not None:
+        try:
+            max_bytes = int(CACHE_SIZE) * CACHE_ENTRY_KB * 1024
+        except ValueError:
+            logger.warning("unable to parse cache size %s as int, disabling cache", CACHE_SIZE)
+            max_bytes = 0
+        if max_bytes > 0:
+            logger.warning("FLASK_CACHE_SIZE (%s predictions) is deprecated, treating it as %.1f MB; "
+                           "set FLASK_CACHE_MB instead", CACHE_SIZE, max_bytes / 1024 / 1024)
+    else:
+        try:
+            max_bytes = int(float(CACHE_MB or 128) * 1024 * 1024)
+        except ValueError:
+            logger.warning("unable to parse cache size %s as a number, disabling cache", CACHE_MB)
+            max_bytes = 0
+
+    try:
+        ttl = float(CACHE_TTL) if CACHE_TTL else None
+    except ValueError:
+        logger.warning("unable to parse cache ttl %s as a number, ignoring it", CACHE_TTL)
+        ttl = None
+
+    if max_bytes <= 0:
+        return None
+    elif CACHE_BACKEND == "sqlite":
+        return SqlitePredictionCache(CACHE_PATH, max_bytes=max_bytes, ttl=ttl)
+    elif CACHE_BACKEND == "memory":
+        return InMemoryPredictionCache(max_bytes=max_bytes, ttl=ttl)
+    else:
+        logger.warning("unknown cache backend %s, disabling cache", CACHE_BACKEND)
+        return None
+
 if __name__ == "__main__":
     main()
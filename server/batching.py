@@ -0,0 +1,132 @@
+"""
+Dynamic micro-batching for predictors.
+"""
+from collections import Counter
+from typing import Dict, List, Optional
+import logging
+import threading
+import time
+
+from allennlp.common.util import JsonDict
+from allennlp.service.predictors import Predictor
+
+from server.preprocessing import preprocess_batch
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class _PendingPrediction:
+    """
+    A single caller's inputs, waiting to be run as part of a batch.
+    """
+    def __init__(self, inputs: JsonDict) -> None:
+        self.inputs = inputs
+        self.result: Optional[JsonDict] = None
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class PredictionBatcher:
+    """
+    Collects concurrent ``predict_json`` calls for a single model and runs them through the
+    predictor's ``predict_batch_json`` as one padded batch, handing each result back to its caller.
+
+    A batch is dispatched as soon as ``max_batch_size`` requests are waiting, or ``batch_window_ms``
+    milliseconds after the first of them arrived, whichever comes first. With a ``max_batch_size``
+    of 1 every call goes straight to the predictor.
+    """
+    def __init__(self,
+                 predictor: Predictor,
+                 max_batch_size: int = 1,
+                 batch_window_ms: float = 0.0) -> None:
+        self.predictor = predictor
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_window = max(0.0, batch_window_ms) / 1000
+
+        # Maps batch size -> number of batches of that size that have been run.
+        self.batch_sizes: Counter = Counter()
+
+        self._queue: List[_PendingPrediction] = []
+        self._condition = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+
+    def predict_json(self, inputs: JsonDict) -> JsonDict:
+        if self.max_batch_size == 1:
+            with self._condition:
+                self.batch_sizes[1] += 1
+            return self.predictor.predict_json(inputs)
+
+        pending = _PendingPrediction(inputs)
+        with self._condition:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+            self._queue.append(pending)
+            self._condition.notify()
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def predict_batch_json(self, inputs: List[JsonDict]) -> List[JsonDict]:
+        """
+        Runs a batch that's already been collected straight through the predictor.
+        """
+        preprocess_batch(self.predictor, inputs)
+        return self.predictor.predict_batch_json(inputs)
+
+    def batch_size_distribution(self) -> Dict[str, int]:
+        """
+        Returns the number of batches run at each batch size, keyed by the (stringified) size.
+        """
+        with self._condition:
+            return {str(size): count for size, count in sorted(self.batch_sizes.items())}
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+
+                # Give other requests a chance to join the batch.
+                deadline = time.monotonic() + self.batch_window
+                while len(self._queue) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                batch = self._queue[:self.max_batch_size]
+                del self._queue[:self.max_batch_size]
+                self.batch_sizes[len(batch)] += 1
+
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: List[_PendingPrediction]) -> None:
+        if len(batch) == 1:
+            pending = batch[0]
+            try:
+                pending.result = self.predictor.predict_json(pending.inputs)
+            except Exception as error:  # pylint: disable=broad-except
+                pending.error = error
+            pending.done.set()
+            return
+
+        try:
+            results = self.predict_batch_json([pending.inputs for pending in batch])
+        except Exception:  # pylint: disable=broad-except
+            # One bad input shouldn't fail everyone else's request,
+            # so rerun the batch one input at a time.
+            logger.exception("batch of %s failed, retrying individually", len(batch))
+            for pending in batch:
+                try:
+                    pending.result = self.predictor.predict_json(pending.inputs)
+                except Exception as error:  # pylint: disable=broad-except
+                    pending.error = error
+                pending.done.set()
+            return
+
+        for pending, result in zip(batch, results):
+            pending.result = result
+            pending.done.set()
@@ -0,0 +1,343 @@
+"""
+Caches for serialized predictions.
+"""
+from collections import OrderedDict
+from typing import IO, Any, Callable, List, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+from gevent import get_hub, monkey
+
+from allennlp.common.util import JsonDict
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# A saved cache is this header, followed by each entry (from least to most recently used) as the lengths
+# of its key and value and the time it was cached, then the key (in UTF-8) and the value themselves.
+SNAPSHOT_HEADER = b"allennlp-demo cache snapshot 1\n"
+_SNAPSHOT_ENTRY = struct.Struct(">IId")
+
+
+def canonical_json(data: Any) -> str:
+    """
+    Serializes ``data`` so that equal values always produce the same string,
+    regardless of key order or whitespace.
+    """
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+def cache_key(model_name: str, model_version: str, inputs: JsonDict) -> str:
+    """
+    The key under which the prediction of the given model (at the given version) is cached.
+    """
+    content = "\0".join([model_name, model_version, canonical_json(inputs)])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    """
+    This class represents a cache of serialized predictions, keyed by ``cache_key``.
+    Implementations are bounded by the total size of the values they hold.
+    """
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Returns the cached value for the given key, or ``None`` if there isn't one.
+        """
+        raise NotImplementedError
+
+    def put(self, key: str, value: bytes) -> None:
+        """
+        Caches the value under the given key, evicting older entries if necessary.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> JsonDict:
+        """
+        Returns counters describing the contents and effectiveness of the cache.
+        """
+        raise NotImplementedError
+
+    def save(self, path: str) -> None:
+        """
+        Writes the contents of the cache to ``path``, so that a restarted server can ``load``
+        them rather than starting out empty. Caches that persist by themselves needn't bother.
+        """
+        pass
+
+    def load(self, path: str) -> int:
+        """
+        Adds the entries saved at ``path`` (if it exists) to the cache,
+        and returns how many there were.
+        """
+        return 0
+
+
+class InMemoryPredictionCache(PredictionCache):
+    """
+    A least-recently-used cache private to the current process.
+    Entries older than ``ttl`` seconds (if given) are treated as missing.
+    """
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Maps key -> (value, time cached), from least to most recently used.
+        self._entries: 'OrderedDict[str, Tuple[bytes, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, value: bytes) -> None:
+        self._put(key, value, time.time())
+
+    def _put(self, key: str, value: bytes, created: float) -> None:
+        if len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, created)
+            self.num_bytes += len(value)
+
+            while self.num_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def stats(self) -> JsonDict:
+        with self._lock:
+            return {"backend": "memory",
+                    "entries": len(self._entries),
+                    "bytes": self.num_bytes,
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            entries = [(key, value, created) for key, (value, created) in self._entries.items()]
+
+        # Each process (e.g. each forked worker) writes a file of its own, and then replaces
+        # the snapshot with it all at once, so the snapshot is always one of them, complete.
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".")
+        try:
+            with os.fdopen(fd, "wb") as snapshot:
+                _write_snapshot(snapshot, entries)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        logger.info("saved %s cached predictions to %s", len(entries), path)
+
+    def load(self, path: str) -> int:
+        try:
+            with open(path, "rb") as snapshot:
+                entries = _read_snapshot(snapshot)
+        except FileNotFoundError:
+            return 0
+        except ValueError:
+            logger.exception("unable to read the cache snapshot at %s, starting empty", path)
+            return 0
+
+        # From least to most recently used, so they keep their order.
+        for key, value, created in entries:
+            if self.ttl is None or time.time() - created <= self.ttl:
+                self._put(key, value, created)
+        logger.info("loaded %s cached predictions from %s", len(entries), path)
+        return len(entries)
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self.num_bytes -= len(value)
+
+
+def _write_snapshot(snapshot: IO[bytes], entries: List[Tuple[str, bytes, float]]) -> None:
+    snapshot.write(SNAPSHOT_HEADER)
+    for key, value, created in entries:
+        encoded_key = key.encode('utf-8')
+        snapshot.write(_SNAPSHOT_ENTRY.pack(len(encoded_key), len(value), created))
+        snapshot.write(encoded_key)
+        snapshot.write(value)
+
+def _read_snapshot(snapshot: IO[bytes]) -> List[Tuple[str, bytes, float]]:
+    """
+    Reads the entries written by ``_write_snapshot``, raising a ``ValueError``
+    if that's not what ``snapshot`` holds (or not all of it).
+    """
+    if snapshot.read(len(SNAPSHOT_HEADER)) != SNAPSHOT_HEADER:
+        raise ValueError("not a cache snapshot")
+
+    entries = []
+    while True:
+        header = snapshot.read(_SNAPSHOT_ENTRY.size)
+        if not header:
+            return entries
+        if len(header) < _SNAPSHOT_ENTRY.size:
+            raise ValueError("truncated cache snapshot")
+        key_length, value_length, created = _SNAPSHOT_ENTRY.unpack(header)
+        key = snapshot.read(key_length)
+        value = snapshot.read(value_length)
+        if len(key) < key_length or len(value) < value_length:
+            raise ValueError("truncated cache snapshot")
+        entries.append((key.decode('utf-8'), value, created))
+
+
+# SQL for setting up the on-disk cache. The total size of the entries is kept up to date by triggers,
+# so that every process sharing the file sees the same total without adding it all up on every write.
+CREATE_CACHE_SQL = (
+        """
+        BEGIN IMMEDIATE;
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+        CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+        CREATE TABLE IF NOT EXISTS totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            bytes INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO totals VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM entries));
+        CREATE TRIGGER IF NOT EXISTS entries_inserted AFTER INSERT ON entries
+        BEGIN
+            UPDATE totals SET bytes = bytes + NEW.size WHERE id = 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_deleted AFTER DELETE ON entries
+        BEGIN
+            UPDATE totals SET bytes = bytes - OLD.size WHERE id = 0;
+        END;
+        COMMIT;
+        """
+)
+
+def _off_the_event_loop(function: Callable, *args: Any) -> Any:
+    """
+    Runs ``function`` on gevent's threadpool, so that the event loop carries on serving other requests
+    while SQLite reads and writes the disk (which, unlike a socket, it can't do cooperatively).
+    Without monkey patching (e.g. in the tests) there's no event loop to keep free.
+    """
+    if monkey.is_module_patched("threading"):
+        return get_hub().threadpool.apply(function, args)
+    return function(*args)
+
+class SqlitePredictionCache(PredictionCache):
+    """
+    A least-recently-used cache stored in a SQLite database on disk,
+    so that it survives restarts and can be shared by every server process on the host.
+    Entries older than ``ttl`` seconds (if given) are treated as missing.
+
+    The queries run on gevent's threadpool, rather than holding up the event loop.
+    """
+    def __init__(self, path: str, max_bytes: int, ttl: Optional[float] = None) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Only ever taken on the threadpool's (real) threads, so it mustn't be a gevent lock.
+        self._lock = monkey.get_original("_thread", "allocate_lock")()
+
+        logger.info("opening prediction cache at %s", path)
+        # Several processes share the file, so wait for their writes rather than failing.
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # So that replacing an entry fires the delete trigger for the old one.
+        self._conn.execute("PRAGMA recursive_triggers=ON")
+        self._conn.executescript(CREATE_CACHE_SQL)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return _off_the_event_loop(self._get, key)
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) <= self.max_bytes:
+            _off_the_event_loop(self._put, key, value)
+
+    def stats(self) -> JsonDict:
+        return _off_the_event_loop(self._stats)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT value, created FROM entries WHERE key = ?",
+                                         (key,)).fetchone()
+                if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                    self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    row = None
+
+                if row is None:
+                    self.misses += 1
+                    return None
+
+                self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                return bytes(row[0])
+            except sqlite3.Error:
+                logger.exception("unable to read from prediction cache")
+                self.misses += 1
+                return None
+
+    def _put(self, key: str, value: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                                   (key, value, len(value), now, now))
+                self._evict()
+            except sqlite3.Error:
+                logger.exception("unable to write to prediction cache")
+
+    def _stats(self) -> JsonDict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            return {"backend": "sqlite",
+                    "entries": entries,
+                    "bytes": self._num_bytes(),
+                    "max_bytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+    def _num_bytes(self) -> int:
+        return self._conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            self._conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl,))
+
+        num_bytes = self._num_bytes()
+        while num_bytes > self.max_bytes:
+            key, size = self._conn.execute(
+                    "SELECT key, size FROM entries ORDER BY accessed LIMIT 1").fetchone()
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            num_bytes -= size
+            self.evictions += 1
@@ -1,13 +1,21 @@
 """
 Database utilities for the service
 """
-from typing import Optional, List
+from typing import Callable, Deque, Dict, Iterator, Optional, List
+from collections import Counter, deque, OrderedDict
+from contextlib import contextmanager
+import atexit
 import json
 import datetime
 import logging
 import os
+import queue
+import threading
+import time
 
+from gevent.socket import wait_read, wait_write
 import psycopg2
+from psycopg2.extras import execute_values
 
 from allennlp.common.util import JsonDict
 
@@ -26,10 +34,15 @@ class DemoDatabase:
                    headers: JsonDict,
                    model_name: str,
                    inputs: JsonDict,
-                   outputs: JsonDict) -> Optional[int]:
+                   outputs: JsonDict,
+                   content_key: str = None) -> Optional[int]:
         """
         Add the prediction to the database so that it can later
         be retrieved via permalink.
+
+        ``content_key`` identifies the prediction by its model, model version and inputs.
+        If a prediction with the same key has already been added, its id is returned
+        instead of storing another copy.
         """
         raise NotImplementedError
 
@@ -40,6 +53,18 @@ class DemoDatabase:
         """
         raise NotImplementedError
 
+    def top_inputs(self, model_name: str, limit: int) -> List[JsonDict]:
+        """
+        Returns (up to) the ``limit`` inputs most often given to the model, most frequent first.
+        """
+        raise NotImplementedError
+
+    def stats(self) -> JsonDict:
+        """
+        Returns counters describing how the database is being used.
+        """
+        raise NotImplementedError
+
     @classmethod
     def from_environment(cls) -> Optional['DemoDatabase']:
         """
@@ -48,15 +73,182 @@ class DemoDatabase:
         raise NotImplementedError
 
 
-# SQL for inserting predictions into the database.
+def make_psycopg_green() -> None:
+    """
+    Makes ``psycopg2`` yield to other greenlets while it waits on the database,
+    instead of blocking the gevent event loop.
+    """
+    psycopg2.extensions.set_wait_callback(_gevent_wait_callback)
+
+def _gevent_wait_callback(conn: psycopg2.extensions.connection, timeout: float = None) -> None:
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            break
+        elif state == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: %r" % state)
+
+
+class _PooledConnection:
+    def __init__(self, conn: psycopg2.extensions.connection, number: int) -> None:
+        self.conn = conn
+        self.number = number
+        self.last_used = time.monotonic()
+        self.checkouts = 0
+        self.seconds_in_use = 0.0
+
+class ConnectionPool:
+    """
+    A bounded pool of database connections, opened with ``connect`` as they're needed.
+
+    Rather than pinging the database before every query, a connection is checked only when
+    it's checked out after sitting idle for more than ``check_after`` seconds, and is thrown
+    away (to be replaced by a fresh one) whenever it fails with a connection error.
+    """
+    def __init__(self,
+                 connect: Callable[[], psycopg2.extensions.connection],
+                 size: int,
+                 check_after: float = 30.0) -> None:
+        self.size = size
+        self.check_after = check_after
+        self._connect = connect
+        self._idle: List[_PooledConnection] = []
+        self._in_use: Dict[int, _PooledConnection] = {}
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._checkouts = 0
+        self._seconds_waiting = 0.0
+        self._max_seconds_waiting = 0.0
+
+    @contextmanager
+    def connection(self) -> Iterator[psycopg2.extensions.connection]:
+        start = time.monotonic()
+        self._slots.acquire()
+        waited = time.monotonic() - start
+
+        try:
+            with self._lock:
+                pooled = self._idle.pop() if self._idle else None
+                self._checkouts += 1
+                self._seconds_waiting += waited
+                self._max_seconds_waiting = max(self._max_seconds_waiting, waited)
+
+            if pooled is not None and time.monotonic() - pooled.last_used > self.check_after:
+                pooled = self._check(pooled)
+            if pooled is None:
+                pooled = self._open()
+
+            with self._lock:
+                pooled.checkouts += 1
+                self._in_use[pooled.number] = pooled
+            checked_out = time.monotonic()
+            try:
+                yield pooled.conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                # The connection may well be dead, so don't reuse it.
+                self._discard(pooled)
+                pooled = None
+                raise
+            finally:
+                if pooled is not None:
+                    pooled.last_used = time.monotonic()
+                    pooled.seconds_in_use += pooled.last_used - checked_out
+                    with self._lock:
+                        del self._in_use[pooled.number]
+                        self._idle.append(pooled)
+        finally:
+            self._slots.release()
+
+    def stats(self) -> JsonDict:
+        with self._lock:
+            connections = self._idle + list(self._in_use.values())
+            return {"size": self.size,
+                    "open": len(connections),
+                    "in_use": len(self._in_use),
+                    "checkouts": self._checkouts,
+                    "seconds_waiting": round(self._seconds_waiting, 6),
+                    "max_seconds_waiting": round(self._max_seconds_waiting, 6),
+                    "connections": [{"number": pooled.number,
+                                     "checkouts": pooled.checkouts,
+                                     "seconds_in_use": round(pooled.seconds_in_use, 6)}
+                                    for pooled in sorted(connections, key=lambda pooled: pooled.number)]}
+
+    def _open(self) -> _PooledConnection:
+        conn = self._connect()
+        with self._lock:
+            self._opened += 1
+            return _PooledConnection(conn, self._opened)
+
+    def _check(self, pooled: _PooledConnection) -> Optional[_PooledConnection]:
+        """
+        Postgres has no way of automatically reconnecting lost database
+        connections, so make sure an idle connection still works before handing it out.
+        """
+        try:
+            with pooled.conn.cursor() as curs:
+                # Run a simple query
+                curs.execute("""SELECT 1""")
+                curs.fetchone()
+            return pooled
+        except psycopg2.Error:
+            logger.warning("Database connection %s lost, reconnecting", pooled.number)
+            self._discard(pooled)
+            return None
+
+    def _discard(self, pooled: _PooledConnection) -> None:
+        with self._lock:
+            self._in_use.pop(pooled.number, None)
+        try:
+            pooled.conn.close()
+        except psycopg2.Error:
+            pass
+
+
+# SQL for checking that the ``queries`` table has been migrated (by ``scripts/migrate_db.py``)
+# to have the columns the server needs.
+CHECK_SCHEMA_SQL = (
+        """
+        SELECT content_hash, hits
+        FROM queries
+        LIMIT 0
+        """
+)
+
+# SQL for inserting predictions into the database. If a prediction with the same content hash
+# is already there, counts another hit for it instead, and returns its id.
 INSERT_SQL = (
         """
-        INSERT INTO queries (model_name, headers, request_data, response_data, timestamp)
-        VALUES (%(model_name)s, %(headers)s, %(request_data)s, %(response_data)s, %(timestamp)s)
+        INSERT INTO queries (model_name, headers, request_data, response_data, timestamp, content_hash)
+        VALUES (%(model_name)s, %(headers)s, %(request_data)s, %(response_data)s, %(timestamp)s,
+                %(content_hash)s)
+        ON CONFLICT (content_hash) DO UPDATE SET hits = queries.hits + 1
         RETURNING id
         """
 )
 
+# SQL for counting repeat requests for predictions that are already stored.
+ADD_HITS_SQL = (
+        """
+        UPDATE queries SET hits = queries.hits + data.hits
+        FROM (VALUES %s) AS data (id, hits)
+        WHERE queries.id = data.id
+        """
+)
+
+# SQL for finding an existing prediction by its content hash.
+FIND_BY_CONTENT_SQL = (
+        """
+        SELECT id
+        FROM queries
+        WHERE content_hash = (%s)
+        """
+)
+
 # SQL for retrieving a prediction from the database.
 RETRIEVE_SQL = (
         """
@@ -66,53 +258,148 @@ RETRIEVE_SQL = (
         """
 )
 
+# SQL for finding the inputs most often given to a model, among the most recent predictions.
+# Identical predictions are stored once (per model version) and count their repeats in ``hits``,
+# but rows made before that (or that raced with an identical one) are still stored separately,
+# so the hits are summed over every row with the same inputs. Ties go to the latest.
+TOP_INPUTS_SQL = (
+        """
+        SELECT request_data::text
+        FROM queries
+        WHERE model_name = %(model_name)s
+          AND id > (SELECT max(id) FROM queries) - %(window)s
+        GROUP BY request_data::text
+        ORDER BY sum(hits) DESC, max(id) DESC
+        LIMIT %(limit)s
+        """
+)
+
+# SQL for reserving ids for predictions that will be inserted later.
+RESERVE_IDS_SQL = (
+        """
+        SELECT nextval('queries_id_seq')
+        FROM generate_series(1, %s)
+        """
+)
+
+# SQL for inserting a batch of predictions whose ids have already been reserved.
+# Returns the ids of the rows that didn't clash with an existing content hash.
+INSERT_BATCH_SQL = (
+        """
+        INSERT INTO queries (id, model_name, headers, request_data, response_data, timestamp, content_hash,
+                             hits)
+        VALUES %s
+        ON CONFLICT (content_hash) DO NOTHING
+        RETURNING id
+        """
+)
+
+INSERT_BATCH_TEMPLATE = (
+        "(%(id)s, %(model_name)s, %(headers)s, %(request_data)s, %(response_data)s, %(timestamp)s, "
+        "%(content_hash)s, %(hits)s)"
+)
+
 class PostgresDemoDatabase(DemoDatabase):
     """
     Concrete Postgres implementation.
+
+    Queries run on connections from a pool of up to ``pool_size`` connections.
+
+    Predictions are deduplicated by their ``content_key``, which is stored in the ``content_hash``
+    column (added by ``scripts/migrate_db.py``). Only the first request for a prediction has its
+    headers stored. The ids of the most recent ``known_keys`` keys are remembered, so repeat
+    submissions usually don't touch the database. Repeats are still counted, in the row's ``hits``
+    column, which ``top_inputs`` ranks inputs by. The counts are kept in memory and added to the rows
+    ``batch_size`` repeats at a time (and by ``close``).
+
+    If ``write_behind`` is true, ``add_result`` doesn't wait for the database. It hands out
+    an id from a block reserved ahead of time from the ``queries`` id sequence, queues the row,
+    and returns. A background thread writes queued rows in multi-row batches of up to
+    ``batch_size``. If more than ``queue_size`` rows are waiting, callers block for up to
+    ``enqueue_timeout`` seconds and then insert their row themselves, so a slow database
+    slows predictions down rather than losing permalinks. Until a row is written, ``get_result``
+    answers from the queue, so a permalink works as soon as it's handed out. Queued rows are
+    flushed by ``close``, which runs automatically at exit.
+
+    ``top_inputs`` only looks at the latest ``top_inputs_window`` predictions,
+    so that it doesn't have to scan the whole table.
     """
-    def __init__(self, dbname: str, host: str, port: str, user: str, password: str) -> None:
+    def __init__(self,
+                 dbname: str,
+                 host: str,
+                 port: str,
+                 user: str,
+                 password: str,
+                 pool_size: int = 5,
+                 write_behind: bool = False,
+                 batch_size: int = 100,
+                 queue_size: int = 1000,
+                 enqueue_timeout: float = 1.0,
+                 reserve_size: int = 100,
+                 known_keys: int = 10000,
+                 top_inputs_window: int = 100000) -> None:
         self.dbname = dbname
         self.host = host
         self.port = port
         self.user = user
         self.password = password
-        self.conn: Optional[psycopg2.extensions.connection] = None
-        self._connect()
+        self.pool = ConnectionPool(self._connect, size=pool_size)
+
+        # Make sure we can actually connect, and that the table is set up for deduplication.
+        try:
+            with self.pool.connection() as conn, conn.cursor() as curs:
+                curs.execute(CHECK_SCHEMA_SQL)
+        except psycopg2.ProgrammingError:
+            logger.error("the queries table needs migrating, please run scripts/migrate_db.py")
+            raise
+
+        # Maps operation -> number of times it's failed.
+        self.errors: Counter = Counter()
+
+        self.known_keys = known_keys
+        self.top_inputs_window = top_inputs_window
+        # Maps content key -> perma_id, from least to most recently used.
+        self._known_ids: 'OrderedDict[str, int]' = OrderedDict()
+        self._known_lock = threading.Lock()
+        # Maps perma_id -> repeats not yet added to its row.
+        self._hits: Counter = Counter()
+        self._hits_lock = threading.Lock()
+
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.enqueue_timeout = enqueue_timeout
+        self.reserve_size = reserve_size
+        self._reserved_ids: Deque[int] = deque()
+        self._reserve_lock = threading.Lock()
+        self._pending: 'queue.Queue[Optional[Dict]]' = queue.Queue(maxsize=queue_size)
+        # Maps perma_id -> row, for the rows that have been handed out but not yet written.
+        self._unwritten: Dict[int, Dict] = {}
+        self._flusher: Optional[threading.Thread] = None
 
-    def _connect(self) -> None:
+        if write_behind:
+            self._flusher = threading.Thread(target=self._flush_forever, daemon=True)
+            self._flusher.start()
+        atexit.register(self.close)
+
+    def _connect(self) -> psycopg2.extensions.connection:
         logger.info("initializing database connection:")
         logger.info("host: %s", self.host)
         logger.info("port: %s", self.port)
         logger.info("dbname: %s", self.dbname)
         try:
-            self.conn = psycopg2.connect(host=self.host,
-                                         port=self.port,
-                                         user=self.user,
-                                         password=self.password,
-                                         dbname=self.dbname,
-                                         connect_timeout=5)
-            self.conn.set_session(autocommit=True)
+            conn = psycopg2.connect(host=self.host,
+                                    port=self.port,
+                                    user=self.user,
+                                    password=self.password,
+                                    dbname=self.dbname,
+                                    connect_timeout=5)
+            conn.set_session(autocommit=True)
             logger.info("successfully initialized database connection")
+            return conn
         except psycopg2.Error as error:
             logger.exception("unable to connect to database")
             raise error
 
-    def _health_check(self) -> None:
-        """
-        Postgres has no way of automatically reconnecting lost database
-        connections. Because our database load is pretty low, we can afford to do
-        a health check before each database request and (try to) reconnect if the
-        connection has been lost.
-        """
-        try:
-            with self.conn.cursor() as curs:
-                # Run a simple query
-                curs.execute("""SELECT 1""")
-                curs.fetchone()
-        except (psycopg2.Error, AttributeError):
-            logger.exception("Database connection lost, reconnecting")
-            self._connect()
-
     @classmethod
     def from_environment(cls) -> Optional['PostgresDemoDatabase']:
         host = os.environ.get("DEMO_POSTGRES_HOST")
@@ -120,11 +407,19 @@ class PostgresDemoDatabase(DemoDatabase):
         dbname = os.environ.get("DEMO_POSTGRES_DBNAME")
         user = os.environ.get("DEMO_POSTGRES_USER")
         password = os.environ.get("DEMO_POSTGRES_PASSWORD")
+        pool_size_str = os.environ.get("DEMO_POSTGRES_POOL_SIZE") or "5"
+        try:
+            pool_size = int(pool_size_str)
+        except ValueError:
+            logger.warning("unable to parse pool size %s as int, using 5 connections", pool_size_str)
+            pool_size = 5
+        write_behind = (os.environ.get("DEMO_POSTGRES_WRITE_BEHIND") or "false").lower() == "true"
 
         if all([host, port, dbname, user, password]):
             try:
                 logger.info("Initializing demo database connection using environment variables")
-                return PostgresDemoDatabase(dbname=dbname, host=host, port=port, user=user, password=password)
+                return PostgresDemoDatabase(dbname=dbname, host=host, port=port, user=user, password=password,
+                                            pool_size=pool_size, write_behind=write_behind)
             except psycopg2.Error:
                 logger.exception("unable to connect to database, permalinks not enabled")
                 return None
@@ -137,31 +432,215 @@ class PostgresDemoDatabase(DemoDatabase):
                    headers: JsonDict,
                    model_name: str,
                    inputs: JsonDict,
-                   outputs: JsonDict) -> Optional[int]:
+                   outputs: JsonDict,
+                   content_key: str = None) -> Optional[int]:
+        if content_key is not None:
+            perma_id = self._find(content_key)
+            if perma_id is not None:
+                self._count_hit(perma_id)
+                return perma_id
+
+        row = {'model_name'   : model_name,
+               'headers'      : json.dumps(headers),
+               'request_data' : json.dumps(inputs),
+               'response_data': json.dumps(outputs),
+               'timestamp'    : datetime.datetime.now(),
+               'content_hash' : content_key,
+               'hits'         : 1}
+
+        if not self.write_behind:
+            perma_id = self._insert(row)
+        else:
+            perma_id = self._enqueue(row)
+
+        if perma_id is not None and content_key is not None:
+            self._remember(content_key, perma_id)
+        return perma_id
+
+    def close(self) -> None:
+        """
+        Writes any queued predictions, and any uncounted hits, to the database.
+        """
+        self._write_hits()
+        if self._flusher is None or not self._flusher.is_alive():
+            return
+
+        logger.info("flushing %s queued predictions to the database", self._pending.qsize())
+        self._pending.put(None)
+        self._flusher.join()
+
+    def top_inputs(self, model_name: str, limit: int) -> List[JsonDict]:
         try:
-            self._health_check()
-            with self.conn.cursor() as curs:
-                logger.info("inserting into the database")
+            with self.pool.connection() as conn, conn.cursor() as curs:
+                curs.execute(TOP_INPUTS_SQL, {'model_name': model_name,
+                                              'window': self.top_inputs_window,
+                                              'limit': limit})
+                return [json.loads(row[0]) for row in curs.fetchall()]
+        except psycopg2.Error:
+            logger.exception("Unable to find top inputs for %s", model_name)
+            self.errors["top_inputs"] += 1
+            return []
+
+    def stats(self) -> JsonDict:
+        return {"pool": self.pool.stats(),
+                "write_behind_queue": self._pending.qsize() if self.write_behind else None,
+                "errors": dict(self.errors)}
+
+    def _find(self, content_key: str) -> Optional[int]:
+        with self._known_lock:
+            perma_id = self._known_ids.get(content_key)
+            if perma_id is not None:
+                self._known_ids.move_to_end(content_key)
+                return perma_id
 
-                curs.execute(INSERT_SQL,
-                             {'model_name'   : model_name,
-                              'headers'      : json.dumps(headers),
-                              'request_data' : json.dumps(inputs),
-                              'response_data': json.dumps(outputs),
-                              'timestamp'    : datetime.datetime.now()})
+        try:
+            with self.pool.connection() as conn, conn.cursor() as curs:
+                curs.execute(FIND_BY_CONTENT_SQL, (content_key,))
+                row = curs.fetchone()
+        except psycopg2.Error:
+            logger.exception("Unable to look up content hash")
+            self.errors["find"] += 1
+            return None
 
+        if row is None:
+            return None
+        self._remember(content_key, row[0])
+        return row[0]
+
+    def _remember(self, content_key: str, perma_id: int) -> None:
+        with self._known_lock:
+            self._known_ids[content_key] = perma_id
+            self._known_ids.move_to_end(content_key)
+            while len(self._known_ids) > self.known_keys:
+                self._known_ids.popitem(last=False)
+
+    def _count_hit(self, perma_id: int) -> None:
+        row = self._unwritten.get(perma_id)
+        if row is not None:
+            # It's still queued, so it can be written with the hit.
+            row['hits'] += 1
+            return
+
+        with self._hits_lock:
+            self._hits[perma_id] += 1
+            if sum(self._hits.values()) < self.batch_size:
+                return
+        self._write_hits()
+
+    def _write_hits(self) -> None:
+        with self._hits_lock:
+            hits, self._hits = self._hits, Counter()
+        if not hits:
+            return
+
+        try:
+            with self.pool.connection() as conn, conn.cursor() as curs:
+                execute_values(curs, ADD_HITS_SQL, list(hits.items()))
+        except psycopg2.Error:
+            # They're only counts, so they aren't worth retrying.
+            logger.exception("Unable to count %s hits", sum(hits.values()))
+            self.errors["add_hits"] += 1
+
+    def _insert(self, row: Dict) -> Optional[int]:
+        try:
+            with self.pool.connection() as conn, conn.cursor() as curs:
+                logger.info("inserting into the database")
+
+                # If someone else stored the same prediction in the meantime, this gets its id.
+                curs.execute(INSERT_SQL, row)
                 perma_id = curs.fetchone()[0]
                 logger.info("received perma_id %s", perma_id)
 
             return perma_id
-        except (psycopg2.Error, AttributeError):
+        except psycopg2.Error:
             logger.exception("Unable to insert permadata")
+            self.errors["insert"] += 1
+            return None
+
+    def _enqueue(self, row: Dict) -> Optional[int]:
+        try:
+            row['id'] = self._reserve_id()
+        except psycopg2.Error:
+            logger.exception("Unable to reserve perma_id")
+            self.errors["reserve_ids"] += 1
             return None
 
+        self._unwritten[row['id']] = row
+        try:
+            self._pending.put(row, timeout=self.enqueue_timeout)
+        except queue.Full:
+            # The database isn't keeping up, so write this one ourselves.
+            logger.warning("write-behind queue is full, inserting perma_id %s directly", row['id'])
+            if not self._insert_rows([row]):
+                return None
+
+        return row['id']
+
+    def _reserve_id(self) -> int:
+        with self._reserve_lock:
+            if not self._reserved_ids:
+                with self.pool.connection() as conn, conn.cursor() as curs:
+                    curs.execute(RESERVE_IDS_SQL, (self.reserve_size,))
+                    self._reserved_ids.extend(row[0] for row in curs.fetchall())
+            return self._reserved_ids.popleft()
+
+    def _flush_forever(self) -> None:
+        done = False
+        while not done:
+            # Wait for a row, then take whatever else has queued up behind it.
+            batch = [self._pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in batch:
+                done = True
+                batch = [row for row in batch if row is not None]
+            if batch:
+                self._insert_rows(batch)
+
+    def _insert_rows(self, rows: List[Dict]) -> bool:
+        """
+        Writes queued rows, after which they're no longer kept in memory (even if writing them failed,
+        in which case their permalinks are lost, as they would be without write-behind).
+        """
+        try:
+            return self._insert_batch(rows)
+        finally:
+            for row in rows:
+                self._unwritten.pop(row['id'], None)
+
+    def _insert_batch(self, rows: List[Dict]) -> bool:
+        for attempt in range(2):
+            try:
+                with self.pool.connection() as conn, conn.cursor() as curs:
+                    inserted = execute_values(curs, INSERT_BATCH_SQL, rows,
+                                              template=INSERT_BATCH_TEMPLATE, fetch=True)
+                logger.info("inserted %s queued predictions", len(inserted))
+                break
+            except psycopg2.Error:
+                logger.exception("Unable to insert %s queued predictions (attempt %s)", len(rows), attempt + 1)
+                self.errors["insert_batch"] += 1
+        else:
+            return False
+
+        # Another process may have stored some of these predictions after we checked for them.
+        # Their ids have already been handed out as permalinks, so store them anyway, undeduplicated.
+        inserted_ids = {row[0] for row in inserted}
+        duplicates = [dict(row, content_hash=None) for row in rows if row['id'] not in inserted_ids]
+        if duplicates:
+            return self._insert_batch(duplicates)
+        return True
+
     def get_result(self, perma_id: int) -> Optional[Permadata]:
+        row = self._unwritten.get(perma_id)
+        if row is not None:
+            return Permadata(row['model_name'], json.loads(row['request_data']), json.loads(row['response_data']))
+
         try:
-            self._health_check()
-            with self.conn.cursor() as curs:
+            with self.pool.connection() as conn, conn.cursor() as curs:
                 logger.info("retrieving perma_id %s from database", perma_id)
                 curs.execute(RETRIEVE_SQL, (perma_id,))
                 row = curs.fetchone()
@@ -173,8 +652,9 @@ class PostgresDemoDatabase(DemoDatabase):
             # Otherwise, return a ``Permadata`` instance.
             model_name, request_data, response_data = row
             return Permadata(model_name, json.loads(request_data), json.loads(response_data))
-        except (psycopg2.Error, AttributeError):
+        except psycopg2.Error:
             logger.exception("Unable to retrieve result")
+            self.errors["retrieve"] += 1
             return None
 
 class InMemoryDemoDatabase(DemoDatabase):
@@ -183,14 +663,27 @@ class InMemoryDemoDatabase(DemoDatabase):
     """
     def __init__(self):
         self.data: List[Permadata] = []
+        self.ids: Dict[str, int] = {}
+        # Maps perma_id -> how many times it's been added, like the ``hits`` column.
+        self.hits: Counter = Counter()
 
     def add_result(self,
                    headers: JsonDict,
                    model_name: str,
                    inputs: JsonDict,
-                   outputs: JsonDict) -> Optional[int]:
+                   outputs: JsonDict,
+                   content_key: str = None) -> Optional[int]:
+        if content_key in self.ids:
+            perma_id = self.ids[content_key]
+            self.hits[perma_id] += 1
+            return perma_id
+
         self.data.append(Permadata(model_name, inputs, outputs))
-        return len(self.data) - 1
+        perma_id = len(self.data) - 1
+        self.hits[perma_id] = 1
+        if content_key is not None:
+            self.ids[content_key] = perma_id
+        return perma_id
 
     def get_result(self, perma_id: int) -> Permadata:
         try:
@@ -198,6 +691,21 @@ class InMemoryDemoDatabase(DemoDatabase):
         except IndexError:
             return None
 
+    def top_inputs(self, model_name: str, limit: int) -> List[JsonDict]:
+        # Like ``TOP_INPUTS_SQL``: the hits of every stored prediction with the same inputs, latest first on ties.
+        counts: Counter = Counter()
+        latest: Dict[str, int] = {}
+        for perma_id, permadata in enumerate(self.data):
+            if permadata.model_name == model_name:
+                inputs = json.dumps(permadata.request_data, sort_keys=True)
+                counts[inputs] += self.hits[perma_id]
+                latest[inputs] = perma_id
+        ranked = sorted(counts, key=lambda inputs: (counts[inputs], latest[inputs]), reverse=True)
+        return [json.loads(inputs) for inputs in ranked[:limit]]
+
+    def stats(self) -> JsonDict:
+        return {"rows": len(self.data)}
+
     @classmethod
     def from_environment(cls) -> Optional['InMemoryDemoDatabase']:
         return InMemoryDemoDatabase()
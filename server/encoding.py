@@ -0,0 +1,107 @@
+"""
+Encoding predictions compactly: a fast JSON encoder where one is installed,
+MessagePack for clients that ask for it, and compression.
+"""
+from typing import Any, Dict, Optional, Tuple
+import gzip
+import json
+
+from flask import Request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+# Mimetypes that clients might ask for MessagePack by.
+MSGPACK_TYPES = (MSGPACK, "application/x-msgpack")
+
+
+def encode_json(obj: Any) -> bytes:
+    """
+    Encodes ``obj`` as JSON, with whichever of ``orjson``, ``ujson`` and ``json`` is available,
+    in that order. The model outputs are big lists of strings and floats, which the first
+    two encode several times faster than ``json``.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    elif ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    else:
+        return json.dumps(obj).encode('utf-8')
+
+def decode_json(body: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body.decode('utf-8'))
+
+
+def encoders() -> Dict[str, Optional[str]]:
+    """
+    Which of the optional packages are installed: the JSON encoder in use,
+    and the ones (if any) for MessagePack and Brotli.
+    """
+    return {"json": "orjson" if orjson is not None else "ujson" if ujson is not None else "json",
+            "msgpack": "msgpack" if msgpack is not None else None,
+            "brotli": "brotli" if brotli is not None else None}
+
+
+def negotiate(request: Request) -> Tuple[str, Optional[str]]:
+    """
+    Returns the mimetype and the content encoding (if any) that
+    the response to ``request`` should have, given what the client accepts.
+    """
+    mimetype = JSON
+    if msgpack is not None:
+        best = request.accept_mimetypes.best_match((JSON,) + MSGPACK_TYPES, default=JSON)
+        if best in MSGPACK_TYPES:
+            mimetype = MSGPACK
+
+    encoding = None
+    if brotli is not None and request.accept_encodings["br"]:
+        encoding = "br"
+    elif request.accept_encodings["gzip"]:
+        encoding = "gzip"
+
+    return mimetype, encoding
+
+def representation(mimetype: str, encoding: Optional[str]) -> str:
+    """
+    A short name for the combination of mimetype and encoding,
+    to tell apart the ETags (and cache entries) of different representations of the same result.
+    """
+    name = "msgpack" if mimetype == MSGPACK else "json"
+    return name if encoding is None else "{}.{}".format(name, encoding)
+
+
+def to_msgpack(body: bytes) -> bytes:
+    return msgpack.packb(decode_json(body), use_bin_type=True)
+
+def compress(body: bytes, encoding: str, level: int) -> bytes:
+    """
+    Compresses ``body`` at ``level``, which runs from 1 (fastest) to 9 (smallest),
+    as for gzip. Brotli's levels go up to 11, but its top levels are far too slow to use per request.
+    """
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=level)
+    elif encoding == "br":
+        return brotli.compress(body, quality=level)
+    else:
+        raise ValueError("unknown encoding: {}".format(encoding))
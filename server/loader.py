@@ -0,0 +1,281 @@
+"""
+Loading the predictors for the demo models.
+"""
+from concurrent.futures import Future
+from typing import Dict, Optional, Set
+import logging
+import threading
+import time
+
+from gevent import spawn
+from gevent.threadpool import ThreadPoolExecutor
+
+from allennlp.common.util import JsonDict
+from allennlp.service.predictors import Predictor
+
+from server.models import MODEL_STORE, DemoModel, quantization_available
+from server.preprocessing import share_preprocessing
+from server.process_pool import InferenceProcessPool
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+PENDING = "pending"
+QUEUED = "queued"
+LOADING = "loading"
+STARTING = "starting"
+LOADED = "loaded"
+FAILED = "failed"
+
+
+class ModelStatus:
+    """
+    How far along a single model is, where it was loaded from
+    (its archive, or the extracted copy in the ``MODEL_STORE``), and what it cost to load.
+    """
+    def __init__(self) -> None:
+        self.state = PENDING
+        self.source: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.memory_mb: Optional[float] = None
+
+    def to_dict(self) -> JsonDict:
+        return {"state": self.state,
+                "source": self.source,
+                "load_seconds": self.load_seconds,
+                "memory_mb": self.memory_mb}
+
+
+class ModelLoader:
+    """
+    Loads the predictors for a collection of ``DemoModel``s into ``predictors``,
+    recording each one's progress, load time and the memory taken up by its weights.
+
+    Models can be loaded up front, either one after another or several at once
+    (on a pool of ``num_threads`` threads), or left until they're first needed.
+    Loading happens on real threads, so the gevent event loop keeps serving requests meanwhile.
+
+    Models that run in their own processes get an ``InferenceProcessPool``, which loads them
+    when it's started; they count as loaded once it has. Each of ``num_workers`` forked server
+    workers starts a pool of its own, so the model's ``processes`` are divided between them
+    (at least one each) rather than every worker starting that many.
+
+    Models that ``quantize`` get their quantized variant (in ``quantized``) by quantizing a copy
+    of the loaded model: along with it, if some requests get the variant by default
+    (a ``quantized_fraction`` over 0), and otherwise when ``load_quantized`` is first asked for it.
+    If that fails, the full model is still served.
+    """
+    def __init__(self,
+                 models: Dict[str, DemoModel],
+                 predictors: Dict[str, Predictor],
+                 num_threads: int = 4,
+                 num_workers: int = 1) -> None:
+        self.models = models
+        self.predictors = predictors
+        self.quantized: Dict[str, Predictor] = {}
+        self.status = {name: ModelStatus() for name in models}
+        self.num_threads = num_threads
+        self.num_workers = num_workers
+        # Created when it's first needed, so that a process that only uses ``load_here`` can fork safely.
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._futures: Dict[str, Future] = {}
+        self._quantized_futures: Dict[str, Future] = {}
+        # The models that couldn't be quantized, which aren't tried again.
+        self._unquantizable: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def load(self, name: str) -> Optional[Predictor]:
+        """
+        Returns the predictor for the named model, loading it first if necessary.
+        Returns ``None`` if there's no such model or if it failed to load.
+        """
+        predictor = self.predictors.get(name)
+        if predictor is None and name in self.models:
+            predictor = self._submit(name).result()
+        return predictor
+
+    def load_quantized(self, name: str) -> Optional[Predictor]:
+        """
+        Returns the quantized variant of the named model, loading and quantizing the model first
+        if necessary. Returns ``None`` if there's no such model or it can't be quantized.
+        """
+        quantized = self.quantized.get(name)
+        if quantized is not None or name in self._unquantizable:
+            return quantized
+        if name not in self.models or not self.models[name].quantize:
+            return None
+
+        predictor = self.load(name)
+        if predictor is None:
+            return None
+        with self._lock:
+            future = self._quantized_futures.get(name)
+            if future is None:
+                future = self._get_executor().submit(self._quantize, name, predictor)
+                self._quantized_futures[name] = future
+        return future.result()
+
+    def load_all(self, parallel: bool = True, wait: bool = True) -> None:
+        """
+        Starts loading every model that isn't already loaded, either all at once
+        or one after another, and (if ``wait``) waits for them all to finish.
+        Loading them one after another without waiting happens in a greenlet of its own,
+        since it waits for each model in turn, and on the executor it could end up waiting
+        for the very thread it's running on.
+        """
+        if parallel:
+            futures = [self._submit(name) for name in self.models]
+            if wait:
+                for future in futures:
+                    future.result()
+        elif wait:
+            for name in self.models:
+                self._submit(name).result()
+        else:
+            spawn(self.load_all, parallel=False)
+
+    def load_here(self) -> None:
+        """
+        Loads every model that isn't already loaded, one after another, on the calling thread,
+        without starting any others. (A process that's going to fork mustn't have other threads.)
+        Models that run in their own processes are left ``STARTING``, for ``start_processes``.
+        """
+        for name in self.models:
+            if self.status[name].state != LOADED:
+                self._load(name, start_processes=False)
+
+    def start_processes(self) -> None:
+        """
+        Starts the processes for the models that run in their own, in the calling process (which
+        is the one that will be routing requests to them), and marks those models loaded.
+        """
+        for name in self.models:
+            pool = self.predictors.get(name)
+            if not isinstance(pool, InferenceProcessPool):
+                continue
+            try:
+                pool.start()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("unable to start processes for %s model", name)
+                self.status[name].state = FAILED
+                del self.predictors[name]
+                with self._lock:
+                    self._futures.pop(name, None)
+                continue
+
+            quantized = self.quantized.get(name)
+            if isinstance(quantized, InferenceProcessPool):
+                try:
+                    quantized.start()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("unable to start quantized %s model, serving only the full one", name)
+                    del self.quantized[name]
+            self.status[name].state = LOADED
+
+    def ready(self) -> bool:
+        """
+        Whether every model is either loaded or waiting to be loaded on demand
+        (as opposed to queued to be loaded, or being loaded, right now).
+        """
+        return all(status.state in (LOADED, PENDING) for status in self.status.values())
+
+    def info(self) -> JsonDict:
+        return {name: status.to_dict() for name, status in self.status.items()}
+
+    def _submit(self, name: str) -> Future:
+        with self._lock:
+            future = self._futures.get(name)
+            if future is None:
+                if self.status[name].state != LOADED:
+                    self.status[name].state = QUEUED
+                future = self._get_executor().submit(self._load, name)
+                self._futures[name] = future
+            return future
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
+
+    def _load(self, name: str, start_processes: bool = True) -> Optional[Predictor]:
+        """
+        Loads the named model. If not ``start_processes``, a model that runs in its own processes
+        gets its pool, but the processes aren't started.
+        """
+        if name in self.predictors:
+            if self.status[name].state != STARTING:
+                self.status[name].state = LOADED
+            return self.predictors[name]
+
+        status = self.status[name]
+        status.state = LOADING
+        logger.info("loading %s model", name)
+        start = time.time()
+
+        demo_model = self.models[name]
+        status.source = "store" if demo_model.extracted(MODEL_STORE) else "archive"
+        try:
+            if demo_model.processes > 0:
+                predictor = self._pool(demo_model)
+                if start_processes:
+                    predictor.start()
+            else:
+                predictor = demo_model.predictor()
+                share_preprocessing(predictor)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("unable to load %s model", name)
+            status.state = FAILED
+            # Let the next request for the model try again.
+            with self._lock:
+                self._futures.pop(name, None)
+            return None
+
+        if demo_model.quantize and demo_model.quantized_fraction > 0:
+            self._quantize(name, predictor, start_processes)
+
+        status.load_seconds = round(time.time() - start, 3)
+        status.memory_mb = _weights_mb(predictor)
+        self.predictors[name] = predictor
+        status.state = LOADED if start_processes or not isinstance(predictor, InferenceProcessPool) else STARTING
+        logger.info("loaded %s model in %.1fs", name, status.load_seconds)
+        return predictor
+
+    def _quantize(self, name: str, predictor: Predictor, start_processes: bool = True) -> Optional[Predictor]:
+        demo_model = self.models[name]
+        if not quantization_available():
+            logger.warning("this PyTorch can't quantize models, so %s has only its full variant", name)
+            self._unquantizable.add(name)
+            return None
+
+        try:
+            if isinstance(predictor, InferenceProcessPool):
+                # The processes can't share the full model's, so they load their own.
+                quantized = self._pool(demo_model, quantized=True)
+                if start_processes:
+                    quantized.start()
+            else:
+                quantized = demo_model.quantized_predictor(predictor)
+                share_preprocessing(quantized)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("unable to quantize %s model, serving only the full one", name)
+            self._unquantizable.add(name)
+            return None
+
+        self.quantized[name] = quantized
+        return quantized
+
+    def _pool(self, demo_model: DemoModel, quantized: bool = False) -> InferenceProcessPool:
+        size = max(1, demo_model.processes // self.num_workers)
+        if size * self.num_workers != demo_model.processes:
+            logger.warning("%s has %i processes for %i workers, so each worker gets %i",
+                           demo_model.predictor_name, demo_model.processes, self.num_workers, size)
+        return InferenceProcessPool(demo_model, size, quantized=quantized)
+
+
+def _weights_mb(predictor: Predictor) -> Optional[float]:
+    if isinstance(predictor, InferenceProcessPool):
+        # The weights are in other processes.
+        return None
+
+    model = predictor._model  # pylint: disable=protected-access
+    num_bytes = sum(tensor.numel() * tensor.element_size() for tensor in model.state_dict().values())
+    return round(num_bytes / 1024 / 1024, 1)
@@ -1,4 +1,315 @@
-from allennlp.service.predictors import DemoModel
+from typing import Callable, List, Optional
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+import numpy
+import torch
+
+from allennlp.common import Params
+from allennlp.common.file_utils import cached_path
+from allennlp.common.util import JsonDict
+from allennlp.data import Vocabulary
+from allennlp.models.archival import CONFIG_NAME, Archive, load_archive
+from allennlp.models.model import Model, remove_pretrained_embedding_params
+from allennlp.service.predictors import Predictor
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# Responses smaller than this (in bytes) aren't worth compressing.
+COMPRESS_MIN_BYTES = 1024
+COMPRESS_LEVEL = 6
+
+# Where ``scripts/extract_models.py`` puts the unpacked models, if anywhere.
+# (Read here rather than in the app, because the script runs before the rest of the server is installed.)
+MODEL_STORE = os.environ.get("ALLENNLP_DEMO_MODEL_STORE")
+# Bumped whenever the layout of the store changes, so that old extractions are ignored.
+STORE_FORMAT = "v1"
+_WEIGHTS_NAME = "weights.th"
+# Lists the files (e.g. ELMo's weights) bundled with an archive, under "fta/", by the config setting they replace.
+_FTA_NAME = "files_to_archive.json"
+
+# The variants of a model that a request can ask for.
+FULL = "full"
+QUANTIZED = "quantized"
+
+
+class DemoModel:
+    """
+    A demo model is determined by both an archive file
+    (representing the trained model)
+    and a choice of predictor, along with the settings
+    the server uses when serving it.
+
+    ``max_batch_size`` and ``batch_window_ms`` control micro-batching:
+    concurrent requests for the model are held for up to ``batch_window_ms``
+    milliseconds (or until ``max_batch_size`` of them are waiting) and then
+    run through the predictor as a single batch. A ``max_batch_size`` of 1
+    disables batching.
+
+    If ``processes`` is more than 0, the model runs in that many separate
+    processes rather than in the server itself, so that it can be scaled on
+    its own and slow predictions can't hold up other models.
+
+    If ``max_concurrency`` is set, at most that many predictions (not counting
+    cache hits) run at once, with up to ``max_queue`` more waiting. Requests
+    beyond that get a 503 asking them to retry after ``retry_after`` seconds.
+
+    Responses of at least ``compress_min_bytes`` are compressed (for clients
+    that accept it) at ``compress_level``, from 1 (fastest) to 9 (smallest).
+
+    ``default_fields`` lists the fields of the prediction that are returned
+    (and cached and stored) unless the request asks for others, so that
+    the many things the frontend doesn't use, such as per-token probabilities,
+    aren't sent at all. If it's ``None``, everything is returned.
+
+    The model predictions are extremely verbose, so only what ``log_outputs``
+    extracts from them (the most human-readable parts) is logged.
+
+    If ``merge_sentences`` is set, an input (``{"sentence": ...}``) of several sentences
+    is predicted a sentence at a time, with each sentence's prediction cached on its own,
+    so that resubmitting it with one sentence edited only reruns that sentence.
+    ``merge_sentences`` combines the predictions for the sentences into one for the whole input.
+
+    If ``quantize`` is set, the model also has a variant with its linear and LSTM layers quantized to int8,
+    which is smaller and, on CPU, faster, but not quite as accurate. Requests choose between the two
+    with ``variant=quantized`` or ``variant=full``, and a ``quantized_fraction`` of those that don't
+    get the quantized one, so that the two can be compared on real traffic. The quantized variant is
+    made along with the model if ``quantized_fraction`` is more than 0, and otherwise on its first request.
+    """
+    def __init__(self,
+                 archive_file: str,
+                 predictor_name: str,
+                 max_batch_size: int = 1,
+                 batch_window_ms: float = 0.0,
+                 processes: int = 0,
+                 max_concurrency: int = None,
+                 max_queue: int = 0,
+                 retry_after: int = 1,
+                 compress_min_bytes: int = COMPRESS_MIN_BYTES,
+                 compress_level: int = COMPRESS_LEVEL,
+                 default_fields: Optional[List[str]] = None,
+                 log_outputs: Callable[[JsonDict], JsonDict] = None,
+                 merge_sentences: Callable[[List[JsonDict]], JsonDict] = None,
+                 quantize: bool = False,
+                 quantized_fraction: float = 0.0) -> None:
+        self.archive_file = archive_file
+        self.predictor_name = predictor_name
+        self.max_batch_size = max_batch_size
+        self.batch_window_ms = batch_window_ms
+        self.processes = processes
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+        self.default_fields = default_fields
+        self.log_outputs = log_outputs
+        self.merge_sentences = merge_sentences
+        self.quantize = quantize
+        self.quantized_fraction = quantized_fraction
+
+    @property
+    def version(self) -> str:
+        """
+        Identifies the trained model, so that cached predictions
+        don't outlive an upgrade to a new archive.
+        """
+        return os.path.basename(self.archive_file)
+
+    def store_path(self, store: str) -> str:
+        return os.path.join(store, STORE_FORMAT, self.version)
+
+    def extracted(self, store: Optional[str]) -> bool:
+        return store is not None and os.path.exists(os.path.join(self.store_path(store), "manifest.json"))
+
+    def extract(self, store: str) -> str:
+        """
+        Unpacks the archive into ``store`` (unless it's already there), with each of the
+        model's weights saved as its own ``.npy`` file, so that ``predictor`` can memory-map them
+        instead of unpacking and deserializing the archive every time. Returns where it went.
+        """
+        path = self.store_path(store)
+        if self.extracted(store):
+            return path
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unpack next to the final location, and only move it there once it's complete.
+        unpacked = tempfile.mkdtemp(dir=os.path.dirname(path))
+        with tarfile.open(cached_path(self.archive_file), 'r:gz') as archive:
+            archive.extractall(unpacked)
+
+        weights_file = os.path.join(unpacked, _WEIGHTS_NAME)
+        state = torch.load(weights_file, map_location=lambda storage, location: storage)
+        os.remove(weights_file)
+        os.mkdir(os.path.join(unpacked, "weights"))
+        manifest = {}
+        for name, tensor in state.items():
+            numpy.save(os.path.join(unpacked, "weights", name + ".npy"), tensor.cpu().numpy())
+            manifest[name] = list(tensor.size())
+        with open(os.path.join(unpacked, "manifest.json"), "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(unpacked, path)
+        return path
+
+    def predictor(self, quantized: bool = False) -> Predictor:
+        """
+        Loads the model from the ``MODEL_STORE``, if it's been extracted there, and otherwise
+        from its archive, and quantizes it if asked to.
+        """
+        if quantized and not quantization_available():
+            # Don't load the model just to find out.
+            raise RuntimeError("quantization needs PyTorch 1.3 or later, not {}".format(torch.__version__))
+
+        start = time.time()
+        if self.extracted(MODEL_STORE):
+            source = self.store_path(MODEL_STORE)
+            archive = load_extracted(source)
+        else:
+            source = self.archive_file
+            archive = load_archive(self.archive_file)
+        if quantized:
+            archive = archive._replace(model=quantize(archive.model))
+            source += " (quantized)"
+        predictor = Predictor.from_archive(archive, self.predictor_name)
+        logger.info("loaded %s from %s in %.2fs", self.predictor_name, source, time.time() - start)
+        return predictor
+
+    def quantized_predictor(self, predictor: Predictor) -> Predictor:
+        """
+        Returns a predictor for a quantized copy of the (already loaded) model behind ``predictor``,
+        which is left as it is, rather than loading the model all over again.
+        """
+        # pylint: disable=protected-access
+        start = time.time()
+        quantized = Predictor.by_name(self.predictor_name)(quantize(predictor._model), predictor._dataset_reader)
+        logger.info("quantized %s in %.2fs", self.predictor_name, time.time() - start)
+        return quantized
+
+
+def quantization_available() -> bool:
+    """
+    Whether this version of PyTorch can ``quantize`` models. (1.3 and later can.)
+    """
+    return hasattr(torch, "quantization")
+
+def quantize(model: Model) -> Model:
+    """
+    Returns a copy of the model with its linear and LSTM layers' weights quantized to int8 ahead of time,
+    and their activations quantized on the fly ("dynamic" quantization). The model itself is left alone.
+    """
+    if not quantization_available():
+        raise RuntimeError("quantization needs PyTorch 1.3 or later, not {}".format(torch.__version__))
+    quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8,
+                                                    inplace=False)
+    quantized.eval()
+    return quantized
+
+
+def load_extracted(path: str) -> Archive:
+    """
+    Builds the model in an extracted archive, with its weights memory-mapped (copy-on-write)
+    rather than read in, so that they're only paged in as they're used, and every process
+    on the host shares the same pages.
+    """
+    overrides = _bundled_files(path)
+    config = Params.from_file(os.path.join(path, CONFIG_NAME), json.dumps(overrides) if overrides else "")
+    vocab = Vocabulary.from_files(os.path.join(path, "vocabulary"))
+    model_params = config.duplicate().get("model")
+    # The pretrained embeddings are already in the weights.
+    remove_pretrained_embedding_params(model_params)
+    model = Model.from_params(vocab, model_params)
+
+    with open(os.path.join(path, "manifest.json")) as manifest_file:
+        names = json.load(manifest_file)
+    parameters = dict(model.named_parameters())
+    state = model.state_dict()
+    for name in names:
+        tensor = torch.from_numpy(numpy.load(os.path.join(path, "weights", name + ".npy"), mmap_mode='c'))
+        if name in parameters:
+            parameters[name].data = tensor
+        else:
+            # A buffer (e.g. a batch norm's running mean), which is small enough to just copy.
+            state[name].copy_(tensor)
+    model.eval()
+    return Archive(model=model, config=config)
+
+def _bundled_files(path: str) -> JsonDict:
+    """
+    Config overrides that point the settings for the files bundled with an archive at the bundled
+    copies, as ``load_archive`` does, rather than at wherever they were when the model was trained
+    (often S3, where they'd be downloaded from on every start).
+    """
+    fta_path = os.path.join(path, _FTA_NAME)
+    if not os.path.exists(fta_path):
+        return {}
+
+    with open(fta_path) as fta_file:
+        files_to_archive = json.load(fta_file)
+    overrides: JsonDict = {}
+    for key in files_to_archive:
+        # e.g. "model.text_field_embedder.elmo.weight_file"
+        *parents, name = key.split(".")
+        settings = overrides
+        for parent in parents:
+            settings = settings.setdefault(parent, {})
+        settings[name] = os.path.join(path, "fta", key)
+    return overrides
+
+
+class _LogFields:
+    """
+    Picks out the named fields of a prediction. (A class rather than a closure,
+    so that it can be sent along with its ``DemoModel`` to an inference process.)
+    """
+    def __init__(self, *names: str) -> None:
+        self.names = names
+
+    def __call__(self, prediction: JsonDict) -> JsonDict:
+        # The request may have asked for only some of the fields.
+        return {name: prediction.get(name) for name in self.names}
+
+def _log_verbs(prediction: JsonDict) -> JsonDict:
+    verbs = []
+    for verb in prediction.get("verbs", []):
+        # Don't want to log boring verbs with no semantic parses.
+        good_tags = [tag for tag in verb["tags"] if tag != "0"]
+        if len(good_tags) > 1:
+            verbs.append({"verb": verb["verb"], "description": verb["description"]})
+    return {"verbs": verbs}
+
+def _merge_tokens(predictions: List[JsonDict]) -> JsonDict:
+    """
+    For predictions made up entirely of one list per token (``words``, ``tags`` and so on).
+    """
+    merged: JsonDict = {}
+    for prediction in predictions:
+        for name, values in prediction.items():
+            merged.setdefault(name, []).extend(values)
+    return merged
+
+def _merge_verbs(predictions: List[JsonDict]) -> JsonDict:
+    """
+    Each verb's tags (and description) cover every word in the input, not just its own sentence's.
+    """
+    words = [word for prediction in predictions for word in prediction["words"]]
+    verbs = []
+    start = 0
+    for prediction in predictions:
+        end = start + len(prediction["words"])
+        for verb in prediction["verbs"]:
+            verbs.append({"verb": verb["verb"],
+                          "description": " ".join(words[:start] + [verb["description"]] + words[end:]),
+                          "tags": ["O"] * start + verb["tags"] + ["O"] * (len(words) - end)})
+        start = end
+    return {"verbs": verbs, "words": words}
+
 
 # This maps from the name of the task
 # to the ``DemoModel`` indicating the location of the trained model
@@ -9,26 +320,75 @@ from allennlp.service.predictors import DemoModel
 MODELS = {
         'machine-comprehension': DemoModel(
                 'https://s3-us-west-2.amazonaws.com/allennlp/models/bidaf-model-2017.09.15-charpad.tar.gz',  # pylint: disable=line-too-long
-                'machine-comprehension'
+                'machine-comprehension',
+                max_batch_size=16,
+                batch_window_ms=10,
+                max_concurrency=32,
+                max_queue=64,
+                default_fields=['best_span', 'best_span_str', 'passage_question_attention',
+                                'question_tokens', 'passage_tokens'],
+                log_outputs=_LogFields('best_span_str'),
+                quantize=True
         ),
         'semantic-role-labeling': DemoModel(
                 'https://s3-us-west-2.amazonaws.com/allennlp/models/srl-model-2018.05.25.tar.gz', # pylint: disable=line-too-long
-                'semantic-role-labeling'
+                'semantic-role-labeling',
+                max_batch_size=16,
+                batch_window_ms=10,
+                max_concurrency=32,
+                max_queue=64,
+                default_fields=['verbs', 'words'],
+                log_outputs=_log_verbs,
+                merge_sentences=_merge_verbs,
+                quantize=True
         ),
         'textual-entailment': DemoModel(
                 'https://s3-us-west-2.amazonaws.com/allennlp/models/decomposable-attention-elmo-2018.02.19.tar.gz',  # pylint: disable=line-too-long
-                'textual-entailment'
+                'textual-entailment',
+                max_batch_size=8,
+                batch_window_ms=5,
+                max_concurrency=16,
+                max_queue=32,
+                default_fields=['label_probs', 'h2p_attention', 'p2h_attention',
+                                'premise_tokens', 'hypothesis_tokens'],
+                log_outputs=_LogFields('label_probs')
         ),
         'coreference-resolution': DemoModel(
                 'https://s3-us-west-2.amazonaws.com/allennlp/models/coref-model-2018.02.05.tar.gz',  # pylint: disable=line-too-long
-                'coreference-resolution'
+                'coreference-resolution',
+                processes=2,
+                max_concurrency=4,
+                max_queue=8,
+                retry_after=5,
+                compress_level=9,
+                default_fields=['document', 'clusters'],
+                log_outputs=_LogFields('clusters', 'document'),
+                quantize=True
         ),
         'named-entity-recognition': DemoModel(
                 'https://s3-us-west-2.amazonaws.com/allennlp/models/ner-model-2018.04.30.tar.gz',  # pylint: disable=line-too-long
-                'sentence-tagger'
+                'sentence-tagger',
+                max_batch_size=32,
+                batch_window_ms=5,
+                max_concurrency=64,
+                max_queue=128,
+                default_fields=['words', 'tags'],
+                log_outputs=_LogFields('tags'),
+                merge_sentences=_merge_tokens,
+                quantize=True
         ),
         'constituency-parsing': DemoModel(
                 'https://s3-us-west-2.amazonaws.com/allennlp/models/elmo-constituency-parser-2018.03.14.tar.gz',  # pylint: disable=line-too-long
-                'constituency-parser'
+                'constituency-parser',
+                max_batch_size=8,
+                batch_window_ms=10,
+                max_concurrency=16,
+                max_queue=32,
+                retry_after=2,
+                compress_level=9,
+                default_fields=['hierplane_tree', 'trees'],
+                log_outputs=_LogFields('trees')
+                # Not predicted a sentence at a time: the parser makes a single tree for the whole input,
+                # and there's no faithful way to stitch several sentences' trees into one.
         )
 }
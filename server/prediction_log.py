@@ -0,0 +1,123 @@
+"""
+Logging predictions without holding up the requests that made them.
+"""
+from collections import deque
+from typing import IO
+import atexit
+import json
+import random
+import sys
+
+from gevent.monkey import get_original
+
+from allennlp.common.util import JsonDict
+
+# The unpatched versions, so that the writer gets a real thread of its own even under gevent,
+# and a write that blocks only blocks that thread, rather than the whole event loop.
+_start_new_thread = get_original("_thread", "start_new_thread")
+_allocate_lock = get_original("_thread", "allocate_lock")
+
+
+class _Signal:
+    """
+    Like a ``threading.Event`` that's cleared by waiting for it, but built on an unpatched lock,
+    so that the event loop's thread can wake up a real one (and vice versa) even under gevent.
+    """
+    def __init__(self) -> None:
+        self._lock = _allocate_lock()
+        self._lock.acquire()
+
+    def set(self) -> None:
+        try:
+            self._lock.release()
+        except RuntimeError:
+            # It's already set.
+            pass
+
+    def wait(self) -> None:
+        self._lock.acquire()
+
+
+class PredictionLog:
+    """
+    Writes a JSON line to ``stream`` (stdout, by default) for a ``sample_rate`` fraction of the
+    predictions it's given. ``log`` only queues the entry, and a background thread does the
+    encoding and writing, so a slow reader at the other end of ``stream`` never holds up a request.
+    If ``queue_size`` entries are already waiting, new ones are dropped (and counted)
+    rather than waited for.
+
+    The lines don't go through the ``logging`` module, whose locks belong to the event loop's thread
+    under gevent, so they're just the JSON, without a level or logger name in front.
+
+    ``close`` (which also runs at exit) writes whatever is still queued and stops the thread.
+    """
+    def __init__(self, sample_rate: float = 1.0, queue_size: int = 1000, stream: IO[str] = None) -> None:
+        self.sample_rate = sample_rate
+        self.queue_size = queue_size
+        self.stream = stream or sys.stdout
+        self.queued = 0
+        self.logged = 0
+        self.dropped = 0
+        self.failed = 0
+        # Appending and popping are atomic, so this is safe to share with a real thread.
+        self._entries: deque = deque()
+        self._closed = False
+        # Set when there are new entries (or it's time to stop), and when the writer has caught up.
+        self._wake_writer = _Signal()
+        self._caught_up = _Signal()
+        self._stopped = _Signal()
+        _start_new_thread(self._write_until_closed, ())
+        atexit.register(self.close)
+
+    def log(self, entry: JsonDict) -> None:
+        if self._closed or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return
+        if len(self._entries) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queued += 1
+        self._entries.append(entry)
+        self._wake_writer.set()
+
+    def flush(self) -> None:
+        """
+        Waits until everything queued so far has been written. This blocks the calling thread.
+        """
+        while self.logged + self.failed < self.queued:
+            self._caught_up.wait()
+
+    def close(self) -> None:
+        """
+        Writes everything queued so far, and stops the writer.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wake_writer.set()
+        self._stopped.wait()
+
+    def stats(self) -> JsonDict:
+        return {"sample_rate": self.sample_rate,
+                "waiting": len(self._entries),
+                "logged": self.logged,
+                "dropped": self.dropped,
+                "failed": self.failed}
+
+    def _write_until_closed(self) -> None:
+        while True:
+            self._wake_writer.wait()
+            while self._entries:
+                self._write(self._entries.popleft())
+            self._caught_up.set()
+            if self._closed:
+                self._stopped.set()
+                return
+
+    def _write(self, entry: JsonDict) -> None:
+        try:
+            self.stream.write(json.dumps(entry) + "\n")
+            self.stream.flush()
+            self.logged += 1
+        except Exception:  # pylint: disable=broad-except
+            # Not logged, for the same reason the entries aren't.
+            self.failed += 1
@@ -0,0 +1,157 @@
+"""
+Serving the demo from several forked worker processes that share one copy of the models.
+"""
+from typing import Callable, Dict, Optional, Tuple
+import atexit
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+import torch
+
+from allennlp.common.util import JsonDict
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# How often (in seconds) the supervisor logs how much memory its workers share.
+REPORT_INTERVAL = 300
+
+
+def serve_forked(serve: Callable[[socket.socket], None],
+                 address: Tuple[str, int],
+                 num_workers: int) -> None:
+    """
+    Forks ``num_workers`` processes that each call ``serve`` with their own listening socket
+    bound to ``address`` (with ``SO_REUSEPORT``, so the kernel spreads connections between them),
+    restarts any that die, and shuts them all down on SIGTERM or SIGINT.
+
+    Anything already loaded (in particular, the models) is shared with the workers copy-on-write,
+    so it should all be loaded before calling this. Nothing should write to the model weights
+    afterwards, or the pages holding them stop being shared. Only the calling thread survives
+    the fork, so no other threads (e.g. thread pools) should have been started yet.
+    """
+    if hasattr(gc, "freeze"):
+        # Move everything loaded so far out of the garbage collector's reach,
+        # so that collections in the workers don't write to (and so copy) it.
+        gc.collect()
+        gc.freeze()
+
+    workers: Dict[int, int] = {}
+    stopping = []
+
+    def stop(signum: int, frame) -> None:  # pylint: disable=unused-argument
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def respawn(index: int) -> None:
+        _spawn(serve, address, num_workers, index, workers)
+
+    for index in range(num_workers):
+        respawn(index)
+
+    last_report = time.time()
+    while workers:
+        if stopping:
+            logger.info("stopping %s workers", len(workers))
+            for pid in workers:
+                os.kill(pid, signal.SIGTERM)
+            while workers:
+                pid, _ = os.wait()
+                workers.pop(pid, None)
+            break
+
+        if not _reap(workers, respawn):
+            if time.time() - last_report > REPORT_INTERVAL:
+                for worker_pid, index in workers.items():
+                    logger.info("worker %s memory: %s", index, memory_sharing(str(worker_pid)))
+                last_report = time.time()
+            time.sleep(1)
+
+
+def _reap(workers: Dict[int, int], respawn: Callable[[int], None]) -> bool:
+    """
+    If a child process has exited, forgets it and, if it was one of the ``workers`` (which maps pid
+    to the worker's index), replaces it by calling ``respawn`` with its index. Returns whether one had.
+    """
+    pid, status = os.waitpid(-1, os.WNOHANG)
+    if pid == 0:
+        return False
+
+    index = workers.pop(pid, None)
+    if index is not None:
+        logger.error("worker %s (pid %s) exited with status %s, restarting it", index, pid, status)
+        respawn(index)
+    return True
+
+
+def _spawn(serve: Callable[[socket.socket], None],
+           address: Tuple[str, int],
+           num_workers: int,
+           index: int,
+           workers: Dict[int, int]) -> None:
+    pid = os.fork()
+    if pid != 0:
+        logger.info("started worker %s (pid %s)", index, pid)
+        workers[pid] = index
+        return
+
+    # We're the worker. Exit rather than ever returning into the supervisor's loop.
+    status = 1
+    try:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        # Split the cores between the workers, rather than every worker trying to use all of them.
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+
+        serve(_reuseport_socket(address))
+        status = 0
+    except SystemExit as error:
+        status = error.code if isinstance(error.code, int) else 0
+    except BaseException:  # pylint: disable=broad-except
+        logger.exception("worker %s crashed", index)
+    finally:
+        # Flush anything (e.g. queued permalinks) that's waiting to be written at exit.
+        atexit._run_exitfuncs()  # pylint: disable=protected-access
+        logging.shutdown()
+        os._exit(status)  # pylint: disable=protected-access
+
+
+def _reuseport_socket(address: Tuple[str, int]) -> socket.socket:
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(address)
+    listener.listen(socket.SOMAXCONN)
+    return listener
+
+
+def memory_sharing(pid: str = "self", smaps_path: str = None) -> Optional[JsonDict]:
+    """
+    Breaks down the resident memory of a process (in MB) into what it shares with other
+    processes, such as model weights inherited by a forked worker, and what's private to it.
+    Returns ``None`` where ``/proc/<pid>/smaps_rollup`` (or ``smaps_path``) isn't available.
+    """
+    kilobytes: Dict[str, int] = {}
+    try:
+        with open(smaps_path or f"/proc/{pid}/smaps_rollup") as smaps:
+            for line in smaps:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == "kB":
+                    kilobytes[fields[0].rstrip(":")] = int(fields[1])
+    except OSError:
+        return None
+
+    def megabytes(*names: str) -> float:
+        return round(sum(kilobytes.get(name, 0) for name in names) / 1024, 1)
+
+    return {"rss_mb": megabytes("Rss"),
+            "pss_mb": megabytes("Pss"),
+            "shared_mb": megabytes("Shared_Clean", "Shared_Dirty"),
+            "private_mb": megabytes("Private_Clean", "Private_Dirty")}
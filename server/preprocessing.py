@@ -0,0 +1,175 @@
+"""
+Sharing spaCy's preprocessing (tokenization, tagging, and so on) between models.
+"""
+from collections import OrderedDict
+from typing import Any, List, Optional, Set
+import hashlib
+import threading
+
+from spacy.language import Language
+from spacy.tokens import Doc, Token
+
+from allennlp.common.util import JsonDict
+from allennlp.data.tokenizers.word_splitter import SpacyWordSplitter, WordSplitter
+from allennlp.data.tokenizers.word_tokenizer import WordTokenizer
+from allennlp.service.predictors import Predictor
+
+# How many tokens' worth of processed documents to keep.
+MAX_TOKENS = 250000
+
+# The input field that each kind of shared pipeline processes: the one behind a predictor's tokenizer
+# (for NER, SRL and constituency parsing) splits the "sentence", and coreference's the "document".
+TOKENIZER_FIELD = "sentence"
+SPACY_FIELD = "document"
+
+
+class DocumentCache:
+    """
+    The most recently used spaCy ``Doc``s, up to ``max_tokens`` tokens of them in all, keyed by
+    the pipeline that made them and a hash of their text. The predictors for several models
+    (e.g. NER, SRL and constituency parsing) tokenize and tag with the same pipeline, so a sentence
+    sent to each of them is only processed once.
+
+    Lookups made to ``prefetch`` documents aren't counted as hits or misses. Instead, the first
+    ordinary lookup of a document that was prefetched counts as the miss it would have been.
+    """
+    def __init__(self, max_tokens: int = MAX_TOKENS) -> None:
+        self.max_tokens = max_tokens
+        self.num_tokens = 0
+        self.hits = 0
+        self.misses = 0
+        self._docs: 'OrderedDict[Any, Doc]' = OrderedDict()
+        # The keys of the documents that were processed to prefetch them, and haven't been looked up since.
+        self._prefetched: Set[Any] = set()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any, prefetch: bool = False) -> Optional[Doc]:
+        with self._lock:
+            doc = self._docs.get(key)
+            if doc is not None:
+                self._docs.move_to_end(key)
+            if prefetch:
+                return doc
+
+            if doc is None or key in self._prefetched:
+                self.misses += 1
+                self._prefetched.discard(key)
+            else:
+                self.hits += 1
+            return doc
+
+    def put(self, key: Any, doc: Doc, prefetch: bool = False) -> None:
+        with self._lock:
+            if key in self._docs:
+                self.num_tokens -= len(self._docs[key])
+            self._docs[key] = doc
+            self._docs.move_to_end(key)
+            self.num_tokens += len(doc)
+            if prefetch:
+                self._prefetched.add(key)
+
+            # Always keep the newest, even if it's too big by itself, since it's about to be used.
+            while self.num_tokens > self.max_tokens and len(self._docs) > 1:
+                evicted, evicted_doc = self._docs.popitem(last=False)
+                self.num_tokens -= len(evicted_doc)
+                self._prefetched.discard(evicted)
+
+    def stats(self) -> JsonDict:
+        with self._lock:
+            return {"documents": len(self._docs),
+                    "tokens": self.num_tokens,
+                    "max_tokens": self.max_tokens,
+                    "hits": self.hits,
+                    "misses": self.misses}
+
+# The one every predictor in the process shares.
+DOCUMENTS = DocumentCache()
+
+
+class CachingSpacy:
+    """
+    Stands in for a spaCy pipeline, processing each text only if it's not already in ``cache``.
+    """
+    def __init__(self, nlp: Language, cache: DocumentCache) -> None:
+        self.nlp = nlp
+        self.cache = cache
+
+    def __call__(self, text: str) -> Doc:
+        return self.pipe([text])[0]
+
+    def pipe(self, texts: List[str], prefetch: bool = False) -> List[Doc]:
+        """
+        Returns the processed documents for ``texts``, running those that aren't cached
+        through spaCy together, which is cheaper than one at a time. If ``prefetch``,
+        they're only wanted in the cache, ahead of the lookups that will actually use them.
+        """
+        keys = [self._key(text) for text in texts]
+        docs = [self.cache.get(key, prefetch) for key in keys]
+        missing = [i for i, doc in enumerate(docs) if doc is None]
+        if missing:
+            for i, doc in zip(missing, self.nlp.pipe([texts[i] for i in missing], batch_size=len(missing))):
+                docs[i] = doc
+                self.cache.put(keys[i], doc, prefetch)
+        return docs
+
+    def _key(self, text: str) -> Any:
+        # Models loaded with the same spaCy settings share a pipeline (and so its cache entries).
+        return id(self.nlp), hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class CachingWordSplitter(WordSplitter):
+    """
+    A ``SpacyWordSplitter`` that gets its documents from a ``CachingSpacy``.
+    """
+    def __init__(self, spacy: CachingSpacy) -> None:
+        self.spacy = spacy
+
+    def split_words(self, sentence: str) -> List[Token]:
+        return _remove_spaces(self.spacy(sentence))
+
+    def batch_split_words(self, sentences: List[str]) -> List[List[Token]]:
+        return [_remove_spaces(doc) for doc in self.spacy.pipe(sentences)]
+
+
+def share_preprocessing(predictor: Predictor, cache: DocumentCache = DOCUMENTS) -> bool:
+    """
+    Makes the predictor's spaCy preprocessing go through ``cache``, if it does any that we know of.
+    Returns whether it does.
+    """
+    # pylint: disable=protected-access
+    shared = False
+    tokenizer = getattr(predictor, "_tokenizer", None)
+    if isinstance(tokenizer, SpacyWordSplitter):
+        predictor._tokenizer = CachingWordSplitter(CachingSpacy(tokenizer.spacy, cache))
+        shared = True
+    elif isinstance(tokenizer, WordTokenizer) and isinstance(tokenizer._word_splitter, SpacyWordSplitter):
+        tokenizer._word_splitter = CachingWordSplitter(CachingSpacy(tokenizer._word_splitter.spacy, cache))
+        shared = True
+
+    # The coreference predictor uses a spaCy pipeline directly.
+    if isinstance(getattr(predictor, "_spacy", None), Language):
+        predictor._spacy = CachingSpacy(predictor._spacy, cache)
+        shared = True
+    return shared
+
+def preprocess_batch(predictor: Predictor, inputs: List[JsonDict]) -> None:
+    """
+    Caches the preprocessed documents for a batch of inputs, all in one go, before the predictor
+    asks for them one at a time. Only the field that the predictor runs through spaCy is processed.
+    Does nothing for predictors that don't ``share_preprocessing``.
+    """
+    # pylint: disable=protected-access
+    tokenizer = getattr(predictor, "_tokenizer", None)
+    if isinstance(tokenizer, WordTokenizer):
+        tokenizer = tokenizer._word_splitter
+    pipelines = [(getattr(tokenizer, "spacy", None), TOKENIZER_FIELD),
+                 (getattr(predictor, "_spacy", None), SPACY_FIELD)]
+
+    for spacy, field in pipelines:
+        if isinstance(spacy, CachingSpacy):
+            texts = [data[field] for data in inputs if isinstance(data, dict) and isinstance(data.get(field), str)]
+            spacy.pipe(texts, prefetch=True)
+
+
+def _remove_spaces(doc: Doc) -> List[Token]:
+    return [token for token in doc if not token.is_space]
@@ -0,0 +1,171 @@
+"""
+Running models in their own processes, so that slow ones can't hold up everything else.
+"""
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+from gevent.socket import wait_read
+
+from allennlp.common.util import JsonDict
+
+from server.models import DemoModel
+from server.preprocessing import preprocess_batch, share_preprocessing
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class InferenceProcessPool:
+    """
+    Runs a ``DemoModel`` in ``size`` separate processes, each with its own copy of the model,
+    and hands predictions to whichever of them is free over a pipe. While a process is working,
+    the calling greenlet waits cooperatively, so the server carries on with other requests.
+
+    It has the same ``predict_json`` and ``predict_batch_json`` methods as a ``Predictor``,
+    so it can stand in for one. The processes are started by ``start``, or on first use,
+    by whichever process uses the pool; a forked server worker gets processes of its own.
+    If ``quantized``, they run the quantized variant of the model.
+
+    A process that dies is replaced in the background, with up to ``RESPAWN_ATTEMPTS`` tries,
+    ``RESPAWN_DELAY`` seconds apart (doubling each time). If every process is gone for good,
+    predictions fail straight away rather than waiting for one that will never be free.
+    """
+    RESPAWN_ATTEMPTS = 5
+    RESPAWN_DELAY = 1.0
+
+    def __init__(self, demo_model: DemoModel, size: int, quantized: bool = False) -> None:
+        self.demo_model = demo_model
+        self.size = size
+        self.quantized = quantized
+        self._owner: Optional[int] = None
+        # ``None`` in the queue means there are no processes left.
+        self._idle: 'queue.Queue[Optional[Connection]]' = queue.Queue()
+        self._processes: Dict[Connection, multiprocessing.Process] = {}
+        self._replacing = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        """
+        Starts the processes, unless this process already has, and waits for them to load the model.
+        """
+        with self._lock:
+            if self._owner == os.getpid():
+                return
+            self._idle = queue.Queue()
+            self._processes = {}
+            self._replacing = 0
+            for _ in range(self.size):
+                self._start_process()
+            self._owner = os.getpid()
+
+    def predict_json(self, inputs: JsonDict) -> JsonDict:
+        return self._call("predict_json", inputs)
+
+    def predict_batch_json(self, inputs: List[JsonDict]) -> List[JsonDict]:
+        return self._call("predict_batch_json", inputs)
+
+    def _call(self, method: str, inputs: Any) -> Any:
+        self.start()
+        conn = self._idle.get()
+        if conn is None:
+            # Leave it for the next caller too.
+            self._idle.put(None)
+            raise RuntimeError("no inference processes left for {}".format(self.demo_model.predictor_name))
+
+        try:
+            conn.send((method, inputs))
+            succeeded, result = _receive(conn)
+        except (EOFError, OSError):
+            logger.exception("inference process for %s died, replacing it", self.demo_model.predictor_name)
+            with self._lock:
+                self._processes.pop(conn).terminate()
+                self._replacing += 1
+            conn.close()
+            threading.Thread(target=self._replace_process, daemon=True).start()
+            raise RuntimeError("inference process for {} died".format(self.demo_model.predictor_name))
+
+        self._idle.put(conn)
+        if not succeeded:
+            raise RuntimeError(result)
+        return result
+
+    def _replace_process(self) -> None:
+        delay = self.RESPAWN_DELAY
+        replaced = False
+        for attempt in range(1, self.RESPAWN_ATTEMPTS + 1):
+            try:
+                self._start_process()
+                replaced = True
+                break
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("unable to replace inference process for %s (attempt %s of %s)",
+                                 self.demo_model.predictor_name, attempt, self.RESPAWN_ATTEMPTS)
+            if attempt < self.RESPAWN_ATTEMPTS:
+                time.sleep(delay)
+                delay *= 2
+
+        with self._lock:
+            self._replacing -= 1
+            if not replaced and not self._processes and not self._replacing:
+                logger.error("no inference processes left for %s", self.demo_model.predictor_name)
+                self._idle.put(None)
+
+    def _start_process(self) -> None:
+        context = multiprocessing.get_context("spawn")
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_serve_predictions, args=(self.demo_model, self.quantized, child_conn),
+                                  daemon=True)
+        process.start()
+        child_conn.close()
+
+        try:
+            succeeded, error = _receive(conn)
+        except EOFError:
+            succeeded, error = False, "inference process exited while loading the model"
+        if not succeeded:
+            conn.close()
+            process.join()
+            raise RuntimeError(error)
+
+        logger.info("started inference process %s for %s", process.pid, self.demo_model.predictor_name)
+        self._processes[conn] = process
+        self._idle.put(conn)
+
+
+def _receive(conn: Connection) -> Any:
+    # Wait cooperatively, so other greenlets can run while the other end is busy.
+    wait_read(conn.fileno())
+    return conn.recv()
+
+def _serve_predictions(demo_model: DemoModel, quantized: bool, conn: Connection) -> None:
+    """
+    The body of an inference process: load the model, then make predictions until the pipe closes.
+    Replies are ``(True, result)`` or ``(False, error message)``.
+    """
+    try:
+        predictor = demo_model.predictor(quantized=quantized)
+        share_preprocessing(predictor)
+    except Exception as error:  # pylint: disable=broad-except
+        logger.exception("unable to load model")
+        conn.send((False, repr(error)))
+        return
+    conn.send((True, None))
+
+    while True:
+        try:
+            method, inputs = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            if method == "predict_batch_json":
+                preprocess_batch(predictor, inputs)
+            conn.send((True, getattr(predictor, method)(inputs)))
+        except Exception as error:  # pylint: disable=broad-except
+            logger.exception("prediction failed")
+            conn.send((False, repr(error)))
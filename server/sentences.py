@@ -0,0 +1,23 @@
+"""
+Splitting inputs into sentences, so that they can be predicted (and cached) a sentence at a time.
+"""
+from typing import List
+import threading
+
+from spacy.lang.en import English
+
+_sentencizer = None
+_lock = threading.Lock()
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Splits ``text`` into sentences, using spaCy's rule-based sentencizer,
+    which is much cheaper than parsing the text to find them.
+    """
+    global _sentencizer  # pylint: disable=global-statement
+    with _lock:
+        if _sentencizer is None:
+            _sentencizer = English()
+            _sentencizer.add_pipe(_sentencizer.create_pipe("sentencizer"))
+    return [sentence.text for sentence in _sentencizer(text).sents if sentence.text.strip()]
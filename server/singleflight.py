@@ -0,0 +1,92 @@
+"""
+Coalescing identical work that's in progress at the same time.
+"""
+from typing import Any, Callable, Dict, Tuple
+import threading
+
+from allennlp.common.util import JsonDict
+
+
+class Flight:
+    """
+    One piece of work in progress, which any number of callers can wait for.
+    """
+    def __init__(self) -> None:
+        self.result: Any = None
+        self.error: BaseException = None
+        self._done = threading.Event()
+
+    def finish(self, result: Any = None, error: BaseException = None) -> None:
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self) -> Any:
+        """
+        Returns the result of the work, or raises the error it failed with.
+        """
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """
+    Makes concurrent callers doing the same work (as identified by a key) share a single execution
+    of it: the first caller (the leader) does the work, and any others that turn up before it's
+    finished (the followers) wait for its result rather than doing the work again.
+    Once the work is finished, the next caller with that key starts afresh.
+    """
+    def __init__(self) -> None:
+        self.led = 0
+        self.coalesced = 0
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, work: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Returns the result of ``work``, done either by this caller or by another one with the same key,
+        and whether it was shared with another caller.
+        """
+        flight, leading = self.claim(key)
+        if not leading:
+            return flight.wait(), True
+
+        try:
+            result = work()
+        except BaseException as error:
+            self.fail(key, error)
+            raise
+        self.resolve(key, result)
+        return result, False
+
+    def claim(self, key: str) -> Tuple[Flight, bool]:
+        """
+        Returns the flight for the given key, and whether the caller is its leader. A leader must
+        eventually call ``resolve`` or ``fail``, or its followers will wait forever.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.led += 1
+            return flight, True
+
+    def resolve(self, key: str, result: Any) -> None:
+        with self._lock:
+            flight = self._flights.pop(key)
+        flight.finish(result=result)
+
+    def fail(self, key: str, error: BaseException) -> None:
+        with self._lock:
+            flight = self._flights.pop(key)
+        flight.finish(error=error)
+
+    def stats(self) -> JsonDict:
+        with self._lock:
+            return {"in_flight": len(self._flights),
+                    "led": self.led,
+                    "coalesced": self.coalesced}
@@ -0,0 +1,122 @@
+"""
+Serving the demo's static build from memory.
+"""
+from typing import Dict, Optional
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+
+from flask import Request, Response
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+# Files smaller than this (in bytes) aren't worth compressing.
+MIN_COMPRESS_BYTES = 1024
+
+# The bundles that the build puts under static/ have a hash of their contents in the name
+# (e.g. static/js/main.1a2b3c4d.js), so a given URL always has the same contents.
+HASHED_NAME = re.compile(r"^static/.+\.[0-9a-f]{8,}\.(chunk\.)?[a-z0-9]+$")
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Everything else (most importantly index.html) might change with the next deploy,
+# so clients have to check their copy is current, which the ETag makes cheap.
+REVALIDATE = "no-cache"
+
+# Content-Encoding -> file extension of a precompressed copy, in order of preference.
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+
+class StaticFile:
+    """
+    The contents of one file from the build, along with
+    whichever compressed versions of it are smaller.
+    """
+    def __init__(self, path: str, content: bytes) -> None:
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.etag = hashlib.sha1(content).hexdigest()
+        self.cache_control = IMMUTABLE if HASHED_NAME.match(path) else REVALIDATE
+        self.variants: Dict[Optional[str], bytes] = {None: content}
+
+    def add_variant(self, encoding: str, content: bytes) -> None:
+        if len(content) < len(self.variants[None]):
+            self.variants[encoding] = content
+
+
+class StaticFiles:
+    """
+    An in-memory index of everything under ``build_dir``, read once at startup, so that serving
+    the demo's pages and bundles costs the server (which is busy running models) next to nothing.
+
+    Text files are compressed up front, with gzip and (if the ``brotli`` package is installed)
+    brotli, unless the build already has precompressed ``.gz`` or ``.br`` copies alongside them.
+    Each response uses the best encoding the client accepts, and carries an ``ETag``.
+    Changes to ``build_dir`` aren't noticed until the server restarts.
+    """
+    def __init__(self, build_dir: str) -> None:
+        self.files: Dict[str, StaticFile] = {}
+
+        for root, _, names in os.walk(build_dir):
+            for name in names:
+                full_path = os.path.join(root, name)
+                path = os.path.relpath(full_path, build_dir).replace(os.sep, "/")
+                with open(full_path, "rb") as contents:
+                    self.files[path] = StaticFile(path, contents.read())
+
+        for path, static_file in self.files.items():
+            for encoding, extension in ENCODINGS.items():
+                precompressed = self.files.get(path + extension)
+                if precompressed is not None:
+                    static_file.add_variant(encoding, precompressed.variants[None])
+                elif _compressible(static_file):
+                    static_file.add_variant(encoding, _compress(encoding, static_file.variants[None]))
+
+        logger.info("serving %s static files from memory (%.1f MB)", len(self.files),
+                    sum(len(variant) for static_file in self.files.values()
+                        for variant in static_file.variants.values()) / 1024 / 1024)
+
+    def response(self, path: str, request: Request) -> Response:
+        """
+        Returns the given file, as the smallest variant ``request`` accepts,
+        or a 304 if the client's copy is current. Raises ``NotFound`` if there's no such file.
+        """
+        static_file = self.files.get(path)
+        if static_file is None:
+            raise NotFound()
+
+        encoding = next((encoding for encoding in ENCODINGS
+                         if encoding in static_file.variants and request.accept_encodings[encoding]), None)
+
+        response = Response(static_file.variants[encoding], mimetype=static_file.mimetype)
+        response.headers["Cache-Control"] = static_file.cache_control
+        if len(static_file.variants) > 1:
+            response.headers["Vary"] = "Accept-Encoding"
+        if encoding is None:
+            response.set_etag(static_file.etag)
+        else:
+            response.headers["Content-Encoding"] = encoding
+            # Each encoding is a different representation, so it needs an ETag of its own.
+            response.set_etag("{}-{}".format(static_file.etag, encoding))
+        return response.make_conditional(request)
+
+
+def _compressible(static_file: StaticFile) -> bool:
+    mimetype = static_file.mimetype
+    return (len(static_file.variants[None]) >= MIN_COMPRESS_BYTES and
+            (mimetype.startswith("text/") or mimetype.endswith(("javascript", "json", "xml"))))
+
+def _compress(encoding: str, content: bytes) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=9)
+    elif encoding == "br" and brotli is not None:
+        return brotli.compress(content)
+    else:
+        return content
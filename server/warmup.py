@@ -0,0 +1,81 @@
+"""
+Filling the prediction cache before users ask for anything.
+"""
+from typing import Callable, Dict, List
+import logging
+import threading
+import time
+
+from allennlp.common.util import JsonDict
+
+logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+
+class CacheWarmup:
+    """
+    Precomputes the predictions users are most likely to ask for (usually the demo's canned
+    examples) in the background, so the first users after a deploy get cache hits.
+
+    ``top_inputs(model_name)`` says what to precompute for each model, and ``warm(model_name, inputs)``
+    makes and caches one prediction, returning ``False`` if it was already cached.
+    Until a ``threshold`` fraction of the predictions have been made, the warm-up isn't ``ready``.
+    """
+    def __init__(self,
+                 top_inputs: Callable[[str], List[JsonDict]],
+                 warm: Callable[[str, JsonDict], bool],
+                 threshold: float = 0.0) -> None:
+        self.top_inputs = top_inputs
+        self.warm = warm
+        self.threshold = threshold
+        self.total = 0
+        self.done = 0
+        self.computed = 0
+        self.failed = 0
+        self.started = False
+        self.finished = False
+        self.seconds = None
+
+    def start(self, model_names: List[str]) -> None:
+        """
+        Starts warming up the cache for the given models, which should already be loaded.
+        """
+        self.started = True
+        threading.Thread(target=self._run, args=(model_names,), daemon=True).start()
+
+    def ready(self) -> bool:
+        if self.threshold <= 0 or self.finished:
+            return True
+        return self.started and self.total > 0 and self.done >= self.threshold * self.total
+
+    def stats(self) -> JsonDict:
+        return {"total": self.total,
+                "done": self.done,
+                "computed": self.computed,
+                "failed": self.failed,
+                "finished": self.finished,
+                "seconds": self.seconds}
+
+    def _run(self, model_names: List[str]) -> None:
+        start = time.time()
+        inputs: Dict[str, List[JsonDict]] = {}
+        for name in model_names:
+            try:
+                inputs[name] = self.top_inputs(name)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("unable to find inputs to warm up %s with", name)
+        self.total = sum(len(model_inputs) for model_inputs in inputs.values())
+        logger.info("warming up the cache with %s predictions", self.total)
+
+        for name, model_inputs in inputs.items():
+            for data in model_inputs:
+                try:
+                    if self.warm(name, data):
+                        self.computed += 1
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("unable to warm up %s with %s", name, data)
+                    self.failed += 1
+                self.done += 1
+
+        self.seconds = round(time.time() - start, 3)
+        self.finished = True
+        logger.info("warmed up the cache with %s new predictions in %.1fs", self.computed, self.seconds)
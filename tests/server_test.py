@@ -1,20 +1,37 @@
 # pylint: disable=no-self-use,invalid-name
 import copy
+import gzip
+import io
 import json
 import os
 import pathlib
+import tarfile
 import tempfile
+import threading
+import time
 from collections import defaultdict
+from typing import Dict, List, Optional
 
 from flask import Response
+import psycopg2
+import pytest
 
 from allennlp.common.util import JsonDict
 from allennlp.common.testing import AllenNlpTestCase
 from allennlp.models.archival import load_archive
 from allennlp.service.predictors import Predictor
-from allennlp.service.db import InMemoryDemoDatabase
 
+from server.admission import AdmissionController
 from server.app import make_app
+from server.cache import InMemoryPredictionCache, SqlitePredictionCache
+from server import db as demo_db
+from server.db import ConnectionPool, InMemoryDemoDatabase, PostgresDemoDatabase
+from server.loader import ModelLoader
+from server.models import MODELS, DemoModel, load_extracted, quantization_available
+from server.prediction_log import PredictionLog
+from server.preprocessing import DocumentCache, preprocess_batch, share_preprocessing
+from server.prefork import _reap, memory_sharing
+from server.process_pool import InferenceProcessPool
 
 TEST_ARCHIVE_FILES = {
         'machine-comprehension': 'tests/fixtures/bidaf/model.tar.gz',
@@ -43,6 +60,192 @@ class CountingPredictor(Predictor):
         self.calls[key] += 1
         return copy.deepcopy(inputs)
 
+class BatchRecordingPredictor(CountingPredictor):
+    """
+    bogus predictor that also records the size of every batch it's asked to run
+    """
+    # pylint: disable=abstract-method
+    def __init__(self):
+        super().__init__()
+        self.batches: List[int] = []
+
+    def predict_json(self, inputs: JsonDict) -> JsonDict:
+        self.batches.append(1)
+        return super().predict_json(inputs)
+
+    def predict_batch_json(self, inputs: List[JsonDict]) -> List[JsonDict]:
+        self.batches.append(len(inputs))
+        return [super(BatchRecordingPredictor, self).predict_json(instance) for instance in inputs]
+
+class BlockingPredictor(CountingPredictor):
+    """
+    bogus predictor that doesn't return until it's released
+    """
+    # pylint: disable=abstract-method
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def predict_json(self, inputs: JsonDict) -> JsonDict:
+        self.started.set()
+        self.release.wait()
+        return super().predict_json(inputs)
+
+class TaggingPredictor(BatchRecordingPredictor):
+    """
+    bogus predictor that tags every word of its sentence with its length
+    """
+    # pylint: disable=abstract-method
+    def predict_json(self, inputs: JsonDict) -> JsonDict:
+        self.batches.append(1)
+        return self.tag(inputs)
+
+    def predict_batch_json(self, inputs: List[JsonDict]) -> List[JsonDict]:
+        self.batches.append(len(inputs))
+        return [self.tag(instance) for instance in inputs]
+
+    def tag(self, inputs: JsonDict) -> JsonDict:
+        self.calls[inputs["sentence"]] += 1
+        words = inputs["sentence"].split()
+        return {"words": words, "tags": [str(len(word)) for word in words]}
+
+class BlockingDemoModel(DemoModel):
+    """
+    bogus demo model that doesn't finish loading until it's released
+    """
+    def __init__(self, release: threading.Event):
+        super().__init__("", "")
+        self.release = release
+
+    def predictor(self, quantized: bool = False) -> Predictor:
+        self.release.wait()
+        return PREDICTORS["textual-entailment"]
+
+class LoadCountingDemoModel(DemoModel):
+    """
+    bogus demo model that counts how many times it's been loaded
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loads = 0
+
+    def predictor(self, quantized: bool = False) -> Predictor:
+        self.loads += 1
+        return super().predictor(quantized)
+
+class FakePostgres:
+    """
+    bogus stand-in for the demo's Postgres database, which understands just
+    the queries that ``PostgresDemoDatabase`` makes
+    """
+    def __init__(self):
+        self.rows: Dict[int, Dict] = {}
+        self.next_id = 1
+        self.batches: List[int] = []
+        self.connections = 0
+        self.fail = False
+        # Batch inserts made by this thread wait for ``release``.
+        self.held_thread: Optional[threading.Thread] = None
+        self.batch_started = threading.Event()
+        self.release = threading.Event()
+
+    def connect(self) -> 'FakeConnection':
+        if self.fail:
+            raise psycopg2.OperationalError("database is down")
+        self.connections += 1
+        return FakeConnection(self)
+
+    def insert(self, rows: List[Dict], count_hits: bool = False) -> List[tuple]:
+        hashes = {row['content_hash']: row for row in self.rows.values()}
+        inserted = []
+        for row in rows:
+            if row['content_hash'] is not None and row['content_hash'] in hashes:
+                if count_hits:
+                    hashes[row['content_hash']]['hits'] += 1
+                    inserted.append((hashes[row['content_hash']]['id'],))
+                continue
+            row = dict(row)
+            if 'id' not in row:
+                row['id'] = self.next_id
+                self.next_id += 1
+            self.rows[row['id']] = row
+            inserted.append((row['id'],))
+        return inserted
+
+class FakeConnection:
+    encoding = "UTF8"
+
+    def __init__(self, database: FakePostgres):
+        self.database = database
+        self.closed = False
+
+    def cursor(self) -> 'FakeCursor':
+        return FakeCursor(self)
+
+    def close(self) -> None:
+        self.closed = True
+
+class FakeCursor:
+    def __init__(self, connection: FakeConnection):
+        self.connection = connection
+        self.results: List[tuple] = []
+        self.values: List[Dict] = []
+
+    def __enter__(self) -> 'FakeCursor':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def mogrify(self, template, values) -> bytes:  # pylint: disable=unused-argument
+        # ``execute_values`` builds up a multi-row statement this way.
+        self.values.append(values)
+        return b"(row)"
+
+    def execute(self, sql, params=None) -> None:
+        database = self.connection.database
+        if database.fail or self.connection.closed:
+            raise psycopg2.OperationalError("database is down")
+
+        if isinstance(sql, bytes) and sql.lstrip().startswith(b"UPDATE"):
+            hits, self.values = self.values, []
+            for perma_id, count in hits:
+                database.rows[perma_id]['hits'] += count
+        elif isinstance(sql, bytes):
+            rows, self.values = self.values, []
+            database.batches.append(len(rows))
+            if threading.current_thread() is database.held_thread:
+                database.batch_started.set()
+                database.release.wait()
+            self.results = database.insert(rows)
+        elif sql == demo_db.RESERVE_IDS_SQL:
+            self.results = [(database.next_id + i,) for i in range(params[0])]
+            database.next_id += params[0]
+        elif sql == demo_db.INSERT_SQL:
+            self.results = database.insert([params], count_hits=True)
+        elif sql == demo_db.FIND_BY_CONTENT_SQL:
+            self.results = [(row['id'],) for row in database.rows.values() if row['content_hash'] == params[0]]
+        elif sql == demo_db.RETRIEVE_SQL:
+            row = database.rows.get(params[0])
+            self.results = [] if row is None else [(row['model_name'], row['request_data'], row['response_data'])]
+        else:
+            self.results = [(1,)]
+
+    def fetchone(self) -> Optional[tuple]:
+        return self.results[0] if self.results else None
+
+    def fetchall(self) -> List[tuple]:
+        return self.results
+
+class FakePostgresDemoDatabase(PostgresDemoDatabase):
+    def __init__(self, database: FakePostgres, **kwargs):
+        self.database = database
+        super().__init__("demo", "localhost", "5432", "demo", "password", **kwargs)
+
+    def _connect(self) -> FakeConnection:
+        return self.database.connect()
+
 class TestFlask(AllenNlpTestCase):
     client = None
 
@@ -59,6 +262,13 @@ class TestFlask(AllenNlpTestCase):
             self.app.testing = True
             self.client = self.app.test_client()
 
+    def add_demo_model(self, name: str, demo_model: DemoModel) -> None:
+        """
+        Adds the model to ``MODELS``, so that the server uses its settings, until the end of the test.
+        """
+        MODELS[name] = demo_model
+        self.addCleanup(MODELS.pop, name)
+
     def post_json(self, endpoint: str, data: JsonDict) -> Response:
         return self.client.post(endpoint,
                                 content_type="application/json",
@@ -149,12 +359,277 @@ class TestFlask(AllenNlpTestCase):
             assert predictor.calls[json.dumps(noyes)] == 1
             assert len(predictor.calls) == 2
 
+    def test_caching_ignores_key_order(self):
+        predictor = CountingPredictor()
+        self.app.predictors["counting"] = predictor
+
+        response = self.post_json("/predict/counting", data={"first": 1, "second": 2})
+        assert response.status_code == 200
+        response = self.client.post("/predict/counting",
+                                    content_type="application/json",
+                                    data='{"second": 2, "first": 1}')
+        assert response.status_code == 200
+        assert json.loads(response.get_data()) == {"first": 1, "second": 2}
+
+        # the second request differs only in key order, so it should have come from the cache
+        assert sum(predictor.calls.values()) == 1
+
+    def test_sqlite_cache(self):
+        path = str(self.TEST_DIR / 'cache.sqlite')
+        cache = SqlitePredictionCache(path, max_bytes=10)
+        cache.put("a", b"aaaa")
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        # replacing an entry doesn't count it twice
+        assert cache.stats()["bytes"] == 8
+        assert cache.get("a") == b"aaaa"
+
+        # "b" is the least recently used, so it goes
+        cache.put("c", b"cccc")
+        assert cache.get("b") is None
+        assert cache.stats()["bytes"] == 8
+
+        # another process sharing the file sees the same total
+        assert SqlitePredictionCache(path, max_bytes=10).stats()["bytes"] == 8
+
+    def test_cache_revalidation(self):
+        predictor = CountingPredictor()
+        self.app.predictors["counting"] = predictor
+        data = {"revalidate": "me"}
+
+        response = self.post_json("/predict/counting", data=data)
+        assert response.status_code == 200
+        etag = response.headers.get("ETag")
+        assert etag is not None
+
+        # a cache hit should carry the same ETag
+        response = self.post_json("/predict/counting", data=data)
+        assert response.status_code == 200
+        assert response.headers.get("ETag") == etag
+        assert json.loads(response.get_data()) == data
+
+        # a POST can't be answered with a 304, so it gets the (cached) result regardless
+        response = self.client.post("/predict/counting",
+                                    content_type="application/json",
+                                    data=json.dumps(data),
+                                    headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert json.loads(response.get_data()) == data
+        assert predictor.calls[json.dumps(data)] == 1
+
+    def test_response_compression(self):
+        self.app.predictors["counting"] = CountingPredictor()
+        data = {"words": ["buffalo"] * 1000}
+
+        # big responses come compressed, if the client accepts that ...
+        response = self.client.post("/predict/counting",
+                                    content_type="application/json",
+                                    data=json.dumps(data),
+                                    headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert json.loads(gzip.decompress(response.get_data()).decode('utf-8')) == data
+
+        # ... with an ETag of their own
+        compressed_etag = response.headers["ETag"]
+
+        # and small ones, or ones for clients that don't, aren't
+        response = self.post_json("/predict/counting", data=data)
+        assert "Content-Encoding" not in response.headers
+        assert json.loads(response.get_data()) == data
+        assert response.headers["ETag"] != compressed_etag
+
+        response = self.client.post("/predict/counting",
+                                    content_type="application/json",
+                                    data=json.dumps({"small": "input"}),
+                                    headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in response.headers
+
+    def test_field_selection(self):
+        predictor = CountingPredictor()
+        self.add_demo_model("projecting", DemoModel("", "", default_fields=["keep"]))
+        self.app.predictors["projecting"] = predictor
+        data = {"keep": "me", "drop": "me"}
+
+        # by default, only the model's default fields come back
+        response = self.post_json("/predict/projecting", data=data)
+        assert json.loads(response.get_data()) == {"keep": "me"}
+
+        # but the request can ask for others, which aren't answered from the trimmed cache entry
+        response = self.post_json("/predict/projecting?fields=drop", data=data)
+        assert json.loads(response.get_data()) == {"drop": "me"}
+        response = self.post_json("/predict/projecting?fields=*", data=data)
+        assert json.loads(response.get_data()) == data
+        assert predictor.calls[json.dumps(data)] == 3
+
+        response = self.post_json("/predict/projecting?fields=drop", data=data)
+        assert json.loads(response.get_data()) == {"drop": "me"}
+        assert predictor.calls[json.dumps(data)] == 3
+
+    def test_sentence_cache(self):
+        predictor = TaggingPredictor()
+        self.add_demo_model("tagging",
+                            DemoModel("", "", merge_sentences=MODELS["named-entity-recognition"].merge_sentences))
+        self.app.predictors["tagging"] = predictor
+
+        response = self.post_json("/predict/tagging", data={"sentence": "One two. Three four five."})
+        assert json.loads(response.get_data()) == {"words": ["One", "two.", "Three", "four", "five."],
+                                                   "tags": ["3", "4", "5", "4", "5"]}
+        # both sentences were predicted together
+        assert predictor.batches == [2]
+
+        # editing one sentence only predicts that one again
+        response = self.post_json("/predict/tagging", data={"sentence": "One two. Six seven."})
+        assert json.loads(response.get_data()) == {"words": ["One", "two.", "Six", "seven."],
+                                                   "tags": ["3", "4", "3", "6"]}
+        assert predictor.batches == [2, 1]
+        assert predictor.calls == {"One two.": 1, "Three four five.": 1, "Six seven.": 1}
+
+    def test_quantized_variant(self):
+        full, quantized = CountingPredictor(), CountingPredictor()
+        self.add_demo_model("quantizable", DemoModel("", "", quantize=True))
+        self.app.predictors["quantizable"] = full
+        self.app.quantized["quantizable"] = quantized
+        data = {"some": "input"}
+
+        # each variant makes (and caches) its own predictions
+        for _ in range(2):
+            assert self.post_json("/predict/quantizable", data=data).status_code == 200
+            assert self.post_json("/predict/quantizable?variant=quantized", data=data).status_code == 200
+        assert full.calls[json.dumps(data)] == 1
+        assert quantized.calls[json.dumps(data)] == 1
+
+        assert self.post_json("/predict/quantizable?variant=bogus", data=data).status_code == 400
+        self.app.predictors["counting"] = CountingPredictor()
+        assert self.post_json("/predict/counting?variant=quantized", data=data).status_code == 400
+
+    def test_quantized_loading(self):
+        def demo_model(quantized_fraction: float) -> LoadCountingDemoModel:
+            return LoadCountingDemoModel(TEST_ARCHIVE_FILES["semantic-role-labeling"], "semantic-role-labeling",
+                                         quantize=True, quantized_fraction=quantized_fraction)
+
+        # the quantized variant isn't made until it's asked for ...
+        loader = ModelLoader({"srl": demo_model(0.0)}, {})
+        loader.load_all()
+        assert not loader.quantized
+        quantized = loader.load_quantized("srl")
+        assert loader.load_quantized("srl") is quantized
+
+        # ... unless some requests get it by default
+        eager_loader = ModelLoader({"srl": demo_model(0.5)}, {})
+        eager_loader.load_all()
+        assert ("srl" in eager_loader.quantized) == quantization_available()
+
+        # either way, it's a copy of the loaded model, rather than the model loaded again
+        for each_loader in [loader, eager_loader]:
+            assert each_loader.models["srl"].loads == 1
+            if quantization_available():
+                assert each_loader.quantized["srl"] is not each_loader.predictors["srl"]
+            else:
+                assert each_loader.load_quantized("srl") is None
+
+    @pytest.mark.skipif(not quantization_available(), reason="quantization needs PyTorch 1.3 or later")
+    def test_quantize(self):
+        demo_model = DemoModel(TEST_ARCHIVE_FILES["semantic-role-labeling"], "semantic-role-labeling",
+                               quantize=True)
+        full = demo_model.predictor()
+        quantized = demo_model.quantized_predictor(full)
+
+        def quantized_modules(predictor: Predictor) -> List[str]:
+            modules = predictor._model.modules()  # pylint: disable=protected-access
+            return [type(module).__name__ for module in modules if "quantized" in type(module).__module__]
+
+        # the copy's linear layers are quantized, and the original's are left alone
+        assert "Linear" in quantized_modules(quantized)
+        assert not quantized_modules(full)
+
+        data = {"sentence": "The squirrel wrote a unit test to make sure its nuts worked as designed."}
+        assert quantized.predict_json(data)["words"] == full.predict_json(data)["words"]
+
+    def test_prediction_log(self):
+        self.add_demo_model("logged",
+                            DemoModel("", "", log_outputs=lambda prediction: {"first": prediction["first"]}))
+        self.addCleanup(setattr, self.app, "prediction_log", self.app.prediction_log)
+        self.app.predictors["logged"] = CountingPredictor()
+        stream = io.StringIO()
+        self.app.prediction_log = PredictionLog(stream=stream)
+
+        self.post_json("/predict/logged", data={"first": 1, "second": 2})
+        self.post_json("/predict/logged", data={"first": 1, "second": 2})
+        self.app.prediction_log.flush()
+
+        # only the interesting parts of new predictions are logged
+        entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [entry["outputs"] for entry in entries] == [{"first": 1}, {}]
+        assert [entry["cached"] for entry in entries] == [False, True]
+
+        # closing the log writes whatever is still queued, and stops it
+        self.post_json("/predict/logged", data={"first": 2})
+        self.app.prediction_log.close()
+        assert len(stream.getvalue().splitlines()) == 3
+        self.app.prediction_log.log({"too": "late"})
+        assert len(stream.getvalue().splitlines()) == 3
+
+        # and none at all are, if they're not sampled
+        self.app.prediction_log = PredictionLog(sample_rate=0.0, stream=stream)
+        self.post_json("/predict/logged", data={"first": 3})
+        self.app.prediction_log.flush()
+        assert len(stream.getvalue().splitlines()) == 3
+        self.app.prediction_log.close()
+
+    def test_cache_warmup(self):
+        db = InMemoryDemoDatabase()
+        app = make_app(build_dir=self.TEST_DIR, demo_db=db)
+        app.predictors = {"counting": CountingPredictor()}
+        app.testing = True
+        client = app.test_client()
+        for data in [{"popular": True}, {"popular": True}, {"popular": False}]:
+            client.post("/predict/counting", content_type="application/json", data=json.dumps(data))
+        # the popular input is only stored once, but the repeat is still counted
+        assert len(db.data) == 2
+        assert db.top_inputs("counting", 2) == [{"popular": True}, {"popular": False}]
+
+        # a new server warms up its cache with what's been asked for before
+        predictor = CountingPredictor()
+        app = make_app(build_dir=self.TEST_DIR, demo_db=db, cache=InMemoryPredictionCache(max_bytes=1024 * 1024))
+        app.predictors = {"counting": predictor}
+        app.testing = True
+        client = app.test_client()
+        app.warmup.start(["counting"])
+        for _ in range(100):
+            if app.warmup.finished:
+                break
+            time.sleep(0.1)
+        assert app.warmup.stats()["computed"] == 2
+
+        response = client.post("/predict/counting?record=false",
+                               content_type="application/json",
+                               data=json.dumps({"popular": True}))
+        assert json.loads(response.get_data()) == {"popular": True}
+        assert sum(predictor.calls.values()) == 2
+
+        # and a saved cache can be loaded back
+        snapshot = str(self.TEST_DIR / "cache.snapshot")
+        cache = InMemoryPredictionCache(max_bytes=1024)
+        cache.put("key", b"value")
+        cache.save(snapshot)
+        restored = InMemoryPredictionCache(max_bytes=1024)
+        assert restored.load(snapshot) == 1
+        assert restored.get("key") == b"value"
+        assert sorted(path.name for path in self.TEST_DIR.glob("cache.snapshot*")) == ["cache.snapshot"]
+
+        # but a damaged one is ignored
+        pathlib.Path(snapshot).write_bytes(pathlib.Path(snapshot).read_bytes()[:-1])
+        assert InMemoryPredictionCache(max_bytes=1024).load(snapshot) == 0
+
     def test_disable_caching(self):
-        import allennlp.service.server_flask as server
+        import server.app as server
+        cache_size = server.CACHE_SIZE
         server.CACHE_SIZE = 0
 
         predictor = CountingPredictor()
         app = server.make_app(build_dir=self.TEST_DIR)
+        server.CACHE_SIZE = cache_size
         app.predictors = {"counting": predictor}
         app.testing = True
         client = app.test_client()
@@ -175,6 +650,419 @@ class TestFlask(AllenNlpTestCase):
             assert predictor.calls[key] == i + 1
             assert len(predictor.calls) == 1
 
+    def test_batching(self):
+        predictor = BatchRecordingPredictor()
+        self.add_demo_model("batching", DemoModel("", "", max_batch_size=4, batch_window_ms=200))
+        app = make_app(build_dir=self.TEST_DIR)
+        app.predictors = {"batching": predictor}
+        app.testing = True
+        client = app.test_client()
+
+        responses = {}
+
+        def post(i: int) -> None:
+            responses[i] = client.post("/predict/batching?cache=false",
+                                       content_type="application/json",
+                                       data=json.dumps({"input": i}))
+
+        threads = [threading.Thread(target=post, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Every caller should get back its own result ...
+        for i, response in responses.items():
+            assert response.status_code == 200
+            assert json.loads(response.get_data()) == {"input": i}
+
+        # ... even though the predictor only ran once.
+        assert predictor.batches == [4]
+
+        response = client.get("/info")
+        assert json.loads(response.get_data())["batch_sizes"]["batching"] == {"4": 1}
+
+    def test_lazy_loading(self):
+        app = make_app(build_dir=self.TEST_DIR)
+        app.loader = ModelLoader({"machine-comprehension": DemoModel(TEST_ARCHIVE_FILES["machine-comprehension"],
+                                                                     "machine-comprehension")},
+                                 app.predictors)
+        app.testing = True
+        client = app.test_client()
+
+        # nothing has been loaded, but the model is still available
+        assert not app.predictors
+        assert json.loads(client.get("/models").get_data())["models"] == ["machine-comprehension"]
+        assert client.get("/ready").status_code == 200
+
+        response = client.post("/predict/machine-comprehension",
+                               content_type="application/json",
+                               data=json.dumps({"passage": "the super bowl was played in seattle",
+                                                "question": "where was the super bowl played?"}))
+        assert response.status_code == 200
+        assert "best_span" in json.loads(response.get_data())
+
+        # the first request should have loaded it
+        assert "machine-comprehension" in app.predictors
+        status = json.loads(client.get("/info").get_data())["models"]["machine-comprehension"]
+        assert status["state"] == "loaded"
+        assert status["load_seconds"] is not None
+
+    def test_ready_waits_for_queued_models(self):
+        release = threading.Event()
+        loader = ModelLoader({"first": BlockingDemoModel(release), "second": BlockingDemoModel(release)},
+                             {},
+                             num_threads=1)
+        assert loader.ready()
+
+        # one model is loading and the other is waiting its turn, and neither is ready
+        loader.load_all(wait=False)
+        assert not loader.ready()
+        assert {status["state"] for status in loader.info().values()} <= {"queued", "loading"}
+        assert "queued" in {status["state"] for status in loader.info().values()}
+
+        release.set()
+        loader.load_all()
+        assert loader.ready()
+        assert {status["state"] for status in loader.info().values()} == {"loaded"}
+
+    def test_memory_sharing(self):
+        sharing = memory_sharing(smaps_path='tests/fixtures/smaps_rollup')
+        assert sharing == {"rss_mb": 2048.0, "pss_mb": 1126.4, "shared_mb": 1843.2, "private_mb": 204.8}
+        assert memory_sharing(smaps_path=str(self.TEST_DIR / 'missing')) is None
+
+    def test_worker_restarts(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(1)  # pylint: disable=protected-access
+
+        workers = {pid: 3, pid + 1000000: 4}
+        respawned: List[int] = []
+        for _ in range(100):
+            if pid not in workers:
+                break
+            if not _reap(workers, respawned.append):
+                time.sleep(0.1)
+
+        # the worker that died is replaced by one with the same index, and the others are left alone
+        assert respawned == [3]
+        assert workers == {pid + 1000000: 4}
+
+    def test_shared_preprocessing(self):
+        documents = DocumentCache(max_tokens=4)
+        predictor = Predictor.from_archive(load_archive(TEST_ARCHIVE_FILES["semantic-role-labeling"]),
+                                           predictor_name="semantic-role-labeling")
+        assert share_preprocessing(predictor, documents)
+
+        data = {"sentence": "The squirrel wrote a unit test to make sure its nuts worked as designed."}
+        assert predictor.predict_json(data) == predictor.predict_json(data)
+        stats = documents.stats()
+        assert (stats["hits"], stats["misses"]) == (1, 1)
+
+        # batches are processed together, and only the most recent documents are kept
+        preprocess_batch(predictor, [{"sentence": "One.", "verb": "ignored"}, {"sentence": "Two."},
+                                     {"sentence": "Three."}])
+        stats = documents.stats()
+        assert (stats["documents"], stats["tokens"]) == (2, 4)
+        # (prefetching doesn't count as a hit or a miss ...
+        assert (stats["hits"], stats["misses"]) == (1, 1)
+
+        # ... but the first lookup of a prefetched document counts as the miss it would have been)
+        predictor.predict_json({"sentence": "Three."})
+        predictor.predict_json({"sentence": "Three."})
+        stats = documents.stats()
+        assert (stats["hits"], stats["misses"]) == (2, 2)
+
+    def test_model_store(self):
+        demo_model = DemoModel(TEST_ARCHIVE_FILES["textual-entailment"], "textual-entailment")
+        assert not demo_model.extracted(str(self.TEST_DIR))
+
+        path = demo_model.extract(str(self.TEST_DIR))
+        assert demo_model.extracted(str(self.TEST_DIR))
+        # extracting again leaves it alone
+        assert demo_model.extract(str(self.TEST_DIR)) == path
+
+        predictor = Predictor.from_archive(load_extracted(path), "textual-entailment")
+        data = {"premise": "Two women are wandering along the shore.",
+                "hypothesis": "Two people are walking."}
+        assert predictor.predict_json(data) == PREDICTORS["textual-entailment"].predict_json(data)
+
+    def test_model_store_bundled_files(self):
+        # an archive that bundles a file, as the ELMo models do with their weights
+        unpacked = self.TEST_DIR / "bundled"
+        with tarfile.open(TEST_ARCHIVE_FILES["textual-entailment"], "r:gz") as archive:
+            archive.extractall(str(unpacked))
+        key = "model.text_field_embedder.tokens.pretrained_file"
+        (unpacked / "files_to_archive.json").write_text(json.dumps({key: "s3://somewhere/glove.txt.gz"}))
+        (unpacked / "fta").mkdir()
+        (unpacked / "fta" / key).write_text("")
+        archive_file = str(self.TEST_DIR / "bundled.tar.gz")
+        with tarfile.open(archive_file, "w:gz") as archive:
+            for name in os.listdir(str(unpacked)):
+                archive.add(str(unpacked / name), arcname=name)
+
+        def bundled_file(config) -> str:
+            return config.as_dict()["model"]["text_field_embedder"]["tokens"]["pretrained_file"]
+
+        # the extracted model's config points at the bundled copy, just like the archive's does
+        path = DemoModel(archive_file, "textual-entailment").extract(str(self.TEST_DIR / "store"))
+        assert bundled_file(load_extracted(path).config) == os.path.join(path, "fta", key)
+        assert bundled_file(load_archive(archive_file).config).endswith(os.path.join("fta", key))
+
+    def test_process_pool(self):
+        pool = InferenceProcessPool(DemoModel(TEST_ARCHIVE_FILES["textual-entailment"], "textual-entailment"), 1)
+        app = make_app(build_dir=self.TEST_DIR)
+        app.predictors = {"textual-entailment": pool}
+        app.testing = True
+        client = app.test_client()
+
+        response = client.post("/predict/textual-entailment",
+                               content_type="application/json",
+                               data=json.dumps({"premise": "the super bowl was played in seattle",
+                                                "hypothesis": "the super bowl was played in ohio"}))
+        assert response.status_code == 200
+        assert "label_probs" in json.loads(response.get_data())
+
+    def test_process_pool_gives_up_on_dead_processes(self):
+        pool = InferenceProcessPool(DemoModel(TEST_ARCHIVE_FILES["textual-entailment"], "textual-entailment"), 1)
+        pool.RESPAWN_ATTEMPTS = 2
+        pool.RESPAWN_DELAY = 0.0
+        pool.start()
+
+        # the process dies, and its replacement can't load the model
+        pool.demo_model = DemoModel(str(self.TEST_DIR / "missing.tar.gz"), "textual-entailment")
+        for process in list(pool._processes.values()):  # pylint: disable=protected-access
+            process.terminate()
+            process.join()
+        with pytest.raises(RuntimeError, match="died"):
+            pool.predict_json({"premise": "a", "hypothesis": "b"})
+
+        # so once it's given up, predictions fail rather than waiting forever (every time)
+        for _ in range(2):
+            with pytest.raises(RuntimeError, match="no inference processes left"):
+                pool.predict_json({"premise": "a", "hypothesis": "b"})
+
+    def test_process_pool_loading(self):
+        models = {"entailment": DemoModel(TEST_ARCHIVE_FILES["textual-entailment"], "textual-entailment",
+                                          processes=2),
+                  "broken": DemoModel(str(self.TEST_DIR / "missing.tar.gz"), "textual-entailment", processes=1)}
+        loader = ModelLoader(models, {}, num_workers=2)
+
+        # a server that's about to fork gets the pools ready, but leaves starting them to the workers,
+        # which share the processes out between them
+        loader.load_here()
+        assert {status["state"] for status in loader.info().values()} == {"starting"}
+        assert not loader.ready()
+        assert loader.predictors["entailment"].size == 1
+        assert loader.predictors["broken"].size == 1
+
+        # a model only counts as loaded once its processes have started
+        loader.start_processes()
+        assert loader.info()["entailment"]["state"] == "loaded"
+        assert loader.info()["broken"]["state"] == "failed"
+        assert "broken" not in loader.predictors
+
+        # the same goes for a model that's loaded on demand
+        loader = ModelLoader({"broken": models["broken"]}, {})
+        assert loader.load("broken") is None
+        assert loader.info()["broken"]["state"] == "failed"
+
+    def test_load_shedding(self):
+        predictor = BlockingPredictor()
+        self.add_demo_model("blocking", DemoModel("", "", max_concurrency=1, max_queue=0, retry_after=7))
+        app = make_app(build_dir=self.TEST_DIR)
+        app.predictors = {"blocking": predictor}
+        app.testing = True
+        client = app.test_client()
+
+        def post(data: JsonDict) -> Response:
+            return client.post("/predict/blocking", content_type="application/json", data=json.dumps(data))
+
+        # occupy the only slot
+        first = threading.Thread(target=post, args=({"first": True},))
+        first.start()
+        assert predictor.started.wait(10)
+
+        # so there's no room for anything else
+        response = post({"second": True})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "7"
+
+        predictor.release.set()
+        first.join()
+
+        stats = json.loads(client.get("/info").get_data())["admission"]["blocking"]
+        assert stats["admitted"] == 1
+        assert stats["shed"] == 1
+
+        # once the slot is free, requests are let through again
+        assert post({"third": True}).status_code == 200
+
+    def test_coalescing(self):
+        # (with or without the cache and the database)
+        for url in ["/predict/blocking", "/predict/blocking?cache=false&record=false"]:
+            predictor = BlockingPredictor()
+            app = make_app(build_dir=self.TEST_DIR)
+            app.predictors = {"blocking": predictor}
+            app.testing = True
+            client = app.test_client()
+            data = {"same": "input"}
+            responses = []
+
+            def post() -> None:
+                responses.append(client.post(url,  # pylint: disable=cell-var-from-loop
+                                             content_type="application/json",
+                                             data=json.dumps(data)))
+
+            # while the first request is being predicted ...
+            threads = [threading.Thread(target=post)]
+            threads[0].start()
+            assert predictor.started.wait(10)
+
+            # ... identical ones wait for its result rather than making their own
+            threads.extend(threading.Thread(target=post) for _ in range(3))
+            for thread in threads[1:]:
+                thread.start()
+            for _ in range(100):
+                if app.single_flight.stats()["coalesced"] == 3:
+                    break
+                time.sleep(0.1)
+            predictor.release.set()
+            for thread in threads:
+                thread.join()
+
+            assert [response.status_code for response in responses] == [200] * 4
+            assert all(json.loads(response.get_data()) == data for response in responses)
+            assert predictor.calls[json.dumps(data)] == 1
+            metrics = client.get("/metrics").get_data(as_text=True)
+            assert 'demo_predictions_coalesced_total{model="blocking"} 3' in metrics
+
+    def test_metrics(self):
+        predictor = CountingPredictor()
+        self.app.predictors["counting"] = predictor
+        data = {"measure": "me"}
+
+        for _ in range(2):
+            response = self.post_json("/predict/counting", data=data)
+            assert response.status_code == 200
+
+        response = self.client.get("/metrics")
+        assert response.status_code == 200
+        metrics = response.get_data(as_text=True)
+
+        # the first request missed the cache and the second one hit it
+        assert 'demo_cache_lookups_total{model="counting",result="hit"} 1' in metrics
+        assert 'demo_cache_lookups_total{model="counting",result="miss"} 1' in metrics
+        assert 'demo_prediction_seconds_count{model="counting"} 2' in metrics
+        assert 'demo_prediction_stage_seconds_count{model="counting",stage="inference"} 1' in metrics
+        assert 'demo_predictions_in_flight{model="counting"} 0' in metrics
+
+    def test_batch_endpoint(self):
+        predictor = BatchRecordingPredictor()
+        self.app.predictors["bulk"] = predictor
+
+        # one of the inputs is already in the cache
+        assert self.post_json("/predict/bulk", data={"input": 2}).status_code == 200
+        predictor.batches.clear()
+
+        lines = [json.dumps({"input": i}) for i in range(5)] + ["not json"]
+        response = self.client.post("/predict_batch/bulk?batch_size=2",
+                                    content_type="application/x-ndjson",
+                                    data="\n".join(lines) + "\n")
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert results[:5] == [{"input": i} for i in range(5)]
+        assert "error" in results[5]
+
+        # the cached input was skipped, and the rest went through in batches
+        assert predictor.batches == [2, 1, 1]
+
+        # a plain JSON list works too
+        response = self.post_json("/predict_batch/bulk", data=[{"input": 7}, {"input": 8}])
+        assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == \
+                [{"input": 7}, {"input": 8}]
+
+        assert self.post_json("/predict_batch/bulk", data={"input": 9}).status_code == 400
+        assert self.post_json("/predict_batch/bulk?batch_size=0", data=[]).status_code == 400
+
+    def test_batch_fallback_is_admitted(self):
+        admission = AdmissionController(1)
+        in_flight: List[int] = []
+
+        class UnbatchablePredictor(CountingPredictor):
+            # pylint: disable=abstract-method
+            def predict_json(self, inputs: JsonDict) -> JsonDict:
+                in_flight.append(admission.in_flight)
+                # another request takes the model's only slot as soon as this one gives it up
+                admission.in_flight += 1
+                return super().predict_json(inputs)
+
+            def predict_batch_json(self, inputs: List[JsonDict]) -> List[JsonDict]:
+                raise RuntimeError("batching is broken")
+
+        self.app.predictors["unbatchable"] = UnbatchablePredictor()
+        self.app.admission["unbatchable"] = admission
+        response = self.post_json("/predict_batch/unbatchable", data=[{"input": 1}, {"input": 2}])
+        results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        # the first input was retried on its own, but only once it had been admitted,
+        # and the second was shed rather than run over the limit
+        assert in_flight == [1]
+        assert results[0] == {"input": 1}
+        assert results[1] == {"error": "unbatchable is overloaded"}
+
+    def test_batch_survives_database_errors(self):
+        class BrokenDemoDatabase(InMemoryDemoDatabase):
+            def add_result(self, *args, **kwargs) -> Optional[int]:
+                raise RuntimeError("database is down")
+
+        app = make_app(build_dir=self.TEST_DIR, demo_db=BrokenDemoDatabase())
+        app.predictors = {"bulk": BatchRecordingPredictor()}
+        app.testing = True
+        response = app.test_client().post("/predict_batch/bulk", content_type="application/json",
+                                          data=json.dumps([{"input": 1}, {"input": 2}]))
+
+        # every prediction still comes back, just without a permalink
+        assert response.status_code == 200
+        assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == \
+                [{"input": 1}, {"input": 2}]
+
+    def test_static_files(self):
+        (self.TEST_DIR / 'index.html').write_text('<html>demo</html>')  # pylint: disable=no-member
+        bundle = 'console.log("hello");\n' * 100
+        (self.TEST_DIR / 'static' / 'js').mkdir(parents=True)  # pylint: disable=no-member
+        (self.TEST_DIR / 'static' / 'js' / 'main.0123abcd.js').write_text(bundle)  # pylint: disable=no-member
+        app = make_app(build_dir=self.TEST_DIR)
+        app.testing = True
+        client = app.test_client()
+
+        # the single page app is served from memory and revalidated on every load
+        for path in ['/', '/semantic-role-labeling', '/semantic-role-labeling/abcd']:
+            response = client.get(path)
+            assert response.status_code == 200
+            assert response.get_data(as_text=True) == '<html>demo</html>'
+            assert response.headers["Cache-Control"] == "no-cache"
+
+        # hashed bundles can be cached forever, and come compressed if the client accepts that
+        response = client.get('/static/js/main.0123abcd.js', headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert "immutable" in response.headers["Cache-Control"]
+        assert gzip.decompress(response.get_data()).decode() == bundle
+
+        etag = response.headers["ETag"]
+        response = client.get('/static/js/main.0123abcd.js',
+                              headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+        assert response.status_code == 304
+
+        response = client.get('/static/js/main.0123abcd.js')
+        assert "Content-Encoding" not in response.headers
+        assert response.get_data(as_text=True) == bundle
+
+        assert client.get('/static/js/missing.js').status_code == 404
+
     def test_missing_static_dir(self):
         fake_dir = self.TEST_DIR / 'this' / 'directory' / 'does' / 'not' / 'exist'
 
@@ -182,6 +1070,108 @@ class TestFlask(AllenNlpTestCase):
             make_app(fake_dir)
             assert cm.code == -1  # pylint: disable=no-member
 
+    def test_connection_pool(self):
+        postgres = FakePostgres()
+        pool = ConnectionPool(postgres.connect, size=2, check_after=0)
+
+        # connections go back in the pool to be reused
+        with pool.connection() as first:
+            pass
+        with pool.connection() as conn:
+            assert conn is first
+        assert postgres.connections == 1
+
+        # once they're all in use, the next caller waits for one to come back
+        checked_out = threading.Event()
+
+        def check_out() -> None:
+            with pool.connection():
+                checked_out.set()
+
+        with pool.connection(), pool.connection():
+            thread = threading.Thread(target=check_out)
+            thread.start()
+            assert not checked_out.wait(0.2)
+        assert checked_out.wait(10)
+        thread.join()
+        assert pool.stats()["open"] == 2
+
+        # a connection that fails is thrown away ...
+        try:
+            with pool.connection() as conn:
+                raise psycopg2.OperationalError("connection lost")
+        except psycopg2.OperationalError:
+            pass
+        assert pool.stats()["open"] == 1
+
+        # ... and so is one that's died while idle, which is replaced by a fresh one
+        with pool.connection() as conn:
+            conn.closed = True
+        with pool.connection() as conn:
+            assert not conn.closed
+        assert postgres.connections == 3
+        assert pool.stats()["open"] == 1
+
+    def test_write_behind(self):
+        postgres = FakePostgres()
+        database = FakePostgresDemoDatabase(postgres, write_behind=True, queue_size=3, enqueue_timeout=0.1)
+        postgres.held_thread = database._flusher  # pylint: disable=protected-access
+
+        def add(number: int) -> int:
+            return database.add_result({}, "model", {"n": number}, {"out": number}, content_key=str(number))
+
+        # while the first prediction is being written ...
+        ids = [add(0)]
+        assert postgres.batch_started.wait(10)
+        # ... the next ones wait in the queue, but their permalinks work already
+        ids.extend(add(number) for number in range(1, 4))
+        assert database.stats()["write_behind_queue"] == 3
+        assert ids[1] not in postgres.rows
+        assert database.get_result(ids[1]).request_data == {"n": 1}
+        # (and a repeat is counted in the queued row)
+        assert add(1) == ids[1]
+
+        # once the queue is full, predictions are written directly rather than waiting
+        ids.append(add(4))
+        assert ids[4] in postgres.rows
+
+        # closing writes everything that's queued, all together
+        postgres.release.set()
+        database.close()
+        assert set(postgres.rows) == set(ids)
+        assert postgres.batches == [1, 1, 3]
+        assert database.get_result(ids[2]).response_data == {"out": 2}
+        assert postgres.rows[ids[1]]['hits'] == 2
+
+        # a prediction that's already stored isn't queued again
+        assert add(2) == ids[2]
+
+    def test_repeats_are_counted(self):
+        postgres = FakePostgres()
+        database = FakePostgresDemoDatabase(postgres, batch_size=2)
+
+        def add(number: int) -> int:
+            return database.add_result({}, "model", {"n": number}, {"out": number}, content_key=str(number))
+
+        first, second = add(1), add(2)
+        assert {row['hits'] for row in postgres.rows.values()} == {1}
+
+        # repeats are counted in memory, and added to the rows a batch at a time ...
+        assert add(1) == first
+        assert postgres.rows[first]['hits'] == 1
+        assert add(1) == first
+        assert postgres.rows[first]['hits'] == 3
+
+        # ... or when the database is closed
+        assert add(2) == second
+        database.close()
+        assert postgres.rows[second]['hits'] == 2
+
+        # an insert that turns out to be a repeat counts too
+        row = dict(postgres.rows[second], id=None)
+        assert database._insert(row) == second  # pylint: disable=protected-access
+        assert postgres.rows[second]['hits'] == 3
+
     def test_permalinks_fail_gracefully_with_no_database(self):
         app = make_app(build_dir=self.TEST_DIR)
         predictor = CountingPredictor()
@@ -231,4 +1221,31 @@ class TestFlask(AllenNlpTestCase):
         assert set(result2.keys()) == {"modelName", "requestData", "responseData"}
         assert result2["modelName"] == "counting"
         assert result2["requestData"] == data
-        assert result2["responseData"] == result
+        # the slug is only added to the response, not stored with the outputs
+        assert result2["responseData"] == {key: value for key, value in result.items() if key != "slug"}
+
+        # submitting the same inputs again should give back the same permalink
+        # without storing the prediction a second time
+        response = post("/predict/counting", data=data)
+        assert json.loads(response.get_data())["slug"] == slug
+        assert len(db.data) == 1
+
+        # the same results are available with a cacheable GET
+        response = client.get(f"/permadata/{slug}")
+        assert response.status_code == 200
+        assert json.loads(response.get_data()) == result2
+        assert "immutable" in response.headers["Cache-Control"]
+
+        response = client.get(f"/permadata/{slug}", headers={"If-None-Match": response.headers["ETag"]})
+        assert response.status_code == 304
+
+        # and once they've been looked up, they're served without going back to the database
+        db.data = []
+        response = client.get(f"/permadata/{slug}")
+        assert response.status_code == 200
+        assert json.loads(response.get_data()) == result2
+
+        # a prediction that already has a slug gets it replaced, not duplicated
+        response = post("/predict/counting", data={"slug": "mine"})
+        assert response.get_data().count(b'"slug"') == 1
+        assert json.loads(response.get_data())["slug"] != "mine"